@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+MANIFEST_NAME = "manifest.json"
+
+
+def file_hash(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def config_hash(headers, dependency_files, settings=None):
+    # anything that changes how every file is normalised invalidates the whole cache
+    digest = hashlib.sha256()
+    digest.update(json.dumps(list(headers)).encode("utf-8"))
+    if settings is not None:
+        digest.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    for path in dependency_files:
+        digest.update(file_hash(path).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class AggregationCache:
+
+    def __init__(self, cache_dir, config):
+        self.cache_dir = cache_dir
+        self.config = config
+        self.entries = {}
+
+        os.makedirs(cache_dir, exist_ok=True)
+        manifest_path = os.path.join(cache_dir, MANIFEST_NAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, encoding="utf-8") as f:
+                manifest = json.load(f)
+            if manifest.get("config") == config:
+                self.entries = manifest.get("files", {})
+
+    def _frame_path(self, file_name):
+        return os.path.join(self.cache_dir, hashlib.sha1(file_name.encode("utf-8")).hexdigest() + ".pkl")
+
+    def lookup(self, file_name, content_hash):
+        # returns (hit, frame, error); frame is None for files that failed to load last time
+        entry = self.entries.get(file_name)
+        if entry is None or entry["hash"] != content_hash:
+            return False, None, None
+        if entry.get("error") is not None:
+            return True, None, entry["error"]
+        frame_path = self._frame_path(file_name)
+        if not os.path.exists(frame_path):
+            return False, None, None
+        return True, pd.read_pickle(frame_path), None
+
+    def store(self, file_name, content_hash, frame, error=None):
+        frame_path = self._frame_path(file_name)
+        if frame is not None:
+            frame.to_pickle(frame_path)
+        elif os.path.exists(frame_path):
+            os.remove(frame_path)
+        self.entries[file_name] = {"hash": content_hash, "error": error}
+
+    def prune(self, keep_file_names):
+        removed = [name for name in self.entries if name not in keep_file_names]
+        for file_name in removed:
+            frame_path = self._frame_path(file_name)
+            if os.path.exists(frame_path):
+                os.remove(frame_path)
+            del self.entries[file_name]
+        return removed
+
+    def save(self):
+        manifest_path = os.path.join(self.cache_dir, MANIFEST_NAME)
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"config": self.config, "files": self.entries}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, manifest_path)
@@ -1,8 +1,20 @@
+import argparse
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 import numpy as np
 
+from aggregation_cache import AggregationCache, config_hash, file_hash
+from columnar import write_columns
+from country_names import ALIASES_FILE, CountryNameResolver, parse_country_column
+from profiling import StageProfiler, finish_profile
+from reference import COUNTRIES_FILE, CountriesTable, reference_table
+
+# tracks.json holds the skip list of the pillar files, aggregator.py and tracks.py both read it
+TRACKS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tracks.json")
+
 pillars = [
     "business",
     "foundations",
@@ -13,31 +25,38 @@ pillars = [
     "strategy"
 ]
 
+# nullable Year and higher_is_better: a file with a blank cell still loads (the row is dropped later) and
+# years are written as integers
+indicator_dtypes = {
+    "Country Name": object,
+    "Year": "Int64",
+    "Indicator": object,
+    "data_col": np.float64,
+    "new_rank_score": np.float64,
+    "higher_is_better": "boolean",
+    "Sub-Pillar": object,
+}
 
-def filter_un_countries(df: pd.DataFrame):
-    countries_df = pd.read_csv("../data/Countries.csv")
-    countries_df = countries_df[["Country or Area", "UN Member States"]]
-    countries_df = countries_df.rename(columns={"Country or Area": "Country Name"})
-    countryList = ['Kosovo (UNSCR 1244)']
-
-    for country in countryList:
-        countries_df.loc[len(df.index)] = [country, 'y']
 
-    # filter UN Member States countries from countries_df
-    un_filter = countries_df["UN Member States"].isin(['x', 'y'])
-    countries_df = countries_df.where(un_filter)
-    countries_df = countries_df.dropna()
+def filter_un_countries(df: pd.DataFrame, countries=None, verbose=True):
+    # countries is a CountriesTable from the reference registry or a load_un_countries frame
+    if countries is None:
+        countries = reference_table("countries", COUNTRIES_FILE)
+    elif not isinstance(countries, CountriesTable):
+        countries = CountriesTable(countries)
 
-    print("Countries from Country.csv :", len(countries_df.index))
+    if verbose:
+        print("Countries from Country.csv :", len(countries.countries_df.index))
 
-    # df columns
-    columns = df.columns
-    # merge UN Member States to df
-    df = df.merge(countries_df, on=["Country Name"], how="left")
+    # attach UN Member States through the M49 country ids instead of merging on the name strings
+    df = df.assign(**{"UN Member States": countries.member_column(df["Country Name"])})
 
     # filter data where UN Member States is NaN
     df = df[df["UN Member States"].notna()]
 
+    if not verbose:
+        return df
+
     print(df.head(10).to_string())
 
     print(len(df.index))
@@ -53,231 +72,179 @@ def filter_un_countries(df: pd.DataFrame):
     return df
 
 
-def parse_country_names(df: pd.DataFrame):
-    df['Country Name'] = df['Country Name'].str.strip()
-    df['Country Name'] = df['Country Name'].str.strip('**')
-    df['Country Name'] = df['Country Name'].str.strip('*')
-    df['Country Name'] = df['Country Name'].str.strip('*')
-    df['Country Name'] = df['Country Name'].replace('-', np.nan, regex=False)
-    df['Country Name'] = df['Country Name'].replace('0.03', np.nan, regex=False)
-
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Bahamas.*$)', 'Bahamas (the)', regex=True)
-    df['Country Name'] = df['Country Name'].replace('Bahrain (Kingdom of)', 'Bahrain', regex=False)
-    df['Country Name'] = df['Country Name'].replace('Bolivia', 'Bolivia (Plurinational State of)', regex=False)
-    df['Country Name'] = df['Country Name'].replace('Bolivia, Plurinational State of',
-                                                    'Bolivia (Plurinational State of)', regex=False)
-    df['Country Name'] = df['Country Name'].replace('Brunei', 'Brunei Darussalam', regex=False)
-    df['Country Name'] = df['Country Name'].replace('Bulgaria (Rep.)', 'Bulgaria', regex=False)
-    df['Country Name'] = df['Country Name'].replace('Central African Republic', 'Central African Republic (the)',
-                                                    regex=False)
-    df['Country Name'] = df['Country Name'].replace('Central African Rep.', 'Central African Republic (the)',
-                                                    regex=False)
-    df['Country Name'] = df['Country Name'].replace("China (People's Rep.)", 'China', regex=False)
-    df['Country Name'] = df['Country Name'].replace("Comoros", 'Comoros (the)', regex=False)
-    df['Country Name'] = df['Country Name'].replace("Congo", 'Congo (the)', regex=False)
-    df['Country Name'] = df['Country Name'].replace("Congo (Brazzaville)", 'Congo (the)', regex=False)
-    df['Country Name'] = df['Country Name'].replace("Congo (Rep. of the)", 'Congo (the)', regex=False)
-    df['Country Name'] = df['Country Name'].replace("Congo (Democratic Republic of the)",
-                                                    'Democratic Republic of the Congo (the)', regex=False)
-    df['Country Name'] = df['Country Name'].replace("Congo, Dem. Rep.", 'Democratic Republic of the Congo (the)',
-                                                    regex=False)
-    df['Country Name'] = df['Country Name'].replace("Congo, The Democratic Republic of the",
-                                                    'Democratic Republic of the Congo (the)', regex=False)
-    df['Country Name'] = df['Country Name'].replace("DR Congo", 'Democratic Republic of the Congo (the)', regex=False)
-    df['Country Name'] = df['Country Name'].replace("Democratic Republic of Congo",
-                                                    'Democratic Republic of the Congo (the)', regex=False)
-    df['Country Name'] = df['Country Name'].replace("Democratic Republic of the Congo",
-                                                    'Democratic Republic of the Congo (the)', regex=False)
-    df['Country Name'] = df['Country Name'].replace("Dem. Rep. of the Congo", 'Democratic Republic of the Congo (the)',
-                                                    regex=False)
-
-    df['Country Name'] = df['Country Name'].replace("Cote d'Ivoire", "Côte d'Ivoire", regex=False)
-    df['Country Name'] = df['Country Name'].replace("Côte d’Ivoire", "Côte d'Ivoire", regex=False)
-    df['Country Name'] = df['Country Name'].replace("Cote dIvoire", "Côte d'Ivoire", regex=False)
-    df['Country Name'] = df['Country Name'].str.replace(r"(^.*Côte d'Ivoire.*$)", "Côte d'Ivoire", regex=True)
-    df['Country Name'] = df['Country Name'].replace("Cōte d'Ivoire", "Côte d'Ivoire", regex=False)
-    df['Country Name'] = df['Country Name'].replace("Ivory Coast", "Côte d'Ivoire", regex=False)
-    df['Country Name'] = df['Country Name'].replace("Dem. People's Rep. of Korea",
-                                                    "Democratic People's Republic of Korea (the)", regex=False)
-    df['Country Name'] = df['Country Name'].replace("Democratic People's Republic of Korea",
-                                                    "Democratic People's Republic of Korea (the)", regex=False)
-    df['Country Name'] = df['Country Name'].replace("Korea, Dem. People's Rep.",
-                                                    "Democratic People's Republic of Korea (the)", regex=False)
-    df['Country Name'] = df['Country Name'].replace("North Korea", "Democratic People's Republic of Korea (the)",
-                                                    regex=False)
-
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Czech.*$)', 'Czechia', regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Dominican Re.*$)', 'Dominican Republic (the)', regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Hong Kong.*$)',
-                                                        'China, Hong Kong Special Administrative Region', regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Hongkong.*$)',
-                                                        'China, Hong Kong Special Administrative Region', regex=True)
-    df['Country Name'] = df['Country Name'].replace("Eswatini (Kingdom of)", 'Eswatini', regex=False)
-    df['Country Name'] = df['Country Name'].replace("Swaziland", 'Eswatini', regex=False)
-    df['Country Name'] = df['Country Name'].replace("Faröe Islands", 'Faroe Islands', regex=False)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Gambia.*$)', 'Gambia (the)', regex=True)
-    df['Country Name'] = df['Country Name'].replace("Georgia (Country)", 'Georgia', regex=False)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Iran.*$)', 'Iran (Islamic Republic of)', regex=True)
-    df['Country Name'] = df['Country Name'].replace("Korea", 'Republic of Korea (the)', regex=False)
-    df['Country Name'] = df['Country Name'].replace("Korea (Rep. of)", 'Republic of Korea (the)', regex=False)
-    df['Country Name'] = df['Country Name'].replace("Korea (Rep.)", 'Republic of Korea (the)', regex=False)
-    df['Country Name'] = df['Country Name'].replace("Korea (Republic of)", 'Republic of Korea (the)', regex=False)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Korea, Rep.*$)', 'Republic of Korea (the)', regex=True)
-    df['Country Name'] = df['Country Name'].replace("Korea, South", 'Republic of Korea (the)', regex=False)
-    df['Country Name'] = df['Country Name'].replace("South Korea", 'Republic of Korea (the)', regex=False)
-    df['Country Name'] = df['Country Name'].replace("Republic of Korea", 'Republic of Korea (the)', regex=False)
-    df['Country Name'] = df['Country Name'].replace("Marshall Islands", 'Marshall Islands (the)', regex=False)
-
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Kyrgyz.*$)', 'Kyrgyzstan', regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Lao.*$)', "Lao People's Democratic Republic (the)",
-                                                        regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Macao.*$)', "China, Macao Special Administrative Region",
-                                                        regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Macau.*$)', "China, Macao Special Administrative Region",
-                                                        regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Micronesia.*$)', "Micronesia (Federated States of)",
-                                                        regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Moldova.*$)', "Republic of Moldova (the)", regex=True)
-    df['Country Name'] = df['Country Name'].replace("Morroco", 'Morocco', regex=False)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Nepal.*$)', "Nepal", regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*New Ze.*$)', "New Zealand", regex=True)
-    df['Country Name'] = df['Country Name'].replace("Niger", 'Niger (the)', regex=False)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Macedonia.*$)', "North Macedonia", regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*New Ze.*$)', "New Zealand", regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Palestin.*$)', "State of Palestine (the)", regex=True)
-    df['Country Name'] = df['Country Name'].replace("West Bank and Gaza", 'State of Palestine (the)', regex=False)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Panama.*$)', "Panama", regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Philippines.*$)', "Philippines (the)", regex=True)
-    df['Country Name'] = df['Country Name'].replace("Republic of the Congo", 'Congo (the)', regex=False)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Myanmar.*$)', "Myanmar", regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Puerto Rico.*$)', "Puerto Rico", regex=True)
-    df['Country Name'] = df['Country Name'].replace("Russia", 'Russian Federation (the)', regex=False)
-    df['Country Name'] = df['Country Name'].replace("Russian Federation", 'Russian Federation (the)', regex=False)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Slovak.*$)', "Slovakia", regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'\bSudan\b', 'Sudan (the)', regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'\bSudan (the)\b', 'Sudan (the)', regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*South Sudan.*$)', "South Sudan", regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Syria.*$)', "Syrian Arab Republic (the)", regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*São Tomé.*$)', "Sao Tome and Principe", regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Taiwan.*$)', "Taiwan", regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Taipei.*$)', "Taiwan", regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Tanzania.*$)', "United Republic of Tanzania (the)",
-                                                        regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Netherlands.*$)', "Netherlands (the)", regex=True)
-
-    df['Country Name'] = df['Country Name'].replace("UAE", 'United Arab Emirates (the)', regex=False)
-    df['Country Name'] = df['Country Name'].replace("U.A.E", 'United Arab Emirates (the)', regex=False)
-    df['Country Name'] = df['Country Name'].replace("United Arab Emirates", 'United Arab Emirates (the)', regex=False)
-    df['Country Name'] = df['Country Name'].replace('United Kingdom',
-                                                    'United Kingdom of Great Britain and Northern Ireland (the)',
-                                                    regex=False)
-    df['Country Name'] = df['Country Name'].replace('UK', 'United Kingdom of Great Britain and Northern Ireland (the)',
-                                                    regex=False)
-    df['Country Name'] = df['Country Name'].replace("Great Britain",
-                                                    'United Kingdom of Great Britain and Northern Ireland (the)',
-                                                    regex=False)
-    df['Country Name'] = df['Country Name'].replace("United Kingdom of Great Britain and Northern Ireland",
-                                                    'United Kingdom of Great Britain and Northern Ireland (the)',
-                                                    regex=False)
-    df['Country Name'] = df['Country Name'].replace('Vietnam', 'Viet Nam', regex=False)
-    df['Country Name'] = df['Country Name'].replace('United States', 'United States of America (the)', regex=False)
-    df['Country Name'] = df['Country Name'].replace('USA', 'United States of America (the)', regex=False)
-    df['Country Name'] = df['Country Name'].replace('United States of America', 'United States of America (the)',
-                                                    regex=False)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Virgin Islands.*$)', "United States Virgin Islands",
-                                                        regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Vatican.*$)', "Vatican", regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Venezuela.*$)', "Venezuela (Bolivarian Republic of)",
-                                                        regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Yemen.*$)', "Yemen", regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Arab world.*$)', "Arab World", regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*World.*$)', "World", regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Kitts and Nevis.*$)', "Saint Kitts and Nevis", regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Lucia.*$)', "Saint Lucia", regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Martin (French Part).*$)', "Saint Martin (French Part)",
-                                                        regex=True)
-    df['Country Name'] = df['Country Name'].replace('Sint Maarten', 'Saint Martin', regex=False)
-    df['Country Name'] = df['Country Name'].replace('St. Martin (French part)', 'Saint Martin (French Part)',
-                                                    regex=False)
-    df['Country Name'] = df['Country Name'].replace('Sint Maarten (Dutch part)', 'Saint Martin (Dutch Part)',
-                                                    regex=False)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Vincent and the Grenadines.*$)',
-                                                        "Saint Vincent and the Grenadines", regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Verde.*$)', "Cabo Verde", regex=True)
-    df['Country Name'] = df['Country Name'].replace('Congo, Democratic Republic',
-                                                    'Democratic Republic of the Congo (the)', regex=False)
-    df['Country Name'] = df['Country Name'].replace('Congo, Rep.', 'Congo (the)', regex=False)
-    df['Country Name'] = df['Country Name'].replace('Congo (Rep.)', 'Congo (the)', regex=False)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Egypt.*$)', "Egypt", regex=True)
-
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Korea, D.*$)',
-                                                        "Democratic People's Republic of Korea (the)", regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Tobago.*$)', "Trinidad and Tobago", regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Timor-Leste.*$)', "Timor-Leste", regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Emirates.*$)', "United Arab Emirates (the)", regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Papua.*$)', "Papua New Guinea", regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Bissau.*$)', "Guinea-Bissau", regex=True)
-    df['Country Name'] = df['Country Name'].replace('Eq. Guinea', 'Equatorial Guinea', regex=False)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Burma.*$)', "Myanmar", regex=True)
-    df['Country Name'] = df['Country Name'].replace('C.A. Republic', 'Central African Republic (the)', regex=False)
-    df['Country Name'] = df['Country Name'].replace('Ant.& Barb.', 'Antigua and Barbuda', regex=False)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Bosnia.*$)', "Bosnia and Herzegovina", regex=True)
-    df['Country Name'] = df['Country Name'].replace('Domin. Rep.', 'Dominican Republic (the)', regex=False)
-    df['Country Name'] = df['Country Name'].replace('Dominica (Commonwealth of)', 'Dominica', regex=False)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*European Union.*$)', "European Union", regex=True)
-    df['Country Name'] = df['Country Name'].replace('R. of Congo', 'Congo (the)', regex=False)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Principe.*$)', "Sao Tome and Principe", regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Solomon.*$)', "Solomon Islands", regex=True)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Vincent.*$)', "Saint Vincent and the Grenadines",
-                                                        regex=True)
-    df['Country Name'] = df['Country Name'].replace('Curacao', 'Curaçao', regex=False)
-    df['Country Name'] = df['Country Name'].replace('Reunion', 'Réunion', regex=False)
-    df['Country Name'] = df['Country Name'].str.replace(r'(^.*Kosovo.*$)', "Kosovo (UNSCR 1244)", regex=True)
+def parse_country_names(df: pd.DataFrame, resolver: CountryNameResolver = None):
+    resolver = resolver or CountryNameResolver()
+    df = parse_country_column(df, resolver)
+
+    unmatched = resolver.unmatched_names()
+    print("Country names not matched by any alias rule :", len(unmatched))
 
     return df.reset_index(drop=True).dropna()
 
 
-def aggregate_files(files_dir, headers, output_file, skip_file_names):
-    aggr_df = pd.DataFrame(columns=headers)
-    directory = os.fsencode(files_dir)
+def scan_indicator_files(files_dir, skip_file_names):
+    # list the directory once and split it into files to load and files to skip
+    to_load = []
+    skipped = []
+    for entry in sorted(os.scandir(files_dir), key=lambda x: x.name):
+        file_name = entry.name
+        if not entry.is_file() or not file_name.endswith(".csv"):
+            continue
+        file_pillar = file_name.split("_")[0]
+        if file_pillar.strip().lower() not in pillars:
+            skipped.append({"file": file_name, "reason": "not a pillar file", "detail": file_pillar})
+        elif file_name.strip() in skip_file_names:
+            skipped.append({"file": file_name, "reason": "in skip list", "detail": ""})
+        else:
+            to_load.append((file_name, file_pillar.strip().capitalize()))
+
+    return to_load, skipped
+
+
+def read_indicator_file(files_dir, file_name, pillar, headers):
+    # only read the columns we keep, with fixed dtypes so files concat without upcasting
+    columns = [h for h in headers if h != "Pillar"]
+    dtypes = {c: indicator_dtypes[c] for c in columns if c in indicator_dtypes}
+    try:
+        file_df = pd.read_csv(os.path.join(files_dir, file_name), usecols=columns, dtype=dtypes)
+    except ValueError as ex:
+        return None, {"file": file_name, "reason": "header check failed", "detail": str(ex)}
+
+    file_df["Pillar"] = pillar
+    return file_df[headers], None
+
 
-    for file in os.listdir(directory):
-        file_name = os.fsdecode(file)
-        if file_name.endswith(".csv"):
-            # print(file_name)
-            file_pillar = file_name.split("_")[0]
-            if file_pillar.strip().lower() not in pillars or file_name.strip() in skip_file_names:
-                print(file_pillar, file_name)
-                continue
-            # print(file_name)
-            file_df = pd.read_csv(files_dir + "/" + file_name)
-            pill_names = [file_pillar.strip().capitalize() for i in range(0, len(file_df.index))]
-            file_df["Pillar"] = pill_names
-            try:
-                file_df = file_df[headers]
-            except Exception as ex:
-                print(file_name, ":error:", ex)
-                continue
-            aggr_df = pd.concat([aggr_df, file_df], axis=0, join='outer', ignore_index=True)
+def load_indicator_files(files_dir, headers, skip_file_names, workers=None):
+    to_load, skipped = scan_indicator_files(files_dir, skip_file_names)
+    workers = workers or min(8, os.cpu_count() or 1)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda f: read_indicator_file(files_dir, f[0], f[1], headers), to_load))
+
+    frames = [file_df for file_df, _ in results if file_df is not None]
+    skipped += [error for _, error in results if error is not None]
 
-    aggr_df = parse_country_names(aggr_df)
-    aggr_df = filter_un_countries(aggr_df)
+    if len(frames) == 0:
+        return pd.DataFrame(columns=headers), skipped
 
-    aggr_df.to_csv(output_file, index=False)
+    return pd.concat(frames, axis=0, ignore_index=True), skipped
 
 
-if __name__ == "__main__":
-    skip_files = [
-        "people_Cyberbullying_scores.csv",
-        "business_Doing Business Index_scores.csv",
-        "infrastructure_Mobile Coverage Maps_scores.csv",
-        "infrastructure_Internet Exchange Points (IXPs) map_scores.csv",
-        "infrastructure_Software Developer Ecosystem size_scores.csv"
-    ]
+def print_skipped_files(skipped):
+    for item in skipped:
+        print(item["file"], ":", item["reason"], item["detail"])
+
+
+def normalise_indicator_frame(df, resolver, countries):
+    df = parse_country_column(df, resolver)
+    df = df.reset_index(drop=True).dropna()
+    return filter_un_countries(df, countries, verbose=False)
+
+
+def load_normalised_cached(files_dir, headers, skip_file_names, cache_dir, workers=None,
+                           countries_file=COUNTRIES_FILE):
+    # per-file normalisation gives the same rows as normalising the concatenated frame,
+    # so unchanged files can be served from the cache
+    to_load, skipped = scan_indicator_files(files_dir, skip_file_names)
+    workers = workers or min(8, os.cpu_count() or 1)
+
+    cache = AggregationCache(cache_dir, config_hash(headers, [ALIASES_FILE, countries_file],
+                                                    {c: pd.api.types.pandas_dtype(t).name
+                                                     for c, t in indicator_dtypes.items()}))
+    resolver = CountryNameResolver()
+    countries = reference_table("countries", countries_file)
+
+    def load_one(item):
+        file_name, pillar = item
+        content_hash = file_hash(os.path.join(files_dir, file_name))
+        hit, file_df, error = cache.lookup(file_name, content_hash)
+        if hit:
+            return file_name, content_hash, file_df, error, False
+        file_df, error = read_indicator_file(files_dir, file_name, pillar, headers)
+        return file_name, content_hash, file_df, error, True
 
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(load_one, to_load))
+
+    frames = []
+    refreshed = []
+    for file_name, content_hash, file_df, error, is_new in results:
+        if is_new:
+            if file_df is not None:
+                file_df = normalise_indicator_frame(file_df, resolver, countries)
+            cache.store(file_name, content_hash, file_df, error)
+            refreshed.append(file_name)
+        if error is not None:
+            skipped.append(error)
+        else:
+            frames.append(file_df)
+
+    removed = cache.prune({file_name for file_name, _ in to_load})
+    cache.save()
+    print("Cache: refreshed", len(refreshed), "files, reused", len(to_load) - len(refreshed), "removed", len(removed))
+
+    if len(frames) == 0:
+        return pd.DataFrame(columns=headers + ["UN Member States"]), skipped
+
+    return pd.concat(frames, axis=0, ignore_index=True), skipped
+
+
+def aggregate_files(files_dir, headers, output_file, skip_file_names, workers=None, cache_dir=None,
+                    profiler: StageProfiler = None, columnar_dir=None):
+    profiler = profiler or StageProfiler(enabled=False)
+    run = profiler.run
+
+    if cache_dir is not None:
+        aggr_df, skipped = run("load_normalised_cached", load_normalised_cached, files_dir, headers, skip_file_names,
+                               cache_dir, workers)
+        print_skipped_files(skipped)
+    else:
+        aggr_df, skipped = run("load_indicator_files", load_indicator_files, files_dir, headers, skip_file_names,
+                               workers)
+        print_skipped_files(skipped)
+
+        aggr_df = run("parse_country_names", parse_country_names, aggr_df)
+        aggr_df = run("filter_un_countries", filter_un_countries, aggr_df)
+
+    run("save_output_csv", aggr_df.to_csv, output_file, index=False)
+    if columnar_dir is not None:
+        # typed, dictionary encoded copy of output.csv that process_aggr.py can read instead of the CSV
+        run("save_output_columns", write_columns, aggr_df, columnar_dir)
+
+    return skipped
+
+
+def track_skip_files(track_name="pillars", config_file=TRACKS_FILE):
+    with open(config_file, encoding="utf-8") as f:
+        configs = json.load(f)["tracks"]
+    for config in configs:
+        if config["name"] == track_name:
+            return config.get("skip", [])
+    raise ValueError("{} has no track named {}".format(config_file, track_name))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--cache-dir", default=None,
+                        help="reuse normalised frames of unchanged indicator files, e.g. Processed/Cache/aggregation")
+    parser.add_argument("--columnar", nargs="?", const="Processed/Full Data/output_columns", default=None,
+                        help="also write the aggregated data as a column store")
+    parser.add_argument("--profile", nargs="?", const="Processed/Full Data/profile_aggregator.json", default=None,
+                        help="record per-stage time and memory and write a JSON report")
+    args = parser.parse_args()
+
+    skip_files = track_skip_files()
+
+    stage_profiler = StageProfiler(enabled=args.profile is not None)
     aggregate_files(
         "..\score\indicator_scores",
         ["Country Name", "Year", "Indicator", "data_col", "new_rank_score", "higher_is_better", "Pillar", "Sub-Pillar"],
         "Processed/Full Data/output.csv",
-        skip_files
+        skip_files,
+        workers=args.workers,
+        cache_dir=args.cache_dir,
+        profiler=stage_profiler,
+        columnar_dir=args.columnar
     )
+    finish_profile(stage_profiler, args.profile)
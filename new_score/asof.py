@@ -0,0 +1,176 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from incremental import frame_hash
+from process_aggr import ScoringEngine, roll_level_blocks
+from profiling import StageProfiler, finish_profile
+from reference import default_registry, init_worker, read_table, worker_object
+from scaling import INDICATOR_KEYS
+
+SERIES_KEYS = ["Country Name"] + INDICATOR_KEYS
+MANIFEST_NAME = "manifest.json"
+SUMMARY_COLUMNS = ["Country Name", "Pillar", "Sub-Pillar", "new_rank_score", "rank", "data_availability"]
+
+
+def parse_years(values):
+    # "2019", "2015-2021" or "2015:2021"
+    years = []
+    for value in values:
+        low, _, high = str(value).replace(":", "-").partition("-")
+        years.extend(range(int(low), int(high or low) + 1))
+    return sorted(set(years))
+
+
+class ObservationIndex:
+    # Rows of an indicator frame sorted by (country, indicator, year). A series is one country's
+    # observations of one indicator; as_of() picks the latest observation of every series at or before a
+    # target year with one binary search over the sorted keys.
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+        years = df["Year"].to_numpy(dtype=np.float64)
+        valid = np.flatnonzero(~np.isnan(years))
+        series = df.iloc[valid].groupby(SERIES_KEYS, sort=False, dropna=False).ngroup().to_numpy()
+        years = years[valid].astype(np.int64)
+
+        self.first_year = int(years.min()) if len(years) > 0 else 0
+        self.last_year = int(years.max()) if len(years) > 0 else 0
+        self.span = self.last_year - self.first_year + 1
+        # stable sort, so of two observations in the same year the later row wins
+        order = np.lexsort((years, series))
+        self.rows = valid[order]
+        self.series = series[order]
+        self.years = years[order]
+        self.keys = self.series * self.span + (self.years - self.first_year)
+        self.series_ids = np.unique(self.series)
+
+    def as_of(self, year, max_age=None):
+        # row positions (in frame order) of the latest observation of every series at or before year;
+        # with max_age, observations older than year - max_age are left out
+        if len(self.keys) == 0 or year < self.first_year:
+            return np.array([], dtype=np.int64)
+        offset = min(year, self.last_year) - self.first_year
+        found = np.searchsorted(self.keys, self.series_ids * self.span + offset, side="right") - 1
+        # a series whose first observation is after year lands on the previous series
+        hit = found >= 0
+        found = found[hit]
+        found = found[self.series[found] == self.series_ids[hit]]
+        if max_age is not None:
+            found = found[self.years[found] >= year - max_age]
+        return np.sort(self.rows[found])
+
+    def frame(self, year, max_age=None):
+        return self.df.iloc[self.as_of(year, max_age)].reset_index(drop=True)
+
+
+def score_year(engine: ScoringEngine, frame: pd.DataFrame, year, year_dir):
+    result = engine.score(frame)
+    os.makedirs(year_dir, exist_ok=True)
+    result.save(os.path.join(year_dir, "full_data.csv"), os.path.join(year_dir, "full_output_rolling.csv"))
+    summary = pd.concat(roll_level_blocks(result.full_df, result.cube)[0])[SUMMARY_COLUMNS]
+    summary.insert(0, "as_of_year", year)
+    summary.to_csv(os.path.join(year_dir, "summary.csv"), index=False)
+    return year
+
+
+def score_year_in_worker(frame, year, year_dir):
+    return score_year(worker_object("engine"), frame, year, year_dir)
+
+
+class AsOfScorer:
+    # Scores the index as it stood at every target year. Every year's input is hashed together with the
+    # reference tables; years whose input did not change since the last run are served from cache_dir,
+    # so adding a year of data only recomputes the years it feeds into.
+
+    def __init__(self, engine: ScoringEngine, cache_dir="Processed/AsOf", max_age=None):
+        self.engine = engine
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.manifest = {}
+        manifest_path = os.path.join(cache_dir, MANIFEST_NAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, encoding="utf-8") as f:
+                self.manifest = json.load(f)
+
+    def year_dir(self, year):
+        return os.path.join(self.cache_dir, str(year))
+
+    def input_hash(self, frame: pd.DataFrame):
+        engine = self.engine
+        return frame_hash(frame) + frame_hash(engine.weights) + frame_hash(engine.range_info_df) + \
+            frame_hash(engine.source_data_df) + json.dumps([self.max_age, engine.min_val, engine.max_val])
+
+    def is_cached(self, year, content_hash):
+        entry = self.manifest.get(str(year))
+        return entry is not None and entry["hash"] == content_hash and \
+            os.path.exists(os.path.join(self.year_dir(year), "summary.csv"))
+
+    def run(self, indicator_data, years, workers=1, force=False, profiler: StageProfiler = None):
+        profiler = profiler or StageProfiler(enabled=False)
+        run = profiler.run
+        self.engine.refresh()
+
+        index = run("build_observation_index", ObservationIndex, read_table(indicator_data))
+        frames = {}
+        hashes = {}
+        for year in years:
+            frame = index.frame(year, self.max_age)
+            if len(frame.index) == 0:
+                continue
+            hashes[year] = run("hash_year_input", self.input_hash, frame)
+            if force or not self.is_cached(year, hashes[year]):
+                frames[year] = frame
+
+        def score_all():
+            if workers > 1 and len(frames) > 1:
+                # the engine is sent to every worker once, tasks carry one year's rows
+                with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                         initargs=(default_registry(), {"engine": self.engine})) as executor:
+                    return list(executor.map(score_year_in_worker, frames.values(), frames.keys(),
+                                             [self.year_dir(year) for year in frames]))
+            return [score_year(self.engine, frame, year, self.year_dir(year)) for year, frame in frames.items()]
+
+        scored = run("score_years", score_all)
+        for year in scored:
+            self.manifest[str(year)] = {"hash": hashes[year], "rows": len(frames[year].index)}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(os.path.join(self.cache_dir, MANIFEST_NAME), "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+
+        series = run("build_series", self.series, sorted(hashes))
+        return series, {"years": sorted(hashes), "scored": sorted(scored),
+                        "cached": sorted(set(hashes) - set(scored))}
+
+    def series(self, years):
+        # country, pillar and sub-pillar scores and ranks of every year, one block per target year
+        frames = [pd.read_csv(os.path.join(self.year_dir(year), "summary.csv")) for year in years]
+        if len(frames) == 0:
+            return pd.DataFrame(columns=["as_of_year"] + SUMMARY_COLUMNS)
+        return pd.concat(frames, ignore_index=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score the index as of one or more past years")
+    parser.add_argument("--years", nargs="+", required=True, help="target years, e.g. 2019 or 2015-2021")
+    parser.add_argument("--max-age", type=int, default=None,
+                        help="leave out observations more than this many years older than the target year")
+    parser.add_argument("--input", default="Processed/Full Data/output.csv",
+                        help="indicator observations of every year, a CSV or a column store directory")
+    parser.add_argument("--cache-dir", default="Processed/AsOf")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--force", action="store_true", help="rescore every year, ignoring the cache")
+    parser.add_argument("--profile", nargs="?", const="Processed/AsOf/profile_asof.json", default=None)
+    args = parser.parse_args()
+
+    stage_profiler = StageProfiler(enabled=args.profile is not None)
+    countries_file = "../data/Countries.csv" if os.path.exists("../data/Countries.csv") else None
+    scorer = AsOfScorer(ScoringEngine("Weights.csv", "Sources.csv", countries_file), args.cache_dir, args.max_age)
+    series_df, summary = scorer.run(args.input, parse_years(args.years), args.workers, args.force, stage_profiler)
+    series_df.to_csv(os.path.join(args.cache_dir, "scores_by_year.csv"), index=False)
+    print(summary)
+    finish_profile(stage_profiler, args.profile)
@@ -0,0 +1,237 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import aggregator  # noqa: E402
+import process_aggr  # noqa: E402
+from profiling import StageProfiler  # noqa: E402
+from synthetic import generate_dataset  # noqa: E402
+from uncertainty import run_uncertainty  # noqa: E402
+
+HEADERS = ["Country Name", "Year", "Indicator", "data_col", "new_rank_score", "higher_is_better", "Pillar",
+           "Sub-Pillar"]
+OUTPUT_FILES = ["output.csv", "full_data.csv", "full_output_rolling.csv"]
+GOLDEN_DIR = os.path.join(BENCH_DIR, "golden")
+# small fixed dataset the golden outputs were produced from
+GOLDEN_CONFIG = {"entities": 30, "indicators": 14, "years": 2, "seed": 7}
+# entities whose sub-pillar and pillar scores tie up to the summation order (synthetic.py --tied)
+GOLDEN_TIES_DIR = os.path.join(BENCH_DIR, "golden_ties")
+GOLDEN_TIES_CONFIG = {"entities": 30, "indicators": 63, "years": 1, "seed": 3, "tied": True}
+GOLDEN_SETS = [(GOLDEN_DIR, GOLDEN_CONFIG), (GOLDEN_TIES_DIR, GOLDEN_TIES_CONFIG)]
+
+
+@contextlib.contextmanager
+def working_directory(path):
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def run_pipeline(files_dir, work_dir, quiet=True):
+    # one end to end run (aggregate + score), returns the per-stage profile
+    profiler = StageProfiler(enabled=True, trace_memory=False)
+    sink = io.StringIO() if quiet else sys.stdout
+    with working_directory(work_dir), contextlib.redirect_stdout(sink), warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        start = time.perf_counter()
+        aggregator.aggregate_files(files_dir, HEADERS, "Processed/Full Data/output.csv", [], profiler=profiler)
+        process_aggr.process_aggregated(HEADERS + ["UN Member States"], "Processed/Full Data/output.csv", profiler)
+        total = time.perf_counter() - start
+    return profiler.stages, total
+
+
+def benchmark(config, repeat):
+    with tempfile.TemporaryDirectory() as root_dir:
+        start = time.perf_counter()
+        files_dir, work_dir = generate_dataset(root_dir, config["entities"], config["indicators"], config["years"],
+                                               config["seed"])
+        generate_s = time.perf_counter() - start
+
+        stage_times = {}
+        totals = []
+        rows = None
+        for _ in range(repeat):
+            stages, total = run_pipeline(files_dir, work_dir)
+            totals.append(total)
+            for stage in stages:
+                stage_times.setdefault(stage["stage"], []).append(stage["wall_s"])
+                if stage["stage"] == "prepare":
+                    rows = stage["rows_out"]
+
+    return {
+        "config": config,
+        "repeat": repeat,
+        "rows": rows,
+        "generate_s": generate_s,
+        "stages": {name: statistics.median(times) for name, times in stage_times.items()},
+        "end_to_end_s": statistics.median(totals),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+    }
+
+
+def compare_results(current, baseline, threshold, min_seconds):
+    # a stage regresses when it is both relatively and absolutely slower than the baseline
+    regressions = []
+    lines = ["{:<32} {:>10} {:>10} {:>8}".format("stage", "baseline", "current", "ratio")]
+    pairs = [(name, baseline["stages"].get(name), t) for name, t in current["stages"].items()]
+    pairs.append(("end_to_end", baseline["end_to_end_s"], current["end_to_end_s"]))
+    for name, before, after in pairs:
+        if before is None:
+            lines.append("{:<32} {:>10} {:>10.3f} {:>8}".format(name, "-", after, "new"))
+            continue
+        ratio = after / before if before > 0 else float("inf")
+        flag = ""
+        if ratio > 1 + threshold and after - before > min_seconds:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        lines.append("{:<32} {:>10.3f} {:>10.3f} {:>8.2f}{}".format(name, before, after, ratio, flag))
+    return regressions, "\n".join(lines)
+
+
+def compare_frames(expected, actual, name, atol):
+    problems = []
+    if list(expected.columns) != list(actual.columns):
+        return ["{}: columns differ".format(name)]
+    if len(expected.index) != len(actual.index):
+        return ["{}: {} rows, expected {}".format(name, len(actual.index), len(expected.index))]
+    for column in expected.columns:
+        a, b = expected[column], actual[column]
+        if a.dtype.kind == "f" and b.dtype.kind == "f":
+            same = np.isclose(a.to_numpy(), b.to_numpy(), rtol=0, atol=atol, equal_nan=True)
+        else:
+            same = (a.astype(str) == b.astype(str)).to_numpy()
+        if not same.all():
+            problems.append("{}: column '{}' differs in {} rows".format(name, column, int((~same).sum())))
+    return problems
+
+
+def published_ranks(out_dir):
+    # ranks of full_data.csv and the roll file, labelled like the uncertainty summary
+    full_df = pd.read_csv(os.path.join(out_dir, "full_data.csv"))
+    roll_df = pd.read_csv(os.path.join(out_dir, "full_output_rolling.csv"))
+    sub_pillars = full_df.drop_duplicates(["Country Name", "Pillar", "Sub-Pillar"])
+    pillars = full_df.drop_duplicates(["Country Name", "Pillar"])
+    countries = roll_df[roll_df["Pillar"].isna()]
+    return pd.concat([
+        pd.DataFrame({"level": "sub_pillar", "Country Name": sub_pillars["Country Name"],
+                      "Pillar": sub_pillars["Pillar"], "Sub-Pillar": sub_pillars["Sub-Pillar"],
+                      "published_rank": sub_pillars["country_sub_pillar_rank"]}),
+        pd.DataFrame({"level": "pillar", "Country Name": pillars["Country Name"], "Pillar": pillars["Pillar"],
+                      "Sub-Pillar": "", "published_rank": pillars["country_pillar_rank"]}),
+        pd.DataFrame({"level": "country", "Country Name": countries["Country Name"], "Pillar": "",
+                      "Sub-Pillar": "", "published_rank": countries["rank"]}),
+    ], ignore_index=True)
+
+
+def uncertainty_rank_check(work_dir, name):
+    # the unperturbed ranks of uncertainty.py must be the published ones
+    with working_directory(work_dir), warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        engine = process_aggr.ScoringEngine("Weights.csv", "Sources.csv")
+        summary = run_uncertainty(engine, "Processed/Full Data/output.csv", replicates=2, resample=False).summary()
+    merged = summary.merge(published_ranks(os.path.join(work_dir, "Processed", "Full Data")),
+                           on=["level", "Country Name", "Pillar", "Sub-Pillar"], how="left")
+    different = merged["base_rank"].astype(float).fillna(-1) != merged["published_rank"].fillna(-1)
+    if different.any():
+        return ["{}: uncertainty base_rank differs from the published rank in {} rows".format(
+            name, int(different.sum()))]
+    return []
+
+
+def golden_check(update=False, atol=1e-9):
+    problems = []
+    for golden_dir, config in GOLDEN_SETS:
+        with tempfile.TemporaryDirectory() as root_dir:
+            files_dir, work_dir = generate_dataset(root_dir, config["entities"], config["indicators"],
+                                                   config["years"], config["seed"], config.get("tied", False))
+            run_pipeline(files_dir, work_dir)
+            out_dir = os.path.join(work_dir, "Processed", "Full Data")
+
+            if update:
+                os.makedirs(golden_dir, exist_ok=True)
+                for file_name in OUTPUT_FILES:
+                    pd.read_csv(os.path.join(out_dir, file_name)).to_csv(os.path.join(golden_dir, file_name),
+                                                                         index=False)
+                continue
+
+            for file_name in OUTPUT_FILES:
+                expected = pd.read_csv(os.path.join(golden_dir, file_name))
+                actual = pd.read_csv(os.path.join(out_dir, file_name))
+                problems += compare_frames(expected, actual, os.path.join(os.path.basename(golden_dir), file_name),
+                                           atol)
+            problems += uncertainty_rank_check(work_dir, os.path.basename(golden_dir))
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the new_score pipeline on synthetic data")
+    parser.add_argument("--entities", type=int, default=190)
+    parser.add_argument("--indicators", type=int, default=120)
+    parser.add_argument("--years", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed relative slowdown per stage")
+    parser.add_argument("--min-seconds", type=float, default=0.05, help="ignore slowdowns smaller than this")
+    parser.add_argument("--golden", action="store_true", help="check outputs against benchmarks/golden*")
+    parser.add_argument("--update-golden", action="store_true", help="rewrite benchmarks/golden*")
+    parser.add_argument("--skip-timing", action="store_true")
+    args = parser.parse_args()
+
+    exit_code = 0
+
+    if args.golden or args.update_golden:
+        problems = golden_check(update=args.update_golden)
+        if args.update_golden:
+            print("golden outputs written to", ", ".join(golden_dir for golden_dir, _ in GOLDEN_SETS))
+        elif problems:
+            print("golden check FAILED")
+            print("\n".join(problems))
+            exit_code = 1
+        else:
+            print("golden check passed")
+
+    if not args.skip_timing:
+        results = benchmark({"entities": args.entities, "indicators": args.indicators, "years": args.years,
+                             "seed": args.seed}, args.repeat)
+        print("rows: {}  end to end: {:.3f}s".format(results["rows"], results["end_to_end_s"]))
+        for name, seconds in results["stages"].items():
+            print("  {:<32} {:>9.3f}".format(name, seconds))
+
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
+
+        if args.compare:
+            with open(args.compare, encoding="utf-8") as f:
+                baseline = json.load(f)
+            if baseline["config"] != results["config"]:
+                print("warning: baseline was run with", baseline["config"])
+            regressions, table = compare_results(results, baseline, args.threshold, args.min_seconds)
+            print(table)
+            if regressions:
+                print("regressions:", ", ".join(regressions))
+                exit_code = 1
+
+    sys.exit(exit_code)
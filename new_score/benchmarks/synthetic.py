@@ -0,0 +1,150 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+PILLARS = ["Business", "Foundations", "Government", "Infrastructure", "People", "Regulation", "Strategy"]
+SUB_PILLARS_PER_PILLAR = 3
+
+
+def entity_names(n_entities):
+    return ["Entity {:05d}".format(i) for i in range(n_entities)]
+
+
+def indicator_layout(n_indicators):
+    # spread indicators round-robin over pillars and their sub-pillars
+    rows = []
+    for i in range(n_indicators):
+        pillar = PILLARS[i % len(PILLARS)]
+        sub_pillar = "{} Sub-Pillar {}".format(pillar, (i // len(PILLARS)) % SUB_PILLARS_PER_PILLAR + 1)
+        rows.append((pillar, sub_pillar, "Indicator {:04d}".format(i)))
+    return pd.DataFrame(rows, columns=["Pillar", "Sub-Pillar", "Indicator"])
+
+
+def write_countries(path, names, rng):
+    # most entities are ranked UN members ('x'), some are listed but unranked ('y')
+    members = np.where(rng.random(len(names)) < 0.9, "x", "y")
+    countries_df = pd.DataFrame({
+        "Country or Area": names,
+        "M49 Code": np.arange(1, len(names) + 1),
+        "ISO-alpha3 Code": ["E{:05d}".format(i) for i in range(len(names))],
+        "UN Member States": members,
+        "UNDP Region": rng.choice(["Africa", "Arab States", "Asia and the Pacific", "Europe and Central Asia",
+                                   "Latin America and the Caribbean"], len(names)),
+        "World Bank Income Level": rng.choice(["Low Income", "Lower Middle Income", "Upper Middle Income",
+                                               "High Income"], len(names)),
+    })
+    countries_df.to_csv(path, index=False)
+
+
+def write_weights(path, layout, rng, equal_in_sub_pillar=False):
+    sub_df = layout[["Pillar", "Sub-Pillar"]].drop_duplicates().assign(Indicator=np.nan)
+    sub_df["Weight"] = rng.integers(1, 4, len(sub_df))
+    if equal_in_sub_pillar:
+        ind_df = layout.merge(sub_df[["Pillar", "Sub-Pillar", "Weight"]], on=["Pillar", "Sub-Pillar"], how="left")
+    else:
+        ind_df = layout.assign(Weight=rng.integers(1, 4, len(layout)))
+    pd.concat([sub_df, ind_df], ignore_index=True).to_csv(path, index=False)
+
+
+def write_sources(path, layout, rng, index_share=0.3):
+    sources_df = layout.copy()
+    is_index = rng.random(len(layout)) < index_share
+    sources_df["Raw/Index"] = np.where(is_index, "Index", "Raw")
+    sources_df["min"] = np.where(is_index, 0, np.nan)
+    sources_df["max"] = np.where(is_index, 100, np.nan)
+    sources_df["Data Source"] = ["Source {}".format(i) for i in range(len(layout))]
+    sources_df["Data Link"] = ["https://example.org/source/{}".format(i) for i in range(len(layout))]
+    sources_df.to_csv(path, index=False)
+
+
+def write_indicator_files(files_dir, layout, names, n_years, rng, missing_rate=0.1):
+    names = np.asarray(names, dtype=object)
+    years = np.arange(2021 - n_years + 1, 2022, dtype=np.float64)
+    for pillar, sub_pillar, indicator in layout.itertuples(index=False):
+        country = np.tile(names, n_years)
+        year = np.repeat(years, len(names))
+        keep = rng.random(len(country)) >= missing_rate
+        n = int(keep.sum())
+        # rounded values give the tied and constant quantile bands the scaler has to handle
+        data_col = np.round(rng.gamma(2.0, 20.0, n), rng.integers(0, 3))
+        file_df = pd.DataFrame({
+            "Country Name": country[keep],
+            "Year": year[keep],
+            "Indicator": indicator,
+            "data_col": data_col,
+            "new_rank_score": np.round(rng.uniform(1, 5.99, n), 2),
+            "higher_is_better": bool(rng.random() >= 0.2),
+            "Sub-Pillar": sub_pillar,
+        })
+        file_name = "{}_{}_scores.csv".format(pillar.lower(), indicator)
+        file_df.to_csv(os.path.join(files_dir, file_name), index=False)
+
+
+def write_tied_indicator_files(files_dir, layout, names, rng, group_size=3):
+    # entities come in groups of group_size; within every sub-pillar, the members of a group hold the same
+    # values in a different order, so their sub-pillar and pillar scores are equal up to the summation
+    # order and must share a rank
+    names = np.asarray(names, dtype=object)
+    n_groups = -(-len(names) // group_size)
+    data = {}
+    for _, sub_layout in layout.groupby(["Pillar", "Sub-Pillar"], sort=False):
+        indicators = list(sub_layout["Indicator"])
+        group_values = np.round(rng.uniform(0, 100, (n_groups, len(indicators))), 3)
+        values = np.empty((len(names), len(indicators)))
+        for i in range(len(names)):
+            # a rotation per member, reversed for every other group
+            rotated = np.roll(group_values[i // group_size], i % group_size)
+            values[i] = rotated[::-1] if (i // group_size) % 2 else rotated
+        data.update({indicator: values[:, j] for j, indicator in enumerate(indicators)})
+    for pillar, sub_pillar, indicator in layout.itertuples(index=False):
+        file_df = pd.DataFrame({
+            "Country Name": names,
+            "Year": 2021.0,
+            "Indicator": indicator,
+            "data_col": data[indicator],
+            "new_rank_score": np.round(rng.uniform(1, 5.99, len(names)), 2),
+            "higher_is_better": True,
+            "Sub-Pillar": sub_pillar,
+        })
+        file_name = "{}_{}_scores.csv".format(pillar.lower(), indicator)
+        file_df.to_csv(os.path.join(files_dir, file_name), index=False)
+
+
+def generate_dataset(root_dir, n_entities, n_indicators, n_years=1, seed=0, tied=False):
+    # mirrors the repository layout: data/, score/indicator_scores/ and new_score/
+    rng = np.random.default_rng(seed)
+    files_dir = os.path.join(root_dir, "score", "indicator_scores")
+    work_dir = os.path.join(root_dir, "new_score")
+    for path in [os.path.join(root_dir, "data"), files_dir, os.path.join(work_dir, "Processed", "Full Data")]:
+        os.makedirs(path, exist_ok=True)
+
+    names = entity_names(n_entities)
+    layout = indicator_layout(n_indicators)
+
+    write_countries(os.path.join(root_dir, "data", "Countries.csv"), names, rng)
+    write_weights(os.path.join(work_dir, "Weights.csv"), layout, rng, equal_in_sub_pillar=tied)
+    if tied:
+        # Index indicators on a fixed 0-100 range, so equal values always scale to equal scores, and one
+        # weight for all indicators of a sub-pillar, so reordered values give equal weighted means
+        write_sources(os.path.join(work_dir, "Sources.csv"), layout, rng, index_share=1.0)
+        write_tied_indicator_files(files_dir, layout, names, rng)
+    else:
+        write_sources(os.path.join(work_dir, "Sources.csv"), layout, rng)
+        write_indicator_files(files_dir, layout, names, n_years, rng)
+
+    return files_dir, work_dir
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic new_score dataset")
+    parser.add_argument("root_dir")
+    parser.add_argument("--entities", type=int, default=190)
+    parser.add_argument("--indicators", type=int, default=120)
+    parser.add_argument("--years", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tied", action="store_true", help="entities in groups whose scores tie")
+    args = parser.parse_args()
+
+    generate_dataset(args.root_dir, args.entities, args.indicators, args.years, args.seed, args.tied)
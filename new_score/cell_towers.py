@@ -0,0 +1,346 @@
+import argparse
+import gzip
+import io
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from country_names import CountryNameResolver
+from profiling import StageProfiler, finish_profile
+from reference import default_registry, init_worker, worker_object
+
+# The checked-in data/cell_towers_geolocation.csv.gz is the JSON error page of a rate limited download, not
+# tower data. The real file is OpenCelliD's full cell_towers.csv.gz export, downloaded with an OpenCelliD
+# access token (two downloads per file per day) and saved under this name or passed with --input.
+TOWERS_FILE = "../data/cell_towers_geolocation.csv.gz"
+FETCH_HINT = "download OpenCelliD's full cell_towers.csv.gz export with an access token and pass it with --input"
+GEOJSON_FILE = "../ui/database/raw/country-geojson.json"
+BOUNDING_BOXES_FILE = "../ui/database/raw/bounding-boxes.json"
+AREA_FILE = "../data/Area.csv"
+POPULATION_FILE = "../data/Population.csv"
+
+# OpenCelliD layout: radio,mcc,net,area,cell,unit,lon,lat,range,samples,changeable,created,updated,averageSignal
+TOWER_COLUMNS = {"lat": "lat", "lon": "lon", "radio": "radio"}
+BLOCK_BYTES = 16 * 1024 * 1024
+# points x edges compared at once by the polygon test
+TEST_CELLS = 4 * 1024 * 1024
+HR_ASSOCIATION = "Access"
+SCORE_COLUMNS = ["Country Name", "Year", "Indicator", "data_col", "new_rank_score", "higher_is_better",
+                 "HRAssociation"]
+DENSITY_INDICATORS = {
+    "area": ("Cell Towers per 1000 sq. km", 1000.0),
+    "population": ("Cell Towers per 100k People", 100000.0),
+}
+
+
+def feature_polygons(geometry):
+    if geometry is None:
+        return []
+    if geometry["type"] == "Polygon":
+        return [geometry["coordinates"]]
+    if geometry["type"] == "MultiPolygon":
+        return geometry["coordinates"]
+    raise ValueError("Unsupported geometry type: {}".format(geometry["type"]))
+
+
+class CountryIndex:
+    # Every polygon of every country as a bounding box plus the edges of its rings. Points are sorted by
+    # longitude once per chunk, the boxes cut them down to a contiguous candidate range and only the
+    # candidates inside a box go through the even-odd ray casting test against that polygon's edges.
+    # Countries without geometry fall back to their bounding-boxes.json box for points no polygon took.
+
+    def __init__(self, geojson_file=GEOJSON_FILE, bounding_boxes_file=BOUNDING_BOXES_FILE):
+        with open(geojson_file, encoding="utf-8") as f:
+            features = json.load(f)["features"]
+        boxes = {}
+        if bounding_boxes_file is not None and os.path.exists(bounding_boxes_file):
+            with open(bounding_boxes_file, encoding="utf-8") as f:
+                boxes = json.load(f)
+
+        self.codes = []
+        box_rows = []
+        edge_starts = [0]
+        edges = []
+        self.fallback = []
+        for feature in features:
+            code = feature["properties"]["ISO3CD"]
+            if code not in self.codes:
+                self.codes.append(code)
+            country = self.codes.index(code)
+            polygons = feature_polygons(feature["geometry"])
+            if not polygons and code in boxes:
+                box = boxes[code]
+                self.fallback.append((country, box["sw"]["lon"], box["sw"]["lat"], box["ne"]["lon"], box["ne"]["lat"]))
+            for polygon in polygons:
+                rings = [np.asarray(ring, dtype=np.float64)[:, :2] for ring in polygon if len(ring) > 2]
+                if not rings:
+                    continue
+                points = np.concatenate(rings)
+                # bounding-boxes.json misses parts of many countries (e.g. Alaska), so the boxes are the
+                # polygons' own extents
+                box_rows.append((country, *points.min(axis=0), *points.max(axis=0)))
+                for ring in rings:
+                    edges.append(np.hstack([ring, np.roll(ring, -1, axis=0)]))
+                edge_starts.append(edge_starts[-1] + sum(len(ring) for ring in rings))
+
+        boxes_array = np.array(box_rows, dtype=np.float64).reshape(-1, 5)
+        self.polygon_country = boxes_array[:, 0].astype(np.int64)
+        self.boxes = boxes_array[:, 1:]
+        self.edge_starts = np.array(edge_starts, dtype=np.int64)
+        edges = np.concatenate(edges) if edges else np.empty((0, 4))
+        self.x1, self.y1, x2, y2 = edges.T.copy()
+        # horizontal edges never straddle a point's latitude, their slope is never used
+        dy = y2 - self.y1
+        self.slope = np.divide(x2 - self.x1, dy, out=np.zeros_like(dy), where=dy != 0)
+        self.y2 = y2
+
+    def contains(self, polygon, lon, lat):
+        start, stop = self.edge_starts[polygon], self.edge_starts[polygon + 1]
+        x1, y1, y2, slope = (a[start:stop] for a in (self.x1, self.y1, self.y2, self.slope))
+        inside = np.zeros(len(lon), dtype=bool)
+        block = max(1, TEST_CELLS // max(1, stop - start))
+        for first in range(0, len(lon), block):
+            px = lon[first:first + block, None]
+            py = lat[first:first + block, None]
+            crosses = ((y1 > py) != (y2 > py)) & (px < x1 + (py - y1) * slope)
+            inside[first:first + block] = np.logical_xor.reduce(crosses, axis=1)
+        return inside
+
+    def assign(self, lon, lat):
+        # country id of every point, -1 outside every country; of overlapping polygons the first one wins
+        country = np.full(len(lon), -1, dtype=np.int64)
+        order = np.argsort(lon, kind="stable")
+        sorted_lon = lon[order]
+        starts = np.searchsorted(sorted_lon, self.boxes[:, 0], side="left")
+        stops = np.searchsorted(sorted_lon, self.boxes[:, 2], side="right")
+        for polygon in np.flatnonzero(stops > starts):
+            rows = order[starts[polygon]:stops[polygon]]
+            rows = rows[(country[rows] < 0) & (lat[rows] >= self.boxes[polygon, 1]) &
+                        (lat[rows] <= self.boxes[polygon, 3])]
+            if len(rows) == 0:
+                continue
+            rows = rows[self.contains(polygon, lon[rows], lat[rows])]
+            country[rows] = self.polygon_country[polygon]
+
+        for country_id, west, south, east, north in self.fallback:
+            inside = (country < 0) & (lon >= west) & (lon <= east) & (lat >= south) & (lat <= north)
+            country[inside] = country_id
+        return country
+
+
+def grid_cells(lon, lat, grid):
+    rows = np.floor((lat + 90.0) / grid).astype(np.int64)
+    columns = np.floor((lon + 180.0) / grid).astype(np.int64)
+    return rows, columns
+
+
+def count_towers(block, names, index: CountryIndex, columns=TOWER_COLUMNS, grid=None):
+    # (country x radio counts, country x grid cell counts or None, rows read) of one block of CSV lines
+    df = pd.read_csv(io.BytesIO(block), header=None, names=names,
+                     usecols=[columns["lat"], columns["lon"], columns["radio"]])
+    rows_read = len(df.index)
+    lon = pd.to_numeric(df[columns["lon"]], errors="coerce").to_numpy(dtype=np.float64)
+    lat = pd.to_numeric(df[columns["lat"]], errors="coerce").to_numpy(dtype=np.float64)
+    valid = ~(np.isnan(lon) | np.isnan(lat))
+    lon, lat = lon[valid], lat[valid]
+    radio = df[columns["radio"]].fillna("").astype(str).to_numpy()[valid]
+
+    country = index.assign(lon, lat)
+    found = country >= 0
+    counts = pd.Series(1, index=pd.MultiIndex.from_arrays([country[found], radio[found]],
+                                                          names=["country", "radio"])).groupby(level=[0, 1]).sum()
+    cell_counts = None
+    if grid is not None:
+        cell_rows, cell_columns = grid_cells(lon[found], lat[found], grid)
+        cell_counts = pd.Series(1, index=pd.MultiIndex.from_arrays(
+            [country[found], cell_rows, cell_columns], names=["country", "cell_row", "cell_column"])) \
+            .groupby(level=[0, 1, 2]).sum()
+    return counts, cell_counts, rows_read
+
+
+def count_towers_in_worker(block, names, columns, grid):
+    return count_towers(block, names, worker_object("tower_index"), columns, grid)
+
+
+def read_blocks(towers_file, block_bytes=BLOCK_BYTES):
+    # (header names, generator of blocks of whole lines); gzip input is detected by its magic bytes and
+    # decompressed sequentially, never more than one block is held. Quoted fields must not span lines.
+    with open(towers_file, "rb") as f:
+        start = f.read(256)
+    f = gzip.open(towers_file, "rb") if start[:2] == b"\x1f\x8b" else open(towers_file, "rb")
+    header = f.readline()
+    if header.lstrip().startswith((b"{", b"<")):
+        # a failed download leaves an error document in place of the dump
+        f.close()
+        raise ValueError("{} is not a tower CSV: {}; {}".format(
+            towers_file, header[:200].decode("utf-8", "replace"), FETCH_HINT))
+    names = header.decode("utf-8-sig").strip().split(",")
+
+    def blocks():
+        with f:
+            rest = b""
+            while True:
+                data = f.read(block_bytes)
+                if not data:
+                    break
+                data = rest + data
+                cut = data.rfind(b"\n") + 1
+                if cut == 0:
+                    rest = data
+                    continue
+                rest = data[cut:]
+                yield data[:cut]
+            if rest.strip():
+                yield rest
+
+    return names, blocks()
+
+
+class TowerCounts:
+    # Running totals per country and radio (and per grid cell); bounded by the number of countries,
+    # radio types and cells, not by the number of towers read.
+
+    def __init__(self):
+        self.counts = None
+        self.cell_counts = None
+        self.rows_read = 0
+
+    @staticmethod
+    def combine(total, counts):
+        if total is None or counts is None:
+            return counts if total is None else total
+        return total.add(counts, fill_value=0).astype(np.int64)
+
+    def add(self, result):
+        counts, cell_counts, rows_read = result
+        self.counts = self.combine(self.counts, counts)
+        self.cell_counts = self.combine(self.cell_counts, cell_counts)
+        self.rows_read += rows_read
+
+
+def ingest_towers(towers_file, index: CountryIndex, workers=1, block_bytes=BLOCK_BYTES, columns=TOWER_COLUMNS,
+                  grid=None):
+    names, blocks = read_blocks(towers_file, block_bytes)
+    missing = [column for column in columns.values() if column not in names]
+    if missing:
+        raise ValueError("{} is missing columns: {}".format(towers_file, missing))
+
+    totals = TowerCounts()
+    if workers <= 1:
+        for block in blocks:
+            totals.add(count_towers(block, names, index, columns, grid))
+        return totals
+
+    # the index is sent to every worker once; at most two blocks per worker are in flight, so memory
+    # does not grow with the file
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(default_registry(), {"tower_index": index})) as executor:
+        pending = deque()
+        for block in blocks:
+            pending.append(executor.submit(count_towers_in_worker, block, names, columns, grid))
+            if len(pending) >= 2 * workers:
+                totals.add(pending.popleft().result())
+        while pending:
+            totals.add(pending.popleft().result())
+    return totals
+
+
+def latest_values(wide_file, name):
+    # latest reported year of every country of a World Bank wide table
+    df = pd.read_csv(wide_file, encoding="utf-8-sig")
+    years = [column for column in df.columns if str(column).isdigit()]
+    values = df[years].apply(pd.to_numeric, errors="coerce")
+    latest = values.notna().to_numpy()[:, ::-1].argmax(axis=1)
+    has_value = values.notna().any(axis=1).to_numpy()
+    year_index = len(years) - 1 - latest
+    return pd.DataFrame({
+        "Country Code": df["Country Code"],
+        "Country Name": df["Country Name"],
+        name: np.where(has_value, values.to_numpy()[np.arange(len(df.index)), year_index], np.nan),
+        name + "_year": np.where(has_value, np.array(years, dtype=np.int64)[year_index], -1),
+    })[has_value]
+
+
+def convert_rank(values: pd.Series, old_min, old_max, new_min=1, new_max=6):
+    # linear rescale of the HR notebooks' convert_rank, which produced the other HR_*_scores.csv files
+    old_range = old_max - old_min
+    if old_range == 0:
+        return pd.Series(float(new_max), index=values.index)
+    return ((values - old_min) * (new_max - new_min)) / old_range + new_min
+
+
+def density_scores(totals: TowerCounts, index: CountryIndex, area_file=AREA_FILE, population_file=POPULATION_FILE):
+    # country x radio counts pivoted, then towers per area and per person; countries inside the geometry
+    # without a single tower count as 0
+    counts = totals.counts.unstack("radio", fill_value=0) if totals.counts is not None else pd.DataFrame()
+    counts = counts.reindex(range(len(index.codes)), fill_value=0)
+    counts.insert(0, "towers", counts.sum(axis=1).astype(np.int64))
+    counts.insert(0, "Country Code", index.codes)
+
+    area = latest_values(area_file, "area")
+    population = latest_values(population_file, "population")
+    counts = counts.merge(area, on="Country Code", how="left") \
+        .merge(population.drop(columns="Country Name"), on="Country Code", how="left")
+    for measure in DENSITY_INDICATORS:
+        counts[measure + "_year"] = counts[measure + "_year"].astype("Int64")
+    counts["Country Name"] = CountryNameResolver().resolve_series(counts["Country Name"])
+
+    scores = {}
+    for measure, (indicator, per) in DENSITY_INDICATORS.items():
+        df = counts[counts["Country Name"].notna() & (counts[measure] > 0)]
+        df = pd.DataFrame({
+            "Country Name": df["Country Name"],
+            "Year": df[measure + "_year"].astype(np.int64),
+            "Indicator": indicator,
+            "data_col": df["towers"] / df[measure] * per,
+        })
+        # densities have no fixed scale, the observed range is mapped onto 1-6
+        df["new_rank_score"] = convert_rank(df["data_col"], df["data_col"].min(), df["data_col"].max())
+        df["higher_is_better"] = True
+        df["HRAssociation"] = HR_ASSOCIATION
+        scores[indicator] = df[SCORE_COLUMNS].sort_values("Country Name", kind="stable").reset_index(drop=True)
+    return counts, scores
+
+
+def save_outputs(totals: TowerCounts, index: CountryIndex, output_dir, area_file=AREA_FILE,
+                 population_file=POPULATION_FILE):
+    os.makedirs(output_dir, exist_ok=True)
+    counts, scores = density_scores(totals, index, area_file, population_file)
+    counts.to_csv(os.path.join(output_dir, "cell_tower_counts.csv"), index=False)
+    for indicator, df in scores.items():
+        df.to_csv(os.path.join(output_dir, "HR_{}_scores.csv".format(indicator)), index=False)
+    if totals.cell_counts is not None:
+        cells = totals.cell_counts.rename("towers").reset_index()
+        cells.insert(0, "Country Code", np.array(index.codes, dtype=object)[cells.pop("country").to_numpy()])
+        cells.to_csv(os.path.join(output_dir, "cell_tower_grid.csv"), index=False)
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cell tower density indicators from the tower geolocation dump")
+    parser.add_argument("--input", default=TOWERS_FILE, help="tower CSV, gzip compressed or plain")
+    parser.add_argument("--output-dir", default="Processed/Cell Towers")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--block-mb", type=float, default=BLOCK_BYTES / (1024 * 1024),
+                        help="decompressed MB of CSV parsed per task")
+    parser.add_argument("--grid", type=float, default=None, help="also count towers per grid cell of this many degrees")
+    parser.add_argument("--geojson", default=GEOJSON_FILE)
+    parser.add_argument("--bounding-boxes", default=BOUNDING_BOXES_FILE)
+    parser.add_argument("--area", default=AREA_FILE)
+    parser.add_argument("--population", default=POPULATION_FILE)
+    parser.add_argument("--profile", nargs="?", const="Processed/Cell Towers/profile_cell_towers.json", default=None)
+    args = parser.parse_args()
+
+    stage_profiler = StageProfiler(enabled=args.profile is not None)
+    country_index = stage_profiler.run("build_country_index", CountryIndex, args.geojson, args.bounding_boxes)
+    tower_totals = stage_profiler.run("ingest_towers", ingest_towers, args.input, country_index, args.workers,
+                                      int(args.block_mb * 1024 * 1024), TOWER_COLUMNS, args.grid)
+    tower_counts = stage_profiler.run("save_outputs", save_outputs, tower_totals, country_index, args.output_dir,
+                                      args.area, args.population)
+    print("{} towers read, {} assigned to {} countries".format(
+        tower_totals.rows_read, int(tower_counts["towers"].sum()), int((tower_counts["towers"] > 0).sum())))
+    finish_profile(stage_profiler, args.profile)
@@ -0,0 +1,147 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+SCHEMA_FILE = "schema.json"
+SCHEMA_VERSION = 1
+# float columns that only ever hold whole numbers and are stored as the smallest fitting integer
+INTEGER_COLUMNS = ["Year"]
+
+
+def smallest_int_dtype(low, high):
+    for dtype in (np.int8, np.int16, np.int32, np.int64):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return dtype
+    return np.int64
+
+
+def is_column_store(path):
+    return isinstance(path, (str, os.PathLike)) and os.path.isfile(os.path.join(path, SCHEMA_FILE))
+
+
+def column_file_name(index, suffix):
+    return "{:03d}_{}.npy".format(index, suffix)
+
+
+def encode_column(name, series: pd.Series):
+    # returns (schema entry, {suffix: array}) for one column
+    values = series.to_numpy()
+
+    if series.dtype == bool:
+        return {"name": name, "kind": "bool"}, {"values": values}
+
+    if isinstance(series.dtype, pd.BooleanDtype):
+        # nullable booleans (higher_is_better): values plus a missing mask
+        return {"name": name, "kind": "nullable_bool"}, \
+            {"values": series.to_numpy(dtype=bool, na_value=False), "mask": series.isna().to_numpy()}
+
+    if isinstance(series.dtype, pd.api.extensions.ExtensionDtype) and series.dtype.kind in "iu":
+        # nullable integers (ranks): values plus a missing mask
+        mask = series.isna().to_numpy()
+        values = series.to_numpy(dtype=np.int64, na_value=0)
+        dtype = smallest_int_dtype(values.min(), values.max()) if len(values) > 0 else np.int8
+        return {"name": name, "kind": "nullable_int", "dtype": series.dtype.name}, \
+            {"values": values.astype(dtype), "mask": mask}
+
+    if series.dtype.kind in "iu":
+        dtype = smallest_int_dtype(values.min(), values.max()) if len(values) > 0 else np.int8
+        return {"name": name, "kind": "int", "dtype": series.dtype.name}, {"values": values.astype(dtype)}
+
+    if series.dtype.kind == "f":
+        integral = len(values) > 0 and not np.isnan(values).any() and np.array_equal(values, np.round(values))
+        if name in INTEGER_COLUMNS and integral:
+            dtype = smallest_int_dtype(values.min(), values.max())
+            return {"name": name, "kind": "int", "dtype": series.dtype.name}, {"values": values.astype(dtype)}
+        return {"name": name, "kind": "float", "dtype": series.dtype.name}, {"values": values}
+
+    # labels are dictionary encoded: small integer codes per row, every distinct string stored once.
+    # Values are stored as text, the same way a CSV round trip would bring them back.
+    codes, categories = pd.factorize(series)
+    categories = np.asarray([str(value) for value in categories], dtype=str)
+    codes = codes.astype(smallest_int_dtype(-1, max(len(categories) - 1, 0)))
+    return {"name": name, "kind": "label"}, {"codes": codes, "categories": categories}
+
+
+def write_columns(df: pd.DataFrame, store_dir):
+    # one .npy file per column plus schema.json, the schema is written last and marks the store complete
+    os.makedirs(store_dir, exist_ok=True)
+    schema_path = os.path.join(store_dir, SCHEMA_FILE)
+    if os.path.exists(schema_path):
+        os.remove(schema_path)
+
+    columns = []
+    for index, name in enumerate(df.columns):
+        entry, arrays = encode_column(name, df[name])
+        entry["files"] = {}
+        for suffix, array in arrays.items():
+            file_name = column_file_name(index, suffix)
+            np.save(os.path.join(store_dir, file_name), array, allow_pickle=False)
+            entry["files"][suffix] = file_name
+        columns.append(entry)
+
+    with open(schema_path, "w", encoding="utf-8") as f:
+        json.dump({"version": SCHEMA_VERSION, "rows": len(df.index), "columns": columns}, f, indent=2)
+    return store_dir
+
+
+def read_schema(store_dir):
+    with open(os.path.join(store_dir, SCHEMA_FILE), encoding="utf-8") as f:
+        schema = json.load(f)
+    if schema["version"] != SCHEMA_VERSION:
+        raise ValueError("Unsupported column store version {} in {}".format(schema["version"], store_dir))
+    return schema
+
+
+def load_array(store_dir, file_name, mmap=True):
+    return np.load(os.path.join(store_dir, file_name), mmap_mode="r" if mmap else None, allow_pickle=False)
+
+
+def decode_column(store_dir, entry, rows=None, mmap=True, categorical=False):
+    if entry["kind"] == "label":
+        codes = load_array(store_dir, entry["files"]["codes"], mmap)
+        codes = np.asarray(codes if rows is None else codes[rows], dtype=np.int64)
+        categories = load_array(store_dir, entry["files"]["categories"], mmap=False)
+        if categorical:
+            return pd.Categorical.from_codes(codes, categories.astype(object))
+        labels = np.append(categories.astype(object), np.nan)
+        return labels[codes]
+
+    values = load_array(store_dir, entry["files"]["values"], mmap)
+    if entry["kind"] == "nullable_bool":
+        mask = load_array(store_dir, entry["files"]["mask"], mmap)
+        return pd.arrays.BooleanArray(np.array(values if rows is None else values[rows]),
+                                      np.array(mask if rows is None else mask[rows]))
+    if entry["kind"] == "nullable_int":
+        mask = load_array(store_dir, entry["files"]["mask"], mmap)
+        return pd.arrays.IntegerArray(np.array(values if rows is None else values[rows], dtype=np.int64),
+                                      np.array(mask if rows is None else mask[rows])).astype(entry["dtype"])
+
+    # copy out of the memory map, the frame is modified downstream
+    values = np.array(values if rows is None else values[rows])
+    if entry["kind"] == "int":
+        # integers are only narrowed on disk, the frame gets the dtype that was written
+        return values.astype(entry["dtype"])
+    return values
+
+
+def read_columns(store_dir, columns=None, pillars=None, mmap=True, categorical=False):
+    # Only the requested columns are read; with pillars, the Pillar codes are scanned first and every
+    # other column is read for the matching rows only.
+    schema = read_schema(store_dir)
+    entries = {entry["name"]: entry for entry in schema["columns"]}
+    names = [entry["name"] for entry in schema["columns"]] if columns is None else list(columns)
+    missing = [name for name in names if name not in entries]
+    if missing:
+        raise KeyError("Columns not in {}: {}".format(store_dir, missing))
+
+    rows = None
+    if pillars is not None:
+        entry = entries["Pillar"]
+        categories = load_array(store_dir, entry["files"]["categories"], mmap=False)
+        wanted = np.flatnonzero(np.isin(categories, list(pillars)))
+        rows = np.flatnonzero(np.isin(load_array(store_dir, entry["files"]["codes"], mmap), wanted))
+
+    return pd.DataFrame({name: decode_column(store_dir, entries[name], rows, mmap, categorical) for name in names})
@@ -0,0 +1,80 @@
+import csv
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+ALIASES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "country_aliases.csv")
+
+
+def load_alias_rules(alias_file=ALIASES_FILE):
+    # rules are applied top to bottom, each one on the output of the previous one,
+    # exactly like the old chain of .replace / .str.replace calls
+    rules = []
+    with open(alias_file, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            kind = row["kind"]
+            pattern = row["pattern"]
+            replacement = row["replacement"]
+            if kind == "strip":
+                rules.append((kind, pattern or None, None))
+            elif kind == "regex":
+                rules.append((kind, re.compile(pattern), replacement))
+            elif kind in ("exact", "null"):
+                rules.append((kind, pattern, replacement))
+            else:
+                raise ValueError("Unknown alias rule kind '{}' in {}".format(kind, alias_file))
+    return rules
+
+
+class CountryNameResolver:
+
+    def __init__(self, rules=None):
+        self.rules = load_alias_rules() if rules is None else rules
+        self._cache = {}
+        self._unmatched = set()
+
+    def resolve(self, name):
+        if name in self._cache:
+            return self._cache[name]
+
+        value, matched = self._apply_rules(name)
+        if not matched and isinstance(value, str):
+            self._unmatched.add(value)
+        self._cache[name] = value
+        return value
+
+    def _apply_rules(self, value):
+        # .str methods turn anything that is not a string into NaN
+        if not isinstance(value, str):
+            return np.nan, False
+
+        matched = False
+        for kind, pattern, replacement in self.rules:
+            if kind == "strip":
+                value = value.strip(pattern)
+            elif kind == "regex":
+                value, n = pattern.subn(replacement, value)
+                matched = matched or n > 0
+            elif value == pattern:
+                matched = True
+                if kind == "null":
+                    return np.nan, True
+                value = replacement
+        return value, matched
+
+    def resolve_series(self, names: pd.Series):
+        # resolve each distinct name once, then broadcast back with a single map
+        uniques = names.dropna().unique()
+        lookup = {name: self.resolve(name) for name in uniques}
+        return names.map(lookup)
+
+    def unmatched_names(self):
+        return sorted(self._unmatched)
+
+
+def parse_country_column(df: pd.DataFrame, resolver: CountryNameResolver = None, column="Country Name"):
+    resolver = resolver or CountryNameResolver()
+    df[column] = resolver.resolve_series(df[column])
+    return df
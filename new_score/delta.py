@@ -0,0 +1,248 @@
+import argparse
+import bisect
+import hashlib
+import io
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+HIERARCHY_KEYS = ["Country Name", "Pillar", "Sub-Pillar", "Indicator"]
+# a row is identified by its place in the hierarchy and the year of its data
+ROW_KEYS = HIERARCHY_KEYS + ["Year"]
+# lines parsed at a time, so reading a published file never holds more than one chunk of it
+CHUNK_ROWS = 50000
+# score and rank column reported in the changes of every published file
+PUBLISHED_FILES = {
+    "full_data.csv": ("indicator_score", None),
+    "full_output_rolling.csv": ("new_rank_score", "rank"),
+}
+
+
+def read_chunks(f, chunk_rows=CHUNK_ROWS):
+    # consecutive lists of at most chunk_rows lines (as bytes) after the header
+    chunk = []
+    for line in f:
+        chunk.append(line)
+        if len(chunk) == chunk_rows:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def chunk_state(frame: pd.DataFrame, lines, score_column, rank_column):
+    return frame[ROW_KEYS].assign(
+        row_hash=pd.util.hash_array(np.array(lines, dtype=object)) if lines else np.array([], dtype=np.uint64),
+        score=pd.to_numeric(frame[score_column], errors="coerce") if score_column else np.nan,
+        rank=pd.to_numeric(frame[rank_column], errors="coerce") if rank_column else np.nan)
+
+
+def read_rows(path, score_column, rank_column=None):
+    # (header, state, file hash) of a published CSV, read a chunk of lines at a time: state has the row key,
+    # a hash of the key (with its occurrence number, so repeated keys stay distinct), a hash of the line and
+    # the score and rank of every row
+    columns = ROW_KEYS + [c for c in (score_column, rank_column) if c is not None]
+    file_hash = hashlib.sha256()
+    states = []
+    with open(path, "rb") as f:
+        header = f.readline()
+        file_hash.update(header)
+        for chunk in read_chunks(f):
+            for line in chunk:
+                file_hash.update(line)
+            frame = pd.read_csv(io.BytesIO(header + b"".join(chunk)), usecols=columns, dtype=str, na_filter=False)
+            if len(frame.index) != len(chunk):
+                raise ValueError("{} has fields spanning several lines, rows cannot be diffed line by line"
+                                 .format(path))
+            states.append(chunk_state(frame, chunk, score_column, rank_column))
+    if not states:
+        states.append(chunk_state(pd.read_csv(io.BytesIO(header), usecols=columns, dtype=str), [],
+                                  score_column, rank_column))
+    state = pd.concat(states, ignore_index=True)
+
+    occurrence = state.groupby(ROW_KEYS, sort=False).cumcount()
+    key_hash = pd.util.hash_pandas_object(state[ROW_KEYS].assign(_occurrence=occurrence), index=False).to_numpy()
+    state.insert(len(ROW_KEYS), "key_hash", key_hash)
+    state.insert(len(ROW_KEYS) + 2, "line", np.arange(1, len(state.index) + 1))
+    return header, state, file_hash.hexdigest()
+
+
+def read_lines(path, line_numbers):
+    # {line number: text} of the wanted lines, streamed from the file
+    wanted = set(line_numbers)
+    lines = {}
+    if not wanted:
+        return lines
+    with open(path, "rb") as f:
+        for number, line in enumerate(f):
+            if number in wanted:
+                lines[number] = line.decode("utf-8")
+    return lines
+
+
+def increasing_rows(values):
+    # mask of a longest strictly increasing run (not necessarily contiguous) of the non-negative values,
+    # found by patience sorting in O(n log n)
+    tail_values, tail_rows = [], []
+    previous = np.full(len(values), -1, dtype=np.int64)
+    for row in np.flatnonzero(values >= 0):
+        length = bisect.bisect_left(tail_values, values[row])
+        previous[row] = tail_rows[length - 1] if length > 0 else -1
+        if length == len(tail_values):
+            tail_values.append(values[row])
+            tail_rows.append(row)
+        else:
+            tail_values[length] = values[row]
+            tail_rows[length] = row
+    mask = np.zeros(len(values), dtype=bool)
+    row = tail_rows[-1] if tail_rows else -1
+    while row >= 0:
+        mask[row] = True
+        row = previous[row]
+    return mask
+
+
+def edit_script(old_state: pd.DataFrame, new_state: pd.DataFrame, path):
+    # new file as runs of old lines to copy and literal lines; a row is copied when its key and content
+    # are unchanged and it comes after every row copied before it, so the old file is read front to back
+    # when the script is applied. Only the literal lines are read back from the new file.
+    matched = new_state[["key_hash", "row_hash"]].merge(
+        old_state[["key_hash", "row_hash", "line"]], on=["key_hash", "row_hash"], how="left")
+    old_lines = matched["line"].fillna(-1).to_numpy(dtype=np.int64)
+    old_lines[~increasing_rows(old_lines)] = -1
+    literal_lines = read_lines(path, np.flatnonzero(old_lines < 0) + 1)
+
+    script = []
+    for position, old_line in enumerate(old_lines):
+        if old_line < 0:
+            script.append(["line", literal_lines[position + 1]])
+        elif script and script[-1][0] == "copy" and script[-1][1] + script[-1][2] == old_line:
+            script[-1][2] += 1
+        else:
+            script.append(["copy", int(old_line), 1])
+    return script
+
+
+def row_changes(old_state: pd.DataFrame, new_state: pd.DataFrame):
+    # inserts, updates and deletes with their score and rank deltas
+    merged = new_state.merge(old_state, on="key_hash", how="outer", suffixes=("", "_old"), indicator=True)
+    merged = merged[(merged["_merge"] != "both") | (merged["row_hash"] != merged["row_hash_old"])]
+    op = np.select([merged["_merge"] == "left_only", merged["_merge"] == "right_only"], ["insert", "delete"], "update")
+
+    changes = pd.DataFrame({"op": op})
+    for key in ROW_KEYS:
+        changes[key] = merged[key].where(merged[key].notna(), merged[key + "_old"]).to_numpy()
+    for column in ["score", "rank"]:
+        changes["old_" + column] = merged[column + "_old"].to_numpy()
+        changes["new_" + column] = merged[column].to_numpy()
+        changes[column + "_delta"] = changes["new_" + column] - changes["old_" + column]
+    return changes
+
+
+def diff_file(path, state_file, score_column, rank_column=None):
+    # changeset of path against the state stored by the previous publish; the new state is returned and
+    # only stored once the caller commits it
+    header, new_state, new_hash = read_rows(path, score_column, rank_column)
+    old_state = pd.read_pickle(state_file) if os.path.exists(state_file) else new_state.iloc[:0]
+    old_hash = old_state.attrs.get("file_hash")
+    new_state.attrs["file_hash"] = new_hash
+
+    changes = row_changes(old_state, new_state)
+    changeset = {
+        "file": os.path.basename(path),
+        "old_hash": old_hash,
+        "new_hash": new_hash,
+        "header": header.decode("utf-8"),
+        "counts": changes["op"].value_counts().reindex(["insert", "update", "delete"], fill_value=0).to_dict(),
+        "script": edit_script(old_state, new_state, path) if old_hash != new_hash else
+        [["copy", 1, len(new_state.index)]],
+        "changes": json.loads(changes.to_json(orient="records")),
+    }
+    return changeset, new_state
+
+
+def hashed_lines(f, digest):
+    for line in f:
+        digest.update(line)
+        yield line
+
+
+def apply_changeset(changeset, published_file, output_file=None, check=True):
+    # rewrites published_file (or writes output_file) into the file the changeset was computed from. The
+    # old file is read once, front to back, and the result is written to a temporary file next to the
+    # target that only replaces it once both hashes check out.
+    target = output_file or published_file
+    old_hash = hashlib.sha256()
+    new_hash = hashlib.sha256()
+    handle, temp_file = tempfile.mkstemp(suffix=".partial", dir=os.path.dirname(os.path.abspath(target)))
+    try:
+        with open(published_file, "rb") as f, os.fdopen(handle, "wb") as out:
+            old_lines = hashed_lines(f, old_hash)
+            position = 0
+            for step in [["line", changeset["header"]]] + changeset["script"]:
+                if step[0] == "line":
+                    data = step[1].encode("utf-8")
+                    new_hash.update(data)
+                    out.write(data)
+                    continue
+                start, count = step[1], step[2]
+                if start < position:
+                    raise ValueError("changeset copies line {} after line {}".format(start, position))
+                for _ in range(start - position):
+                    next(old_lines, None)
+                for _ in range(count):
+                    line = next(old_lines, None)
+                    if line is None:
+                        raise ValueError("{} has fewer lines than the changeset copies".format(published_file))
+                    new_hash.update(line)
+                    out.write(line)
+                position = start + count
+            for _ in old_lines:
+                pass
+
+        if check and changeset["old_hash"] is not None and old_hash.hexdigest() != changeset["old_hash"]:
+            raise ValueError("{} is not the file this changeset was computed against".format(published_file))
+        if check and new_hash.hexdigest() != changeset["new_hash"]:
+            raise ValueError("applying the changeset to {} did not reproduce the new file".format(published_file))
+        os.replace(temp_file, target)
+    except BaseException:
+        os.remove(temp_file)
+        raise
+    return len(changeset["changes"])
+
+
+def publish_deltas(output_dir="Processed/Full Data", delta_dir="Processed/Delta", files=PUBLISHED_FILES):
+    # writes <file>.changeset.json for every published file and moves the stored state forward
+    os.makedirs(delta_dir, exist_ok=True)
+    counts = {}
+    for name, (score_column, rank_column) in files.items():
+        path = os.path.join(output_dir, name)
+        if not os.path.exists(path):
+            continue
+        state_file = os.path.join(delta_dir, name + ".state.pkl")
+        changeset, state = diff_file(path, state_file, score_column, rank_column)
+        with open(os.path.join(delta_dir, name + ".changeset.json"), "w", encoding="utf-8") as f:
+            json.dump(changeset, f, ensure_ascii=False, separators=(",", ":"))
+        state.to_pickle(state_file)
+        counts[name] = changeset["counts"]
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Changesets between scoring runs")
+    parser.add_argument("--output-dir", default="Processed/Full Data", help="directory of the new run's CSVs")
+    parser.add_argument("--delta-dir", default="Processed/Delta")
+    parser.add_argument("--apply", metavar="CHANGESET", help="apply a changeset instead of computing them")
+    parser.add_argument("--target", help="published file to patch with --apply")
+    parser.add_argument("--out", help="write the patched file here instead of overwriting --target")
+    args = parser.parse_args()
+
+    if args.apply:
+        with open(args.apply, encoding="utf-8") as f:
+            loaded = json.load(f)
+        print(apply_changeset(loaded, args.target, args.out), "rows changed")
+    else:
+        print(publish_deltas(args.output_dir, args.delta_dir))
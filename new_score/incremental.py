@@ -0,0 +1,299 @@
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from process_aggr import (ScoringEngine, ScoringResult, add_country_pillar_score, add_country_sub_pillar_score,
+                          add_sources, build_roll_df, handle_higher_not_better, prep_pillar_count,
+                          prep_total_indicator_map, prep_total_sub_pillar_map, process_df)
+from integer_keys import KEY_COLUMNS
+from profiling import StageProfiler, finish_profile
+from scaling import INDICATOR_KEYS
+
+FULL_DATA_KEYS = ["Country Name", "Pillar", "Sub-Pillar", "Indicator", "Year"]
+ROLL_KEYS = ["Country Name", "Pillar", "Sub-Pillar", "Indicator", "Year"]
+
+
+def indicator_hashes(df: pd.DataFrame):
+    # content hash of every indicator's rows, in row order
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    codes, keys = pd.factorize(pd.MultiIndex.from_frame(df[INDICATOR_KEYS].astype(str)))
+    order = np.argsort(codes, kind="stable")
+    starts = np.flatnonzero(np.r_[True, np.diff(codes[order]) != 0])
+    hashes = {}
+    for key_id, rows in zip(codes[order][starts], np.split(order, starts[1:])):
+        hashes[keys[key_id]] = hashlib.sha1(row_hashes[rows].tobytes()).hexdigest()
+    return hashes
+
+
+def frame_hash(df: pd.DataFrame):
+    return hashlib.sha1(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes()).hexdigest()
+
+
+def row_positions(old_df: pd.DataFrame, new_df: pd.DataFrame, keys):
+    # position of every new row in old_df, matching on keys plus the occurrence number of the key; -1 if absent
+    def keyed(df):
+        key_df = df[keys].astype(str)
+        return key_df.assign(_occurrence=key_df.groupby(keys, sort=False).cumcount().to_numpy())
+
+    old_keys = keyed(old_df).assign(_position=np.arange(len(old_df.index)))
+    merged = keyed(new_df).merge(old_keys, on=keys + ["_occurrence"], how="left")
+    return merged["_position"].fillna(-1).to_numpy(dtype=np.int64)
+
+
+def unchanged_rows(old_df: pd.DataFrame, new_df: pd.DataFrame, old_positions, rows):
+    # of the given rows, the ones matched in old_df with the same dtype and value in every column, whose line
+    # in the old file is still the right one
+    unchanged = rows & (old_positions >= 0)
+    if list(old_df.columns) != list(new_df.columns):
+        return np.zeros(len(new_df.index), dtype=bool)
+    candidates = np.flatnonzero(unchanged)
+    for column in new_df.columns:
+        if old_df[column].dtype != new_df[column].dtype:
+            return np.zeros(len(new_df.index), dtype=bool)
+        old_values = old_df[column].iloc[old_positions[candidates]].reset_index(drop=True)
+        new_values = new_df[column].iloc[candidates].reset_index(drop=True)
+        same = (old_values == new_values).fillna(False).to_numpy(dtype=bool) | \
+            (old_values.isna() & new_values.isna()).to_numpy()
+        unchanged[candidates[~same]] = False
+    return unchanged
+
+
+def splice_csv(old_file, new_df: pd.DataFrame, old_positions, reuse, output_file):
+    # rewrite output_file taking the lines of reused rows from old_file and rendering the others
+    with open(old_file, "rb") as f:
+        old_lines = f.read().splitlines(keepends=True)
+
+    rendered = new_df[~reuse].to_csv(index=False, header=False).encode("utf-8").splitlines(keepends=True)
+    rendered = iter(rendered)
+    with open(output_file, "wb") as f:
+        f.write(old_lines[0])
+        for position, reused in zip(old_positions, reuse):
+            f.write(old_lines[position + 1] if reused else next(rendered))
+    return int((~reuse).sum())
+
+
+def dependency_graph(df: pd.DataFrame):
+    indicators = df[INDICATOR_KEYS].drop_duplicates()
+    sub_pillars = indicators[["Pillar", "Sub-Pillar"]].drop_duplicates()
+    return {
+        "indicator_sub_pillar": [[p, sp, str(i), p + "|" + sp] for p, sp, i in indicators.to_numpy()],
+        "sub_pillar_pillar": [[p + "|" + sp, p] for p, sp in sub_pillars.to_numpy()],
+        "pillar_country_rank": sorted(sub_pillars["Pillar"].unique().tolist()),
+    }
+
+
+class IncrementalScorer:
+    # Keeps the last scored frames, the indicator -> sub-pillar -> pillar -> country rank graph and a
+    # content hash per indicator in state_dir. update() recomputes only the sub-pillars and pillars the
+    # changed indicators feed into and patches full_data.csv / full_output_rolling.csv line by line: of the
+    # recomputed rows, only the ones whose published values differ from the previous run are rendered
+    # again, the others keep their old line.
+
+    def __init__(self, engine: ScoringEngine, state_dir="Processed/Incremental",
+                 full_data_file="Processed/Full Data/full_data.csv",
+                 roll_file="Processed/Full Data/full_output_rolling.csv"):
+        self.engine = engine
+        self.state_dir = state_dir
+        self.full_data_file = full_data_file
+        self.roll_file = roll_file
+        self.reference_hash = self.reference_digest()
+        self.state = self.load_state()
+
+    def reference_digest(self):
+        return frame_hash(self.engine.weights) + frame_hash(self.engine.range_info_df) + \
+            frame_hash(self.engine.source_data_df)
+
+    def state_file(self):
+        return os.path.join(self.state_dir, "state.pkl")
+
+    def load_state(self):
+        if not os.path.exists(self.state_file()):
+            return None
+        with open(self.state_file(), "rb") as f:
+            state = pickle.load(f)
+        if state["reference_hash"] != self.reference_hash:
+            return None
+        return state
+
+    def save_state(self, result: ScoringResult, hashes):
+        os.makedirs(self.state_dir, exist_ok=True)
+        self.state = {"result": result, "hashes": hashes, "reference_hash": self.reference_hash}
+        with open(self.state_file(), "wb") as f:
+            pickle.dump(self.state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(os.path.join(self.state_dir, "graph.json"), "w", encoding="utf-8") as f:
+            json.dump(dependency_graph(result.full_df), f, indent=2)
+
+    def build(self, indicator_data, profiler: StageProfiler = None):
+        profiler = profiler or StageProfiler(enabled=False)
+        prepared = profiler.run("prepare", self.engine.prepare, indicator_data)
+        result = self.engine.score(prepared.copy(), profiler)
+        profiler.run("save_full_csv", result.full_data.to_csv, self.full_data_file, index=False)
+        profiler.run("save_roll_csv", result.save_roll, self.roll_file)
+        self.save_state(result, indicator_hashes(prepared))
+        return result, {"mode": "full"}
+
+    def changed_indicators(self, new_hashes, changed=None):
+        old_hashes = self.state["hashes"]
+        keys = set(old_hashes) | set(new_hashes)
+        found = {key for key in keys if old_hashes.get(key) != new_hashes.get(key)}
+        if changed:
+            found |= {tuple(str(part) for part in key) for key in changed}
+        return found
+
+    def update(self, indicator_data, changed=None, profiler: StageProfiler = None):
+        # changed optionally names (Pillar, Sub-Pillar, Indicator) keys to treat as changed on top of the
+        # ones detected from the content hashes
+        profiler = profiler or StageProfiler(enabled=False)
+        run = profiler.run
+        tables = self.engine.refresh()
+        if self.reference_digest() != self.reference_hash:
+            # a reference file changed since the state was saved, every score may move
+            self.reference_hash = self.reference_digest()
+            self.state = None
+        if self.state is None or not os.path.exists(self.full_data_file) or not os.path.exists(self.roll_file):
+            return self.build(indicator_data, profiler)
+
+        new_df = run("prepare", self.engine.prepare, indicator_data, tables)
+        new_hashes = indicator_hashes(new_df)
+        changed_keys = self.changed_indicators(new_hashes, changed)
+        if not changed_keys:
+            return self.state["result"], {"mode": "unchanged", "indicators": 0}
+
+        old = self.state["result"]
+        old_df = old.full_df
+        key_strings = new_df[INDICATOR_KEYS].astype(str)
+        changed_rows = pd.MultiIndex.from_frame(key_strings).isin(list(changed_keys))
+        sub_pillars = {(p, sp) for p, sp, _ in changed_keys}
+        pillars = {p for p, _ in sub_pillars}
+        in_sub_pillars = pd.MultiIndex.from_frame(key_strings[["Pillar", "Sub-Pillar"]]).isin(list(sub_pillars))
+        in_pillars = key_strings["Pillar"].isin(pillars).to_numpy()
+
+        positions = run("match_rows", row_positions, old_df, new_df, FULL_DATA_KEYS)
+        reuse = ~in_pillars & (positions >= 0)
+
+        # indicators: only the changed ones are rescaled, scaling never looks across indicators
+        affected = new_df[in_pillars].copy()
+        reused_scores = old_df["indicator_score"].to_numpy()[np.where(positions >= 0, positions, 0)]
+        affected["indicator_score"] = reused_scores[in_pillars]
+        rescaled = run("process_df", process_df, new_df[changed_rows].copy(), self.engine.min_val,
+                       self.engine.max_val, tables.sources.range_lookup)
+        rescaled = handle_higher_not_better(rescaled)
+        affected.loc[rescaled.index, "indicator_score"] = rescaled["indicator_score"]
+
+        # sub-pillars fed by a changed indicator are recomputed, the other sub-pillars of the pillar are copied
+        sub_rows = in_sub_pillars[in_pillars]
+        total_indicator_map = dict(old.total_indicator_map)
+        copied = old_df.iloc[positions[in_pillars][~sub_rows]]
+        for column in ["country_sub_pillar_score", "data_availability"]:
+            affected.loc[affected.index[~sub_rows], column] = copied[column].to_numpy()
+        if sub_rows.any():
+            sub_df = affected[sub_rows].copy()
+            sub_totals = prep_total_indicator_map(sub_df)
+            total_indicator_map.update(sub_totals)
+            sub_df = run("add_country_sub_pillar_score", add_country_sub_pillar_score, sub_df,
+                         tables.weights.weights, sub_totals)
+            affected.loc[sub_df.index, ["country_sub_pillar_score", "data_availability"]] = \
+                sub_df[["country_sub_pillar_score", "data_availability"]]
+
+        total_sub_pillar_map = dict(old.total_sub_pillar_map)
+        pillar_totals = prep_total_sub_pillar_map(affected)
+        total_sub_pillar_map.update(pillar_totals)
+        affected = run("add_country_pillar_score", add_country_pillar_score, affected, tables.weights.weights,
+                       pillar_totals)
+
+        # assemble the full frame in input order, unaffected rows straight from the previous run
+        affected = affected.drop("new_rank_score", axis=1)
+        affected = run("add_sources", add_sources, affected, tables.sources.source_data_df,
+                       tables.sources.source_lookup if tables.sources.unique_sources else None)
+        affected = affected.reindex(columns=old_df.columns)
+        for column in ["country_sub_pillar_rank", "country_pillar_rank"]:
+            affected[column] = pd.array([pd.NA] * len(affected.index), dtype="Int64")
+        full_df = pd.concat([old_df.iloc[positions[~in_pillars]].set_axis(np.flatnonzero(~in_pillars)),
+                             affected.set_axis(np.flatnonzero(in_pillars))]).sort_index()
+        # integer ids are assigned per run, every row takes this run's ids
+        for column in KEY_COLUMNS:
+            full_df[column] = new_df[column].to_numpy()
+
+        pillar_count = prep_pillar_count(full_df)
+        cube = None
+        if pillar_count == old.pillar_count:
+            cube = run("refresh_score_cube", old.cube.refreshed, full_df, sub_pillars, pillars)
+        if cube is None or positions[~in_pillars].min(initial=0) < 0:
+            # new countries, membership or hierarchy: nothing to patch against
+            return self.build(new_df, profiler)
+
+        rows = np.flatnonzero(in_pillars)
+        full_df.iloc[rows, full_df.columns.get_loc("country_sub_pillar_rank")] = \
+            cube.sub_pillar_rank_column()[rows]
+        full_df.iloc[rows, full_df.columns.get_loc("country_pillar_rank")] = cube.pillar_rank_column()[rows]
+        roll_df = run("build_roll_df", build_roll_df, full_df, cube)
+        result = ScoringResult(full_df, roll_df, cube, total_indicator_map, total_sub_pillar_map, pillar_count)
+
+        full_data = result.full_data
+        reuse |= run("compare_full_rows", unchanged_rows, old.full_data, full_data, positions, in_pillars)
+        run("patch_full_csv", splice_csv, self.full_data_file, full_data, positions, reuse, self.full_data_file)
+
+        # country rows always move with any pillar; pillar, sub-pillar and indicator rows only in affected pillars
+        roll_positions = run("match_roll_rows", row_positions, old.roll_df, roll_df, ROLL_KEYS)
+        roll_reuse = (roll_positions >= 0) & (roll_df["Pillar"] != "").to_numpy() & \
+            ~roll_df["Pillar"].isin(pillars).to_numpy()
+        roll_reuse |= run("compare_roll_rows", unchanged_rows, old.roll_df, roll_df, roll_positions, ~roll_reuse)
+        run("patch_roll_csv", splice_csv, self.roll_file, roll_df, roll_positions, roll_reuse, self.roll_file)
+
+        self.save_state(result, new_hashes)
+        return result, {"mode": "incremental", "indicators": len(changed_keys), "sub_pillars": len(sub_pillars),
+                        "pillars": len(pillars), "full_rows_rewritten": int((~reuse).sum()),
+                        "roll_rows_rewritten": int((~roll_reuse).sum())}
+
+    def verify(self, indicator_data):
+        # compare the stored (patched) outputs with a full rebuild written to a temporary directory
+        result = self.engine.score(indicator_data)
+        problems = []
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name, frame, stored in [("full_data.csv", result.full_data, self.full_data_file),
+                                        ("full_output_rolling.csv", result.roll_df, self.roll_file)]:
+                rebuilt = os.path.join(tmp_dir, name)
+                frame.to_csv(rebuilt, index=False)
+                with open(rebuilt, "rb") as f_rebuilt, open(stored, "rb") as f_stored:
+                    rebuilt_lines = f_rebuilt.read().splitlines()
+                    stored_lines = f_stored.read().splitlines()
+                if rebuilt_lines != stored_lines:
+                    differing = sum(a != b for a, b in zip(rebuilt_lines, stored_lines)) + \
+                        abs(len(rebuilt_lines) - len(stored_lines))
+                    problems.append("{}: {} lines differ from a full rebuild".format(name, differing))
+        return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rescore only what changed since the last run")
+    parser.add_argument("--indicator", action="append", nargs=3, metavar=("PILLAR", "SUB_PILLAR", "INDICATOR"),
+                        help="treat this indicator as changed (changes are also detected from content hashes)")
+    parser.add_argument("--full", action="store_true", help="rebuild everything and reset the stored state")
+    parser.add_argument("--verify", action="store_true", help="compare the patched outputs with a full rebuild")
+    parser.add_argument("--state-dir", default="Processed/Incremental")
+    parser.add_argument("--profile", nargs="?", const="Processed/Incremental/profile_incremental.json",
+                        default=None)
+    args = parser.parse_args()
+
+    stage_profiler = StageProfiler(enabled=args.profile is not None)
+    scorer = IncrementalScorer(ScoringEngine("Weights.csv", "Sources.csv"), args.state_dir)
+    aggr_file = "Processed/Full Data/output.csv"
+    if args.full:
+        _, summary = scorer.build(aggr_file, stage_profiler)
+    else:
+        _, summary = scorer.update(aggr_file, args.indicator, stage_profiler)
+    print(summary)
+
+    exit_code = 0
+    if args.verify:
+        issues = scorer.verify(aggr_file)
+        print("\n".join(issues) if issues else "patched outputs match a full rebuild")
+        exit_code = 1 if issues else 0
+    finish_profile(stage_profiler, args.profile)
+    raise SystemExit(exit_code)
@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+
+KEY_COLUMNS = ["country_id", "pillar_id", "sub_pillar_id", "indicator_id"]
+# countries without an M49 code get ids from here up, above every M49 code
+UNCODED_COUNTRY_BASE = 1000
+
+
+def country_code_map(countries_df: pd.DataFrame):
+    # country name -> M49 code from a Countries.csv table, first row wins
+    name_column = "Country Name" if "Country Name" in countries_df.columns else "Country or Area"
+    codes = countries_df[[name_column, "M49 Code"]].dropna().drop_duplicates(name_column, keep="first")
+    return dict(zip(codes[name_column], codes["M49 Code"].astype(np.int64)))
+
+
+def country_ids(names, code_map=None):
+    # M49 code of every name, names without one are numbered from UNCODED_COUNTRY_BASE in order of appearance
+    codes, labels = pd.factorize(pd.Series(names))
+    code_map = code_map or {}
+    label_ids = np.array([code_map.get(label, -1) for label in labels], dtype=np.int64)
+    uncoded = label_ids < 0
+    label_ids[uncoded] = UNCODED_COUNTRY_BASE + np.arange(np.count_nonzero(uncoded))
+    return np.where(codes >= 0, label_ids[np.maximum(codes, 0)] if len(labels) > 0 else -1, -1)
+
+
+def add_key_columns(df: pd.DataFrame, code_map=None):
+    # integer ids for every hierarchy level; grouping, joining and ranking run on these and the label
+    # columns are only carried along for the exports. Every label column is hashed once, the nested
+    # levels are factorized from integer pairs.
+    pillar_codes = pd.factorize(df["Pillar"])[0]
+    sub_pillar_codes = pd.factorize(combined_key(pillar_codes, pd.factorize(df["Sub-Pillar"])[0]))[0]
+    indicator_codes = pd.factorize(combined_key(sub_pillar_codes, pd.factorize(df["Indicator"])[0]))[0]
+
+    df["country_id"] = country_ids(df["Country Name"], code_map).astype(np.int32)
+    df["pillar_id"] = pillar_codes.astype(np.int32)
+    df["sub_pillar_id"] = sub_pillar_codes.astype(np.int32)
+    df["indicator_id"] = indicator_codes.astype(np.int32)
+    return df
+
+
+def drop_key_columns(df: pd.DataFrame):
+    return df.drop(columns=[column for column in KEY_COLUMNS if column in df.columns])
+
+
+def combined_key(major, minor):
+    # one int64 key for a pair of non-negative id columns
+    major = np.asarray(major, dtype=np.int64)
+    minor = np.asarray(minor, dtype=np.int64)
+    return major * (int(minor.max()) + 1 if len(minor) > 0 else 1) + minor
+
+
+def first_rows(keys):
+    # row positions of the first occurrence of every key, in row order
+    _, first = np.unique(np.asarray(keys), return_index=True)
+    return np.sort(first)
+
+
+def lookup(keys, table_keys, table_values, fill=np.nan):
+    # value of table_values for every key, matched on table_keys (non-negative ints); fill where missing
+    keys = np.asarray(keys, dtype=np.int64)
+    table_keys = np.asarray(table_keys, dtype=np.int64)
+    size = int(max(keys.max(initial=0), table_keys.max(initial=0))) + 1
+    values = np.asarray(table_values)
+    table = np.full(size, fill, dtype=values.dtype if values.dtype == object else np.float64)
+    table[table_keys] = values
+    return table[keys]
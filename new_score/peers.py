@@ -0,0 +1,221 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from score_cube import factorize_level, first_value_matrix
+
+# id column, label columns and score column of full_data.csv behind every profile level
+LEVELS = {
+    "pillar": ("pillar_id", ["Pillar"], "country_pillar_score"),
+    "sub_pillar": ("sub_pillar_id", ["Pillar", "Sub-Pillar"], "country_sub_pillar_score"),
+}
+METRICS = ["euclidean", "manhattan", "correlation"]
+DEFAULT_K = 10
+# distance cells (countries x countries x labels) computed at once when all peers are computed
+BLOCK_CELLS = 1 << 22
+
+
+def profile_matrix(full_df: pd.DataFrame, level="pillar"):
+    # (countries, labels, countries x labels scores with NaN for missing) from full_data / ScoringResult.full_df
+    id_column, label_columns, score_column = LEVELS[level]
+    country_ids, countries = factorize_level(full_df, "country_id", ["Country Name"])
+    label_ids, labels = factorize_level(full_df, id_column, label_columns)
+    scores = first_value_matrix((len(countries), len(labels)), country_ids, label_ids, full_df[score_column])
+    if len(label_columns) > 1:
+        # sub-pillars by name, prefixed with their pillar only where a name is used by several pillars
+        names = labels.get_level_values(-1)
+        repeated = names.duplicated(keep=False)
+        labels = [" / ".join(label) if twice else label[-1] for label, twice in zip(labels, repeated)]
+    return list(countries), list(labels), scores
+
+
+def profile_distances(values, available, query_values, query_available, metric):
+    # (distances, shared) of every query row against every profile row, computed over the labels both
+    # have a score for: mean squared difference (root taken) for euclidean, mean absolute difference for
+    # manhattan, 1 - Pearson correlation for correlation. Pairs without shared labels get inf.
+    shared = query_available @ available.T
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if metric == "manhattan":
+            diff = np.abs(query_values[:, None, :] - values[None, :, :])
+            total = np.einsum("qnd,qd,nd->qn", diff, query_available, available)
+            distances = total / shared
+        else:
+            squares = values * values
+            query_squares = query_values * query_values
+            sum_q = query_values @ available.T
+            sum_v = query_available @ values.T
+            sum_qq = query_squares @ available.T
+            sum_vv = query_available @ squares.T
+            sum_qv = query_values @ values.T
+            if metric == "euclidean":
+                distances = np.sqrt(np.maximum(sum_qq - 2 * sum_qv + sum_vv, 0) / shared)
+            elif metric == "correlation":
+                covariance = sum_qv - sum_q * sum_v / shared
+                variance = (sum_qq - sum_q * sum_q / shared) * (sum_vv - sum_v * sum_v / shared)
+                distances = 1 - covariance / np.sqrt(variance)
+                # flat profiles have no correlation
+                distances[~(variance > 1e-12)] = np.nan
+            else:
+                raise ValueError("Unknown metric {}, metrics are: {}".format(metric, METRICS))
+    distances[np.isnan(distances)] = np.inf
+    return distances, shared
+
+
+def top_k(distances, k):
+    # positions of the k smallest finite distances, ties in profile order; exact, no approximation
+    finite = np.flatnonzero(np.isfinite(distances))
+    if len(finite) > k:
+        kth = np.partition(distances[finite], k - 1)[k - 1]
+        finite = finite[distances[finite] <= kth]
+    return finite[np.lexsort((finite, distances[finite]))][:k]
+
+
+class PeerIndex:
+    # Country profiles of one level (pillar or sub-pillar scores) with the k nearest peers of every country
+    # under every metric. Missing scores are left out of a comparison rather than filled in: two countries
+    # are compared on the labels both have, and only when they share at least min_shared of them. Peers are
+    # found exactly with vectorised distances; profiles are a few hundred rows of a few dozen columns, where
+    # a KD or ball tree would not beat a scan (and neither handles missing coordinates).
+
+    def __init__(self, countries, labels, scores, level="pillar", k=DEFAULT_K, metrics=METRICS, min_shared=None):
+        self.countries = list(countries)
+        self.labels = list(labels)
+        self.level = level
+        self.k = k
+        self.metrics = list(metrics)
+        self.min_shared = min_shared or max(1, (len(self.labels) + 1) // 2)
+        self.position = {country: i for i, country in enumerate(self.countries)}
+        self.label_position = {label: i for i, label in enumerate(self.labels)}
+
+        self.scores = np.asarray(scores, dtype=np.float64)
+        self.available = (~np.isnan(self.scores)).astype(np.float64)
+        self.values = np.nan_to_num(self.scores)
+
+        self.peer_ids = {}
+        self.peer_distances = {}
+        for metric in self.metrics:
+            self.peer_ids[metric], self.peer_distances[metric] = self.all_peers(metric)
+
+    @classmethod
+    def from_full_data(cls, full_data, level="pillar", **kwargs):
+        # full_data is full_data.csv, or a frame in its layout
+        full_df = full_data if isinstance(full_data, pd.DataFrame) else pd.read_csv(full_data,
+                                                                                   float_precision="round_trip")
+        countries, labels, scores = profile_matrix(full_df, level)
+        return cls(countries, labels, scores, level, **kwargs)
+
+    def distances(self, query_values, query_available, metric):
+        distances, shared = profile_distances(self.values, self.available, query_values, query_available, metric)
+        distances[shared < self.min_shared] = np.inf
+        return distances
+
+    def all_peers(self, metric):
+        # (n x k positions with -1 padding, n x k distances with inf padding), a country is not its own peer
+        n = len(self.countries)
+        peer_ids = np.full((n, self.k), -1, dtype=np.int64)
+        peer_distances = np.full((n, self.k), np.inf)
+        block_rows = max(1, BLOCK_CELLS // max(1, n * len(self.labels)))
+        for start in range(0, n, block_rows):
+            stop = min(start + block_rows, n)
+            block = self.distances(self.values[start:stop], self.available[start:stop], metric)
+            block[np.arange(stop - start), np.arange(start, stop)] = np.inf
+            for row, row_distances in enumerate(block):
+                peers = top_k(row_distances, self.k)
+                peer_ids[start + row, :len(peers)] = peers
+                peer_distances[start + row, :len(peers)] = row_distances[peers]
+        return peer_ids, peer_distances
+
+    def profile_vector(self, profile):
+        # profile is {label: score} (labels not given count as missing) or scores in self.labels order
+        if isinstance(profile, dict):
+            unknown = [label for label in profile if label not in self.label_position]
+            if unknown:
+                raise ValueError("Unknown {} labels: {}".format(self.level, unknown))
+            vector = np.full(len(self.labels), np.nan)
+            for label, score in profile.items():
+                vector[self.label_position[label]] = np.nan if score is None else score
+        else:
+            vector = np.asarray(profile, dtype=np.float64)
+            if vector.shape != (len(self.labels),):
+                raise ValueError("Expected {} scores, got {}".format(len(self.labels), vector.shape))
+        return vector
+
+    def profile(self, country):
+        return {label: None if np.isnan(score) else float(score)
+                for label, score in zip(self.labels, self.scores[self.position[country]])}
+
+    def query(self, profile, k=None, metric="euclidean", exclude=()):
+        # nearest countries to any profile, computed on the fly
+        vector = self.profile_vector(profile)
+        available = ~np.isnan(vector)
+        distances = self.distances(np.nan_to_num(vector)[None, :], available[None, :].astype(np.float64),
+                                   metric)[0]
+        for country in exclude:
+            distances[self.position[country]] = np.inf
+        return [{"Country Name": self.countries[i], "distance": float(distances[i])}
+                for i in top_k(distances, k or self.k)]
+
+    def peers(self, country, k=None, metric="euclidean"):
+        # precomputed peers of a country of the index
+        if metric not in self.peer_ids:
+            raise ValueError("Metric {} was not precomputed, metrics are: {}".format(metric, self.metrics))
+        if k is not None and k > self.k:
+            return self.query(self.scores[self.position[country]], k, metric, exclude=[country])
+        row = self.position[country]
+        return [{"Country Name": self.countries[i], "distance": float(distance)}
+                for i, distance in zip(self.peer_ids[metric][row], self.peer_distances[metric][row])
+                if i >= 0][:k]
+
+    def peer_table(self):
+        # one row per (country, metric, peer) with the labels both countries have
+        frames = []
+        for metric in self.metrics:
+            rows, ranks = np.nonzero(self.peer_ids[metric] >= 0)
+            peers = self.peer_ids[metric][rows, ranks]
+            frames.append(pd.DataFrame({
+                "Country Name": np.array(self.countries, dtype=object)[rows],
+                "level": self.level,
+                "metric": metric,
+                "peer_rank": ranks + 1,
+                "Peer": np.array(self.countries, dtype=object)[peers],
+                "distance": self.peer_distances[metric][rows, ranks],
+                "shared": np.einsum("ij,ij->i", self.available[rows], self.available[peers]).astype(np.int64),
+            }))
+        return pd.concat(frames, ignore_index=True)
+
+
+def save_peers(full_data_file="Processed/Full Data/full_data.csv", output_dir="Processed/Peers",
+               levels=("pillar",), k=DEFAULT_K, metrics=METRICS):
+    # peers are built from the saved CSV, like the shards, so they match the published scores exactly
+    full_df = full_data_file if isinstance(full_data_file, pd.DataFrame) else \
+        pd.read_csv(full_data_file, float_precision="round_trip")
+    indexes = {level: PeerIndex.from_full_data(full_df, level, k=k, metrics=metrics) for level in levels}
+    os.makedirs(output_dir, exist_ok=True)
+    table = pd.concat([index.peer_table() for index in indexes.values()], ignore_index=True)
+    table.to_csv(os.path.join(output_dir, "peers.csv"), index=False)
+    for level, index in indexes.items():
+        pd.DataFrame(index.scores, index=pd.Index(index.countries, name="Country Name"), columns=index.labels) \
+            .to_csv(os.path.join(output_dir, "profiles_{}.csv".format(level)))
+    return indexes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Nearest peers of every country by pillar-score profile")
+    parser.add_argument("--full-data", default="Processed/Full Data/full_data.csv")
+    parser.add_argument("--output-dir", default="Processed/Peers")
+    parser.add_argument("--sub-pillars", action="store_true", help="also compare sub-pillar profiles")
+    parser.add_argument("--k", type=int, default=DEFAULT_K, help="peers kept per country and metric")
+    parser.add_argument("--metrics", nargs="+", default=METRICS, choices=METRICS)
+    parser.add_argument("--country", help="print this country's peers")
+    args = parser.parse_args()
+
+    peer_indexes = save_peers(args.full_data, args.output_dir, ["pillar", "sub_pillar"] if args.sub_pillars
+                              else ["pillar"], args.k, args.metrics)
+    if args.country:
+        for peer_level, peer_index in peer_indexes.items():
+            for peer_metric in peer_index.metrics:
+                print(peer_level, peer_metric)
+                for peer in peer_index.peers(args.country, metric=peer_metric):
+                    print("  {Country Name:<40} {distance:.4f}".format(**peer))
@@ -0,0 +1,363 @@
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import pandas as pd
+
+from aggregation_cache import file_hash
+from columnar import write_columns
+from country_names import ALIASES_FILE
+from delta import publish_deltas
+from incremental import frame_hash
+from peers import save_peers
+from process_aggr import ScoringEngine, ScoringResult
+from profiling import StageProfiler, finish_profile
+from reference import COUNTRIES_FILE, SOURCES_FILE, WEIGHTS_FILE, default_registry
+from shards import save_shards
+from tracks import TRACKS_FILE, TrackRunner
+
+# bumped whenever a stage changes in a way its module hashes do not show
+PIPELINE_VERSION = 1
+CACHE_DIR = "Processed/Pipeline"
+MANIFEST_NAME = "manifest.json"
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def bytes_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def output_digest(output):
+    # content digest of a stage output; downstream keys use it, so a stage that reruns and produces the
+    # same output leaves everything after it cached
+    if isinstance(output, pd.DataFrame):
+        return frame_hash(output)
+    if isinstance(output, ScoringResult):
+        return frame_hash(output.full_df)
+    if isinstance(output, dict):
+        return bytes_digest(json.dumps(output, sort_keys=True, default=str).encode("utf-8"))
+    return bytes_digest(pickle.dumps(output))
+
+
+class Stage:
+    # func(*dependency outputs) -> output. A dependency "stage:part" uses only that part's digest
+    # for the key. Export stages write files and output {path: sha256}; they are cached as long as the
+    # files are still there unchanged.
+
+    def __init__(self, name, func, deps=(), files=None, code=(), params=None, parts=None, export=False):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.files = files or (lambda: [])
+        self.code = list(code)
+        self.params = params or {}
+        self.parts = parts or {}
+        self.export = export
+
+    @property
+    def upstream(self):
+        return [dep.split(":")[0] for dep in self.deps]
+
+    def digests(self, output):
+        digests = {"": output_digest(output)}
+        digests.update({part: digest(output) for part, digest in self.parts.items()})
+        return digests
+
+
+def written_files(paths):
+    return {path: file_hash(path) for path in paths if os.path.isfile(path)}
+
+
+def tables_digest(tables, parts):
+    values = {
+        "weights": lambda: frame_hash(tables.weights.weights),
+        "ranges": lambda: frame_hash(tables.sources.range_info_df),
+        "links": lambda: frame_hash(tables.sources.source_data_df),
+        "countries": lambda: "" if tables.countries is None else frame_hash(tables.countries.countries_df),
+    }
+    return "".join(values[part]() for part in parts)
+
+
+def build_stages(options):
+    countries_file = options["countries"]
+    runner = TrackRunner.from_file(options["tracks_config"], [options["track"]], workers=options["workers"],
+                                   countries_file=countries_file or COUNTRIES_FILE)
+    track = runner.tracks[options["track"]]
+    roll_file = os.path.join(options["output_dir"], "full_output_rolling.csv")
+    full_file = os.path.join(options["output_dir"], "full_data.csv")
+    output_file = os.path.join(options["output_dir"], "output.csv")
+    scoring = {"min_val": options["min_val"], "max_val": options["max_val"]}
+
+    def track_files():
+        to_load, _, _ = track.select(runner.listing.files(track.directory))
+        return [os.path.join(track.directory, file_name) for file_name, _ in to_load] + \
+            [options["tracks_config"], ALIASES_FILE] + ([countries_file] if countries_file else [])
+
+    def aggregate():
+        with ThreadPoolExecutor(max_workers=runner.workers) as file_pool:
+            df, _, skipped, _ = runner.build_track(track, file_pool)
+        for item in skipped:
+            print(item["file"], ":", item["reason"], item["detail"])
+        return df.reset_index(drop=True)
+
+    def export_aggregate(aggr_df):
+        os.makedirs(options["output_dir"], exist_ok=True)
+        aggr_df.to_csv(output_file, index=False)
+        paths = [output_file]
+        if options["columnar"]:
+            write_columns(aggr_df, os.path.join(options["output_dir"], "output_columns"))
+            paths.append(os.path.join(options["output_dir"], "output_columns", "schema.json"))
+        return written_files(paths)
+
+    def reference():
+        return default_registry().load(options["weights"], options["sources"], countries_file)
+
+    def engine():
+        return ScoringEngine(options["weights"], options["sources"], countries_file, options["min_val"],
+                             options["max_val"])
+
+    def levels(aggr_df, tables):
+        return engine().score_levels(aggr_df, tables=tables)
+
+    def sources(levels_result, tables):
+        return engine().attach_sources(levels_result, tables=tables)
+
+    def export_full(result):
+        os.makedirs(options["output_dir"], exist_ok=True)
+        result.full_data.to_csv(full_file, index=False)
+        paths = [full_file]
+        if options["columnar"]:
+            write_columns(result.full_data, os.path.join(options["output_dir"], "full_data_columns"))
+            paths.append(os.path.join(options["output_dir"], "full_data_columns", "schema.json"))
+        return written_files(paths)
+
+    def export_roll(result):
+        os.makedirs(options["output_dir"], exist_ok=True)
+        result.save_roll(roll_file)
+        return written_files([roll_file])
+
+    def export_shards(roll_files):
+        save_shards(roll_file, options["shards"])
+        return written_files([os.path.join(options["shards"], "manifest.json")])
+
+    def export_peers(full_files):
+        save_peers(full_file, options["peers"])
+        return written_files([os.path.join(options["peers"], name) for name in sorted(os.listdir(options["peers"]))])
+
+    def export_delta(full_files, roll_files):
+        publish_deltas(options["output_dir"], options["delta"])
+        return written_files([os.path.join(options["delta"], name) for name in sorted(os.listdir(options["delta"]))])
+
+    scoring_code = ["process_aggr.py", "scaling.py", "score_cube.py", "integer_keys.py", "reference.py"]
+    # the CSV writers of full_data and the roll file live in process_aggr.py and read the score cube
+    export_code = ["process_aggr.py", "score_cube.py", "integer_keys.py"]
+    stages = [
+        Stage("aggregate", aggregate, files=track_files,
+              code=["aggregator.py", "tracks.py", "country_names.py", "integer_keys.py", "reference.py"],
+              params={"track": options["track"]}),
+        Stage("export_aggregate", export_aggregate, ["aggregate"], code=["columnar.py"],
+              params={"file": output_file, "columnar": options["columnar"]}, export=True),
+        Stage("reference", reference,
+              files=lambda: [options["weights"], options["sources"]] + ([countries_file] if countries_file else []),
+              code=["reference.py", "scaling.py"],
+              parts={"scoring": lambda tables: tables_digest(tables, ["weights", "ranges", "countries"]),
+                     "links": lambda tables: tables_digest(tables, ["links"])}),
+        Stage("levels", levels, ["aggregate", "reference:scoring"], code=scoring_code, params=scoring),
+        Stage("sources", sources, ["levels", "reference:links"], code=scoring_code),
+        Stage("export_full", export_full, ["sources"], code=export_code + ["columnar.py"],
+              params={"file": full_file, "columnar": options["columnar"]}, export=True),
+        Stage("export_roll", export_roll, ["sources"], code=export_code, params={"file": roll_file}, export=True),
+    ]
+    if options["shards"]:
+        stages.append(Stage("export_shards", export_shards, ["export_roll"], code=["shards.py", "query_service.py"],
+                            params={"dir": options["shards"]}, export=True))
+    if options["peers"]:
+        stages.append(Stage("export_peers", export_peers, ["export_full"], code=["peers.py", "score_cube.py"],
+                            params={"dir": options["peers"]}, export=True))
+    if options["delta"]:
+        stages.append(Stage("export_delta", export_delta, ["export_full", "export_roll"], code=["delta.py"],
+                            params={"dir": options["delta"]}, export=True))
+    return stages
+
+
+class Pipeline:
+    # Runs a DAG of stages in one process. Outputs are passed in memory; every non-export output is also
+    # pickled to cache_dir under a key made of the stage's code, parameters, external input files and the
+    # content digests of its dependencies. A stage whose key matches the last run is not run, and its
+    # output is only loaded from the cache when a stage after it has to run. Stages whose dependencies are
+    # resolved run concurrently.
+
+    def __init__(self, stages, cache_dir=CACHE_DIR):
+        self.stages = {stage.name: stage for stage in stages}
+        for stage in stages:
+            unknown = [name for name in stage.upstream if name not in self.stages]
+            if unknown:
+                raise ValueError("Stage {} depends on unknown stages: {}".format(stage.name, unknown))
+        self.cache_dir = cache_dir
+        self.manifest_path = os.path.join(cache_dir, MANIFEST_NAME)
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, encoding="utf-8") as f:
+                self.manifest = json.load(f)
+        self.lock = threading.Lock()
+        self.outputs = {}
+        self.digests = {}
+        self.code_hashes = {}
+
+    def ancestors(self, name):
+        found = set()
+        pending = list(self.stages[name].upstream)
+        while pending:
+            upstream = pending.pop()
+            if upstream not in found:
+                found.add(upstream)
+                pending.extend(self.stages[upstream].upstream)
+        return found
+
+    def descendants(self, name):
+        return {other for other in self.stages if name in self.ancestors(other)}
+
+    def code_hash(self, module):
+        with self.lock:
+            if module not in self.code_hashes:
+                self.code_hashes[module] = file_hash(os.path.join(CODE_DIR, module))
+            return self.code_hashes[module]
+
+    def stage_key(self, stage: Stage):
+        files = {os.path.abspath(path): file_hash(path) for path in stage.files()}
+        dep_digests = [self.digests[dep.split(":")[0]][dep.split(":")[1] if ":" in dep else ""]
+                       for dep in stage.deps]
+        key = [PIPELINE_VERSION, stage.name, {m: self.code_hash(m) for m in stage.code}, stage.params,
+               sorted(files.items()), dep_digests]
+        return bytes_digest(json.dumps(key, sort_keys=True, default=str).encode("utf-8"))
+
+    def cache_file(self, name):
+        return os.path.join(self.cache_dir, name + ".pkl")
+
+    def is_cached(self, stage: Stage, key):
+        entry = self.manifest.get(stage.name)
+        if entry is None or entry["key"] != key:
+            return False
+        if stage.export:
+            return all(os.path.isfile(path) and file_hash(path) == digest for path, digest in entry["output"].items())
+        return os.path.exists(self.cache_file(stage.name))
+
+    def output(self, name):
+        with self.lock:
+            if name not in self.outputs:
+                stage = self.stages[name]
+                if stage.export:
+                    self.outputs[name] = self.manifest[name]["output"]
+                else:
+                    with open(self.cache_file(name), "rb") as f:
+                        self.outputs[name] = pickle.load(f)
+            return self.outputs[name]
+
+    def resolve(self, stage: Stage, force, profiler: StageProfiler):
+        start = time.perf_counter()
+        key = self.stage_key(stage)
+        if not force and self.is_cached(stage, key):
+            with self.lock:
+                self.digests[stage.name] = self.manifest[stage.name]["digests"]
+            return {"stage": stage.name, "status": "cached", "wall_s": time.perf_counter() - start}
+
+        inputs = [self.output(name) for name in stage.upstream]
+        output = profiler.run(stage.name, stage.func, *inputs)
+        digests = stage.digests(output)
+        entry = {"key": key, "digests": digests, "finished": time.time()}
+        if stage.export:
+            entry["output"] = output
+        else:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self.cache_file(stage.name) + ".tmp", "wb") as f:
+                pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(self.cache_file(stage.name) + ".tmp", self.cache_file(stage.name))
+        with self.lock:
+            self.outputs[stage.name] = output
+            self.digests[stage.name] = digests
+            self.manifest[stage.name] = entry
+        return {"stage": stage.name, "status": "ran", "wall_s": time.perf_counter() - start}
+
+    def save_manifest(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self.manifest_path, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+
+    def run(self, start=None, stop=None, force=False, profiler: StageProfiler = None):
+        # start: rerun this stage and everything after it; stop: only run up to this stage
+        profiler = profiler or StageProfiler(enabled=False)
+        for name in (start, stop):
+            if name is not None and name not in self.stages:
+                raise ValueError("Unknown stage {}, stages are: {}".format(name, list(self.stages)))
+        selected = set(self.stages) if stop is None else self.ancestors(stop) | {stop}
+        forced = set(self.stages) if force else set() if start is None else self.descendants(start) | {start}
+
+        reports = {}
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, len(selected))) as executor:
+                pending = {name: self.stages[name] for name in self.stages if name in selected}
+                running = {}
+                while pending or running:
+                    for name in [n for n, s in pending.items() if all(u in reports for u in s.upstream)]:
+                        running[name] = executor.submit(self.resolve, pending.pop(name), name in forced, profiler)
+                    done, _ = wait(running.values(), return_when=FIRST_COMPLETED)
+                    for name in [n for n, future in running.items() if future in done]:
+                        reports[name] = running.pop(name).result()
+        finally:
+            self.save_manifest()
+        return [reports[name] for name in self.stages if name in reports]
+
+    def status(self):
+        # last recorded run of every stage
+        return [{"stage": name, "deps": stage.deps, "export": stage.export,
+                 "last_run": self.manifest.get(name, {}).get("finished")} for name, stage in self.stages.items()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Aggregate, score and export in one cached run")
+    parser.add_argument("--from", dest="start", default=None, help="rerun this stage and every stage after it")
+    parser.add_argument("--to", dest="stop", default=None, help="stop after this stage")
+    parser.add_argument("--force", action="store_true", help="rerun every stage")
+    parser.add_argument("--list", action="store_true", help="print the stages and their last run")
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--output-dir", default="Processed/Full Data")
+    parser.add_argument("--tracks-config", default=TRACKS_FILE)
+    parser.add_argument("--track", default="pillars", help="track of --tracks-config that is aggregated")
+    parser.add_argument("--workers", type=int, default=None, help="threads reading the indicator files")
+    parser.add_argument("--columnar", action="store_true", help="also write output and full_data as column stores")
+    parser.add_argument("--shards", nargs="?", const="Processed/Shards", default=None)
+    parser.add_argument("--peers", nargs="?", const="Processed/Peers", default=None)
+    parser.add_argument("--delta", nargs="?", const="Processed/Delta", default=None)
+    parser.add_argument("--profile", nargs="?", const="Processed/Pipeline/profile_pipeline.json", default=None)
+    args = parser.parse_args()
+
+    pipeline = Pipeline(build_stages({
+        "tracks_config": args.tracks_config,
+        "track": args.track,
+        "workers": args.workers,
+        "weights": WEIGHTS_FILE,
+        "sources": SOURCES_FILE,
+        "countries": COUNTRIES_FILE if os.path.exists(COUNTRIES_FILE) else None,
+        "min_val": 1,
+        "max_val": 5.99,
+        "output_dir": args.output_dir,
+        "columnar": args.columnar,
+        "shards": args.shards,
+        "peers": args.peers,
+        "delta": args.delta,
+    }), args.cache_dir)
+
+    if args.list:
+        for stage_status in pipeline.status():
+            print("{stage:<18} after {deps}".format(**stage_status),
+                  "" if stage_status["last_run"] is None else time.ctime(stage_status["last_run"]))
+    else:
+        stage_profiler = StageProfiler(enabled=args.profile is not None, trace_memory=False)
+        for stage_report in pipeline.run(args.start, args.stop, args.force, stage_profiler):
+            print("{stage:<18} {status:<7} {wall_s:8.3f} s".format(**stage_report))
+        finish_profile(stage_profiler, args.profile)
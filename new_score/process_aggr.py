@@ -1,195 +1,55 @@
+import argparse
+import os
+
 import pandas as pd
 import numpy as np
-from sklearn.preprocessing import MinMaxScaler
-
-total_indicator_map = {}
-total_sub_pillar_map = {}
-pillar_count = 0
-weights = pd.DataFrame()
-
-
-def load_weights():
-    global weights
-    weights = pd.read_csv("Weights.csv")
-    weights["Indicator"] = weights["Indicator"].astype(str)
-
-def get_weight(pillar, sub_pillar, indicator):
-    global weights
-    #print(pillar, sub_pillar, indicator)
-    val = weights.loc[(weights["Pillar"] == pillar) & (weights["Sub-Pillar"] == sub_pillar) & (weights[
-        "Indicator"] == indicator), "Weight"].values[0]
-    return val
-
-
-def get_range_info_df():
-    sources_df = pd.read_csv("Sources.csv")
-    sources_df = sources_df[["Pillar", "Sub-Pillar", "Indicator", "Raw/Index", "min", "max"]] \
-        .dropna(subset=["Pillar", "Sub-Pillar", "Indicator"])
-
-    sources_df["Pillar"] = sources_df["Pillar"].astype(str)
-    sources_df["Sub-Pillar"] = sources_df["Sub-Pillar"].astype(str)
-    sources_df["Indicator"] = sources_df["Indicator"].astype(str)
-
-    return sources_df
-
-
-def process_df(better_df, min_val, max_val):
-    sources_df = get_range_info_df()
-    # print(sources_df.columns)
-
-    #print(sources_df.loc[ (sources_df["Pillar"] == "Infrastructure") & (sources_df["Sub-Pillar"] == "Connectivity Technology") & (sources_df["Indicator"] == "Broadband Density")].head(1))
-
-    pillar_sub_group = better_df.groupby(["Pillar", "Sub-Pillar", "Indicator"])
-    # print(pillar_sub_group.groups.keys())
-    # print(pillar_sub_group["data_col"].count())
-    # print(pillar_sub_group["data_col"].sum())
-
-    # process each group
-    score_map = {}
-    for name, group in pillar_sub_group:
-        # print(name, len(group["data_col"]))
-        is_percentile = False
-        scaler = MinMaxScaler((min_val, max_val))
-        raw_data = group[["data_col"]]
-        idx = raw_data.index
-
-        source_info = sources_df.loc[(sources_df["Pillar"] == name[0]) & (sources_df["Sub-Pillar"] == name[1]) & (
-                sources_df["Indicator"] == name[2])]
-
-        if len(source_info.index) > 0:
-            source_info = source_info.head(1)
-            #print(source_info["Indicator"].values[0], source_info["Raw/Index"].values[0])
-            ind_type = source_info["Raw/Index"].values[0]
-
-            if ind_type == "Index":
-                #range_info = source_info["Data Range"].values[0].split("|")
-
-                if source_info["min"].values[0] != "" and source_info["max"].values[0] != "":
-                    range_min = source_info["min"].values[0]
-                    range_max = source_info["max"].values[0]
-                    #print("range min max", source_info["Indicator"].values[0], range_min, range_max)
-                    vals = raw_data.values
-                    vals = np.append(vals, [[int(range_min)], [int(range_max)]], axis=0)
-                    scaler.fit(vals)
-                else:
-                    ##########print("Index type has invalid range data.")
-                    # scaler.fit(raw_data.values)
-                    is_percentile = True
-            elif ind_type == "Raw":
-                # scaler.fit(raw_data.values)
-                #print("raw:", source_info["Indicator"].values[0])
-                is_percentile = True
-            else:
-                ####################print("Index type unknown for index:", source_info["Indicator"].values[0])
-                is_percentile = True
-        else:
-            # scaler.fit(raw_data.values)
-            is_percentile = True
-
-        # perform percentile calculations and scale data
-        if is_percentile:
-            # prepare 5 scalers
-            scaler1 = MinMaxScaler((1, 1.99))
-            scaler2 = MinMaxScaler((2, 2.99))
-            scaler3 = MinMaxScaler((3, 3.99))
-            scaler4 = MinMaxScaler((4, 4.99))
-            scaler5 = MinMaxScaler((5, 5.99))
-
-            # calculate percentile max values
-            val1 = group["data_col"].quantile(0.2)
-            val2 = group["data_col"].quantile(0.4)
-            val3 = group["data_col"].quantile(0.6)
-            val4 = group["data_col"].quantile(0.8)
-            val5 = group["data_col"].quantile(1.0)
-
-            # data of each quantile
-            raw_data1 = group.loc[group["data_col"] < val1, "data_col"]
-            raw_data2 = group.loc[(group["data_col"] >= val1) & (group["data_col"] < val2), "data_col"]
-            raw_data3 = group.loc[(group["data_col"] >= val2) & (group["data_col"] < val3), "data_col"]
-            raw_data4 = group.loc[(group["data_col"] >= val3) & (group["data_col"] < val4), "data_col"]
-            raw_data5 = group.loc[(group["data_col"] >= val4), "data_col"]
-
-            scaled_data1 = []
-            scaled_data2 = []
-            scaled_data3 = []
-            scaled_data4 = []
-            scaled_data5 = []
-
-            # fit scalers and set scaled values
-            if raw_data1.values.size != 0:
-                scaler1.fit(raw_data1.values.reshape(-1, 1))
-                scaled_data1 = scaler1.transform(raw_data1.values.reshape(-1, 1)).flatten()
-
-            if raw_data2.values.size != 0:
-                scaler2.fit(raw_data2.values.reshape(-1, 1))
-                scaled_data2 = scaler2.transform(raw_data2.values.reshape(-1, 1)).flatten()
-
-            if raw_data3.values.size != 0:
-                values = list(raw_data3.values.reshape(-1, 1))
-                values.sort()
-                mins = []
-                if len(values) > 0:
-                    mn = values[0]
-                    mx = values[-1]
-                    if mn == mx:
-                        mins.append(mx - 1)
-                scaler3.fit(values + mins)
-                scaled_data3 = scaler3.transform(raw_data3.values.reshape(-1, 1)).flatten()
-
-            if raw_data4.values.size != 0:
-                values = list(raw_data4.values.reshape(-1, 1))
-                values.sort()
-                mins = []
-                if len(values) > 0:
-                    mn = values[0]
-                    mx = values[-1]
-                    if mn == mx:
-                        mins.append(mx - 1)
-                scaler4.fit(values + mins)
-                scaled_data4 = scaler4.transform(raw_data4.values.reshape(-1, 1)).flatten()
-
-            if raw_data5.values.size != 0:
-                values = list(raw_data5.values.reshape(-1, 1))
-                values.sort()
-                mins = []
-                if len(values) > 0:
-                    mn = values[0]
-                    mx = values[-1]
-                    if mn == mx:
-                        mins.append(mx - 1)
-                scaler5.fit(values + mins)
-                scaled_data5 = scaler5.transform(raw_data5.values.reshape(-1, 1)).flatten()
-
-            # add data to score_map
-            indexes = list(raw_data1.index) + list(raw_data2.index) + list(raw_data3.index) + list(raw_data4.index) + list(raw_data5.index)
-            values = list(scaled_data1) + list(scaled_data2) + list(scaled_data3) + list(scaled_data4) + list(scaled_data5)
-
-            score_map[name] = (indexes, values)
 
-        else:
-            scaled_data = scaler.transform(raw_data.values).flatten()
-            score_map[name] = (idx, list(scaled_data))
-
-    for key, val_tup in score_map.items():
-        better_df.loc[val_tup[0], "indicator_score"] = val_tup[1]
-
-    # pillar_sub_group = better_df.groupby(["Pillar", "Sub-Pillar"])
-    # sub_score_map = {}
-    # for name, group in pillar_sub_group:
-    #     # print(name, len(group["data_col"]))
-    #     scaler = MinMaxScaler((min_val, max_val))
-    #
-    #     raw_data = group[["data_col"]]
-    #     idx = raw_data.index
-    #
-    #     scaler.fit(raw_data)
-    #     scaled_data = scaler.transform(raw_data).flatten()
-    #     sub_score_map[name] = (idx, list(scaled_data))
-    #
-    # for key, val_tup in sub_score_map.items():
-    #     better_df.loc[val_tup[0], "sub_pillar_score"] = val_tup[1]
-
-    # print(better_df.head(10).to_string())
+from aggregator import filter_un_countries
+from columnar import write_columns
+from delta import publish_deltas
+from integer_keys import add_key_columns, combined_key, drop_key_columns, first_rows, lookup
+from peers import save_peers
+from profiling import StageProfiler, finish_profile
+from reference import ReferenceTables, default_registry, read_table
+from scaling import scale_indicator_scores
+from score_cube import ScoreCube, sequential_sums
+from shards import save_shards
+
+WEIGHT_KEYS = ["Pillar", "Sub-Pillar", "Indicator"]
+# sub-pillar weights are the Weights.csv rows with an empty Indicator
+SUB_PILLAR_WEIGHT_KEY = "nan"
+
+
+def join_weights(weights: pd.DataFrame, keys_df: pd.DataFrame, id_column="indicator_id"):
+    # weight of every row of keys_df (Pillar, Sub-Pillar, Indicator), in row order;
+    # the string keys are only matched once per distinct id_column value
+    ids = keys_df[id_column].to_numpy()
+    distinct = keys_df.iloc[first_rows(ids)]
+    joined = distinct[WEIGHT_KEYS].merge(weights[WEIGHT_KEYS + ["Weight"]], on=WEIGHT_KEYS, how="left")
+    missing = joined["Weight"].isna()
+    if missing.any():
+        keys = joined.loc[missing, WEIGHT_KEYS].drop_duplicates().to_numpy().tolist()
+        raise KeyError("No weight in Weights.csv for: {}".format(keys))
+    return lookup(ids, distinct[id_column], joined["Weight"].to_numpy(dtype=np.float64))
+
+
+def weighted_group_mean(scores, group_weights, group_ids):
+    # sum(w * score) / sum(w) per group, broadcast to every row; NaN if any score in the group is NaN.
+    # Both sums are accumulated in row order, as the per-group loops did: a different summation order
+    # moves scores by an ulp and splits countries that tie on rank.
+    codes, uniques = pd.factorize(np.asarray(group_ids))
+    weighted = sequential_sums(scores * group_weights, codes, len(uniques))
+    weight = sequential_sums(group_weights, codes, len(uniques))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (weighted / weight)[codes]
+
+
+def process_df(better_df, min_val, max_val, sources_df):
+
+    # Index indicators with a min/max range are scaled onto [min_val, max_val],
+    # everything else is split into quintile bands scaled onto 1-1.99 ... 5-5.99;
+    # sources_df is the range info table or its prebuilt lookup (SourcesTable.range_lookup)
+    better_df["indicator_score"] = scale_indicator_scores(better_df, sources_df, min_val, max_val)
 
     return better_df
 
@@ -206,330 +66,410 @@ def handle_higher_not_better(df):
     return df
 
 
-def add_country_sub_pillar_score(df):
-    global weights
-    pillar_sub_group = df.groupby(["Country Name", "Pillar", "Sub-Pillar"])
-    score_map = {}
-    for name, group in pillar_sub_group:
-        # print(name, group["Indicator"])
-        indicator_scores = group["indicator_score"]
-        idx = indicator_scores.index
-
-        pillar = name[1]
-        sub_pillar = name[2]
-
-        weighted_sum = 0
-        total_weight = 0
-
-        # print(name[0])
-        for indicator, in_score in zip(group["Indicator"], group["indicator_score"]):
-            # print(pillar, sub_pillar, indicator, in_score)
-            weight = get_weight(pillar, sub_pillar, indicator)
-            weighted_sum += (in_score * weight)
-            total_weight += weight
+def add_country_sub_pillar_score(df, weights: pd.DataFrame, total_indicator_map):
+    group_ids = combined_key(df["country_id"], df["sub_pillar_id"])
+    scores = df["indicator_score"].to_numpy(dtype=np.float64)
 
-        score = weighted_sum / total_weight
+    df["country_sub_pillar_score"] = weighted_group_mean(scores, join_weights(weights, df), group_ids)
 
-        # add data availability
-        key = (name[1], name[2])
-        total_inds = total_indicator_map[key]
-        data_avail = (len(group.drop_duplicates("Indicator").index) / total_inds) * 100
-
-        score_map[name] = (idx, [score for _ in range(0, len(idx))], [data_avail for _ in range(0, len(idx))])
-
-    for key, val_tup in score_map.items():
-        df.loc[val_tup[0], "country_sub_pillar_score"] = val_tup[1]
-        df.loc[val_tup[0], "data_availability"] = val_tup[2]
+    # add data availability
+    n_indicators = df.groupby(group_ids, sort=False)["indicator_id"].transform("nunique")
+    sub_pillars = df.iloc[first_rows(df["sub_pillar_id"])]
+    totals = [total_indicator_map.get(key, np.nan) for key in zip(sub_pillars["Pillar"], sub_pillars["Sub-Pillar"])]
+    total_inds = lookup(df["sub_pillar_id"], sub_pillars["sub_pillar_id"], np.asarray(totals, dtype=np.float64))
+    df["data_availability"] = (n_indicators.to_numpy() / total_inds) * 100
 
     return df
 
 
-def add_country_sub_pillar_rank(df):
-    # df["country_sub_pillar_rank"] = df.groupby(["Pillar", "Sub-Pillar"])["country_sub_pillar_score"] \
-    #     .rank(method="min", ascending=False)
-    # df["country_sub_pillar_rank"] = df["country_sub_pillar_rank"].astype(int)
-
-
-    pillar_df = df[["Country Name", "Pillar", "Sub-Pillar", "country_sub_pillar_score", "country_sub_pillar_rank",'UN Member States']] \
-        .drop_duplicates(["Country Name", "Pillar", "Sub-Pillar"], keep="first")
-
-    ######################################################################################
-    un_filter = pillar_df["UN Member States"].isin(['x'])
-    pillar_df = pillar_df.where(un_filter)
-
-    pillar_df["country_sub_pillar_score"] = pillar_df["country_sub_pillar_score"].astype(float)
-
-    pillar_df["country_sub_pillar_rank"] = pillar_df.groupby(["Pillar", "Sub-Pillar"])["country_sub_pillar_score"] \
-        .rank(method="min", ascending=False)
-
-    pillar_df["country_sub_pillar_rank"] = pillar_df["country_sub_pillar_rank"].astype("Int64")
-    #.astype(int)
-
-    c = df.columns.difference(["country_sub_pillar_rank"])
-    df = df[c].merge(pillar_df[["Country Name", "Pillar", "Sub-Pillar", "country_sub_pillar_rank"]],
-                     on=["Country Name", "Pillar", "Sub-Pillar"],
-                     how="left").reindex(columns=df.columns)
+def add_country_sub_pillar_rank(df, cube: ScoreCube):
+    df["country_sub_pillar_rank"] = cube.sub_pillar_rank_column()
 
     return df
 
+def add_country_pillar_score(df, weights: pd.DataFrame, total_sub_pillar_map):
+    # one row per country sub-pillar, weighted by the sub-pillar rows of Weights.csv
+    pillar_ids = combined_key(df["country_id"], df["pillar_id"])
+    sub_rows = first_rows(combined_key(df["country_id"], df["sub_pillar_id"]))
+    sub_df = df.iloc[sub_rows]
+    sub_keys = sub_df[["Pillar", "Sub-Pillar", "sub_pillar_id"]].assign(Indicator=SUB_PILLAR_WEIGHT_KEY)
+    scores = sub_df["country_sub_pillar_score"].to_numpy(dtype=np.float64)
+    sub_scores = weighted_group_mean(scores, join_weights(weights, sub_keys, "sub_pillar_id"), pillar_ids[sub_rows])
+
+    # add data availability, counting sub-pillars the way drop_duplicates("Indicator") then ("Sub-Pillar") did
+    indicator_names = pd.factorize(df["Indicator"])[0]
+    first_inds = first_rows(combined_key(pillar_ids, indicator_names))
+    n_sub_pillars = df.iloc[first_inds].groupby(pillar_ids[first_inds], sort=False)["sub_pillar_id"].nunique()
+    pillars = df.iloc[first_rows(df["pillar_id"])]
+    totals = np.asarray([total_sub_pillar_map.get(pillar, np.nan) for pillar in pillars["Pillar"]], dtype=np.float64)
+
+    df["country_pillar_score"] = lookup(pillar_ids, pillar_ids[sub_rows], sub_scores)
+    df["country_pillar_availability"] = (lookup(pillar_ids, n_sub_pillars.index, n_sub_pillars.to_numpy()) /
+                                         lookup(df["pillar_id"], pillars["pillar_id"], totals)) * 100
 
-def add_country_pillar_score(df):
-    pillar_sub_group = df.groupby(["Country Name", "Pillar"])
-    score_map = {}
-    for name, group in pillar_sub_group:
-        # print(name)
-        country_sub_scores = group["country_sub_pillar_score"]
-        idx = country_sub_scores.index
+    return df
 
-        country_pillars = group.drop_duplicates("Sub-Pillar")
-        # print(country_pillars.to_string())
+def add_country_pillar_rank(df, cube: ScoreCube):
+    df["country_pillar_rank"] = cube.pillar_rank_column()
 
-        country_sub_scores_uni = country_pillars["country_sub_pillar_score"]
+    return df
 
-        pillar = name[1]
+def prep_total_indicator_map(df):
+    return df.groupby(["Pillar", "Sub-Pillar"])["Indicator"].nunique().to_dict()
 
-        weighted_sum = 0
-        total_weight = 0
+def prep_total_sub_pillar_map(df):
+    first_inds = df[~df.duplicated(["Pillar", "Indicator"], keep="first")]
+    return first_inds.groupby("Pillar")["Sub-Pillar"].nunique().to_dict()
 
-        # print(name[0])
-        for sub_pillar, in_score in zip(country_pillars["Sub-Pillar"], country_sub_scores_uni):
-            # print(pillar, sub_pillar, indicator, in_score)
-            weight = get_weight(pillar, sub_pillar, "nan")
-            weighted_sum += (in_score * weight)
-            total_weight += weight
+def prep_pillar_count(df):
+    return len(df["Pillar"].unique())
 
-        score = weighted_sum / total_weight
+def add_sources(df, source_data_df: pd.DataFrame, source_lookup=None):
+    # source_lookup is SourcesTable.source_lookup, only passed when every indicator has a single source
+    df["Data Source"] = np.nan
+    df["Data Link"] = np.nan
 
-        # add data availability
-        key = (name[1])
-        total_inds = total_sub_pillar_map[key]
-        data_avail = (len(group.drop_duplicates("Indicator").drop_duplicates("Sub-Pillar").index) / total_inds) * 100
-        #print(key, len(group.drop_duplicates("Indicator").drop_duplicates("Sub-Pillar").index), total_inds, data_avail)
+    if source_lookup is None and source_data_df.duplicated(WEIGHT_KEYS).any():
+        # an indicator with several sources repeats its rows, which only the row-wise merge does
+        c = df.columns.difference(["Data Source", "Data Link"])
+        df = df[c].merge(source_data_df, on=["Pillar", "Sub-Pillar", "Indicator"],
+                         how="left").reindex(columns=df.columns)
+        return df
+
+    indicators = df.iloc[first_rows(df["indicator_id"])]
+    if source_lookup is not None:
+        found = [source_lookup.get(key, (np.nan, np.nan)) for key in zip(*(indicators[k] for k in WEIGHT_KEYS))]
+        joined = pd.DataFrame(found, columns=["Data Source", "Data Link"], dtype=object)
+    else:
+        joined = indicators[WEIGHT_KEYS].merge(source_data_df, on=WEIGHT_KEYS, how="left")
+    for column in ["Data Source", "Data Link"]:
+        df[column] = lookup(df["indicator_id"], indicators["indicator_id"], joined[column].to_numpy(dtype=object))
+
+    return df.reset_index(drop=True)
+
+
+ROLL_COLUMNS = ["Country Name", "Pillar", "Sub-Pillar", "Indicator", "data_col", "higher_is_better", "new_rank_score",
+                "rank", "data_availability", "Data Source", "Data Link", "Year"]
+# indicator rows written per chunk by write_roll_csv
+ROLL_CHUNK_ROWS = 50000
+
+
+def level_rows(df, score_column, keys):
+    # position of the first scored row of every key, in frame order
+    scored = np.flatnonzero(df[score_column].notna().to_numpy())
+    return scored[~df[keys].iloc[scored].duplicated(keep="first").to_numpy()]
+
+
+def roll_frame(level: pd.DataFrame, **columns):
+    # one roll block in ROLL_COLUMNS order, labels from level and blanks for everything not given
+    values = {column: columns.get(column, level[column] if column in level.columns else "") for column in ROLL_COLUMNS}
+    return pd.DataFrame(values, index=level.index)
+
+
+def sub_pillar_level(df):
+    rows = level_rows(df, "country_sub_pillar_score", ["Country Name", "Pillar", "Sub-Pillar"])
+    level = df.iloc[rows][["Country Name", "Pillar", "Sub-Pillar", "country_sub_pillar_score",
+                           "country_sub_pillar_rank", "data_availability"]]
+    return roll_frame(level[["Country Name", "Pillar", "Sub-Pillar"]],
+                      new_rank_score=level["country_sub_pillar_score"], rank=level["country_sub_pillar_rank"],
+                      data_availability=level["data_availability"])
+
+
+def pillar_level(df):
+    rows = level_rows(df, "country_pillar_score", ["Country Name", "Pillar"])
+    level = df.iloc[rows][["Country Name", "Pillar", "country_pillar_score", "country_pillar_rank",
+                           "country_pillar_availability"]]
+    return roll_frame(level[["Country Name", "Pillar"]], new_rank_score=level["country_pillar_score"],
+                      rank=level["country_pillar_rank"], data_availability=level["country_pillar_availability"])
+
+
+def country_level(pillar_df: pd.DataFrame, cube: ScoreCube):
+    # one row per country, in the order the countries first appear among the pillar rows
+    level = pillar_df.drop_duplicates(["Country Name"], keep="first")[["Country Name"]]
+    ids = cube.country_index(level["Country Name"])
+    return roll_frame(level, new_rank_score=cube.country_score[ids], rank=cube.country_rank[ids],
+                      data_availability=cube.country_availability[ids])
+
+
+def indicator_level(df, start=0, stop=None):
+    block = df.iloc[start:stop]
+    return roll_frame(block[["Country Name", "Pillar", "Sub-Pillar", "Indicator", "data_col", "higher_is_better",
+                             "Data Source", "Data Link", "Year"]],
+                      new_rank_score=block["indicator_score"], rank="", data_availability="")
+
+
+def indicator_dtype_probe(df):
+    # at most one indicator row that gives pd.concat the same result dtypes as the whole indicator block:
+    # for every column a non-missing value if the block has one, missing otherwise
+    block = indicator_level(df, 0, 1)
+    if len(block.index) == 0:
+        return block
+    full = {"new_rank_score": "indicator_score", "rank": None, "data_availability": None}
+    for column in ROLL_COLUMNS:
+        source = full.get(column, column)
+        if source is None:
+            continue
+        valid = np.flatnonzero(df[source].notna().to_numpy())
+        block[column] = df[source].iloc[valid[:1] if len(valid) > 0 else [0]].to_numpy()
+    return block
+
+
+def build_roll_df(df, cube: ScoreCube):
+    pillar_df = pillar_level(df)
+    roll_df = pd.concat([country_level(pillar_df, cube), pillar_df, sub_pillar_level(df), indicator_level(df)], axis=0)
+    return roll_df.reset_index(drop=True)
+
+
+def roll_level_blocks(df, cube: ScoreCube):
+    # country, pillar and sub-pillar blocks cast to the dtypes the combined roll frame would have,
+    # plus those dtypes
+    pillar_df = pillar_level(df)
+    levels = [country_level(pillar_df, cube), pillar_df, sub_pillar_level(df)]
+    dtypes = pd.concat(levels + [indicator_dtype_probe(df)], axis=0).dtypes
+    return [block.astype(dtypes) for block in levels], dtypes
+
+
+def write_roll_csv(df, cube: ScoreCube, output_file="Processed/Full Data/full_output_rolling.csv",
+                   chunk_size=ROLL_CHUNK_ROWS):
+    # Writes the same bytes as build_roll_df(df, cube).to_csv(output_file, index=False) without building the
+    # combined frame: the level blocks are small, indicator rows are streamed in chunks. The level blocks get
+    # the dtypes of the combined frame; indicator chunks keep their native float/int/bool columns, which
+    # to_csv formats exactly like the object values they would become, and skip the cast.
+    levels, _ = roll_level_blocks(df, cube)
+    with open(output_file, "w", encoding="utf-8", newline="") as f:
+        pd.DataFrame(columns=ROLL_COLUMNS).to_csv(f, index=False)
+        for block in levels:
+            block.to_csv(f, index=False, header=False)
+        for start in range(0, len(df.index), chunk_size):
+            indicator_level(df, start, start + chunk_size).to_csv(f, index=False, header=False)
+
+
+class ScoringResult:
+    # roll_df is only built when asked for; save() streams full_output_rolling.csv from full_df and the cube
+
+    def __init__(self, full_df, roll_df, cube, total_indicator_map, total_sub_pillar_map, pillar_count):
+        self.full_df = full_df
+        self._roll_df = roll_df
+        self.cube = cube
+        self.total_indicator_map = total_indicator_map
+        self.total_sub_pillar_map = total_sub_pillar_map
+        self.pillar_count = pillar_count
+
+    def __setstate__(self, state):
+        # results pickled before roll_df was built lazily
+        if "roll_df" in state:
+            state["_roll_df"] = state.pop("roll_df")
+        self.__dict__.update(state)
+
+    @property
+    def roll_df(self):
+        if self._roll_df is None:
+            self._roll_df = build_roll_df(self.full_df, self.cube)
+        return self._roll_df
+
+    @property
+    def full_data(self):
+        # full_data.csv layout
+        return drop_key_columns(self.full_df.drop(['UN Member States'], axis=1))
+
+    def save(self, full_data_file="Processed/Full Data/full_data.csv",
+             roll_file="Processed/Full Data/full_output_rolling.csv"):
+        self.full_data.to_csv(full_data_file, index=False)
+        self.save_roll(roll_file)
+
+    def save_roll(self, roll_file="Processed/Full Data/full_output_rolling.csv"):
+        if self._roll_df is not None:
+            self._roll_df.to_csv(roll_file, index=False)
+        else:
+            write_roll_csv(self.full_df, self.cube, roll_file)
 
-        # score = country_sub_scores_uni.sum() / len(country_sub_scores_uni.index)
 
-        score_map[name] = (idx, [score for _ in range(0, len(idx))], [data_avail for _ in range(0, len(idx))])
+class ScoringEngine:
+    # Weights, sources and (optionally) countries come from the reference registry, which parses every
+    # file once per process and reloads it when it changes. Everything derived from the indicator data
+    # lives on the ScoringResult, so one engine can score many frames, from several threads at once, and
+    # engines can be pickled to worker processes.
 
-    for key, val_tup in score_map.items():
-        df.loc[val_tup[0], "country_pillar_score"] = val_tup[1]
-        df.loc[val_tup[0], "country_pillar_availability"] = val_tup[2]
+    def __init__(self, weights="Weights.csv", sources="Sources.csv", countries=None, min_val=1, max_val=5.99,
+                 registry=None):
+        self.registry = registry or default_registry()
+        self.table_sources = (weights, sources, countries)
+        self.tables = self.registry.load(weights, sources, countries)
+        self.min_val = min_val
+        self.max_val = max_val
 
-    return df
+    def refresh(self) -> ReferenceTables:
+        # re-stats the reference files; a score run works on one consistent set of tables
+        self.tables = self.registry.load(*self.table_sources)
+        return self.tables
 
+    @property
+    def weights(self):
+        return self.tables.weights.weights
 
-def add_country_pillar_rank(df):
-    pillar_df = df[["Country Name", "Pillar", "country_pillar_score", "country_pillar_rank",'UN Member States']] \
-        .drop_duplicates(["Country Name", "Pillar"], keep="first")
+    @property
+    def weight_index(self):
+        return self.tables.weights.weight_index
 
-    ##################################################################################
-    un_filter = pillar_df["UN Member States"].isin(['x'])
-    pillar_df = pillar_df.where(un_filter)
+    @property
+    def range_info_df(self):
+        return self.tables.sources.range_info_df
 
-    # print(pillar_df[["Country Name"]].drop_duplicates(["Country Name"], keep="first").values.flatten().tolist())
+    @property
+    def source_data_df(self):
+        return self.tables.sources.source_data_df
 
-    pillar_df["country_pillar_rank"] = pillar_df.groupby(["Pillar"])["country_pillar_score"] \
-        .rank(method="min", ascending=False)
+    @property
+    def countries_df(self):
+        return None if self.tables.countries is None else self.tables.countries.countries_df
 
-    pillar_df["country_pillar_rank"] = pillar_df["country_pillar_rank"].astype("Int64")
-        #.astype(int)
+    @property
+    def country_codes(self):
+        # M49 codes become the integer country ids; without a countries table ids are numbered from 1000
+        return None if self.tables.countries is None else self.tables.countries.country_codes
 
-    c = df.columns.difference(["country_pillar_rank"])
-    df = df[c].merge(pillar_df[["Country Name", "Pillar", "country_pillar_rank"]], on=["Country Name", "Pillar"],
-                     how="left").reindex(columns=df.columns)
+    def prepare(self, indicator_data, tables: ReferenceTables = None):
+        tables = tables or self.tables
+        full_df = read_table(indicator_data)
+        if "UN Member States" not in full_df.columns:
+            if tables.countries is None:
+                raise ValueError("Indicator data has no 'UN Member States' column and no countries table was given")
+            full_df = filter_un_countries(full_df, tables.countries, verbose=False).reset_index(drop=True)
 
-    return df
+        full_df["indicator_score"] = pd.Series(np.float64)
+        # full_df["sub_pillar_score"] = pd.Series(np.float64)
+        full_df["country_sub_pillar_score"] = pd.Series(np.float64)
+        full_df["country_sub_pillar_rank"] = pd.Series(np.int64)
 
+        full_df["country_pillar_score"] = pd.Series(np.float64)
+        full_df["country_pillar_rank"] = pd.Series(np.int64)
 
-def prep_total_indicator_map(df):
-    pillar_sub_group = df.groupby(["Pillar", "Sub-Pillar"])
-    for name, group in pillar_sub_group:
-        country_pillars = group.drop_duplicates("Indicator")
-        total_sub_inds = len(country_pillars.index)
+        full_df["Year"] = full_df["Year"].astype(int)
 
-        total_indicator_map[name] = total_sub_inds
+        full_df["higher_is_better"] = full_df["higher_is_better"].astype(bool)
 
-    # print(total_indicator_map)
+        full_df = add_key_columns(full_df, None if tables.countries is None else tables.countries.country_codes)
 
-def prep_total_sub_pillar_map(df):
-    pillar_sub_group = df.groupby(["Pillar"])
-    for name, group in pillar_sub_group:
-        country_pillars = group.drop_duplicates("Indicator").drop_duplicates("Sub-Pillar")
-        total_sub_inds = len(country_pillars.index)
+        return full_df
 
-        total_sub_pillar_map[name] = total_sub_inds
+    def indicator_scores(self, indicator_data, profiler: StageProfiler = None, tables: ReferenceTables = None):
+        # scaling does not depend on the weights, so sweeps and resampling can reuse this frame
+        profiler = profiler or StageProfiler(enabled=False)
+        run = profiler.run
+        tables = tables or self.refresh()
 
-    # print(total_sub_pillar_map)
+        full_df = run("prepare", self.prepare, indicator_data, tables)
 
-def prep_pillar_count(df):
-    global pillar_count
-    pillar_count = len(df["Pillar"].unique())
+        full_df = run("process_df", process_df, full_df, self.min_val, self.max_val, tables.sources.range_lookup)
+        # print(full_df[full_df["higher_is_better"] == True].head(10).to_string())
 
-    # print(pillars)
+        full_df = run("handle_higher_not_better", handle_higher_not_better, full_df)
+        # print(full_df[full_df["higher_is_better"] == True].head(10).to_string())
 
-def add_sources(df, source_file_name):
-    df["Data Source"] = np.nan
-    df["Data Link"] = np.nan
+        return full_df
 
-    sources_df = pd.read_csv(source_file_name)
-    source_data_df = sources_df[["Pillar", "Sub-Pillar", "Indicator", "Data Source", "Data Link"]] \
-        .dropna(subset=["Pillar", "Sub-Pillar", "Indicator"])
+    def score(self, indicator_data, profiler: StageProfiler = None):
+        tables = self.refresh()
+        return self.attach_sources(self.score_levels(indicator_data, profiler, tables), profiler, tables)
 
-    # print(source_data_df.to_string())
+    def score_levels(self, indicator_data, profiler: StageProfiler = None, tables: ReferenceTables = None):
+        # indicator, sub-pillar and pillar scores and ranks, without the source columns
+        profiler = profiler or StageProfiler(enabled=False)
+        run = profiler.run
 
-    c = df.columns.difference(["Data Source", "Data Link"])
-    df = df[c].merge(source_data_df, on=["Pillar", "Sub-Pillar", "Indicator"],
-                     how="left").reindex(columns=df.columns)
+        tables = tables or self.refresh()
+        weights = tables.weights.weights
+        full_df = self.indicator_scores(indicator_data, profiler, tables)
 
-    return df
+        total_indicator_map = run("prep_total_indicator_map", prep_total_indicator_map, full_df)
+        total_sub_pillar_map = run("prep_total_sub_pillar_map", prep_total_sub_pillar_map, full_df)
+        pillar_count = run("prep_pillar_count", prep_pillar_count, full_df)
 
+        full_df = run("add_country_sub_pillar_score", add_country_sub_pillar_score, full_df, weights,
+                      total_indicator_map)
+        # print(full_df.head(10).to_string())
 
-def get_country_rank(pillar_df: pd.DataFrame):
-    country_df = pillar_df.copy(deep=True)
-    #############################################
-    un_filter = pillar_df["UN Member States"].isin(['x','y'])
-    country_df = pillar_df.where(un_filter)
-    #country_df = country_df.drop(['UN Member States'], axis=1)
-
-    country_group = pillar_df.groupby(["Country Name"])
-
-    for name, group in country_group:
-        n_pillars = len(group[["Pillar"]].index)
-        score_sum = group[["new_rank_score"]].sum()
-
-        score = float(score_sum / n_pillars)
-
-        country_df.loc[country_df["Country Name"] == name, "new_rank_score"] = score
-        country_df.loc[country_df["Country Name"] == name, "data_availability"] = (n_pillars/pillar_count)*100
-
-        #print(name, (n_pillars/pillar_count)*100)
-
-
-    country_df = country_df.drop_duplicates(["Country Name"], keep="first")
-    country_df["Pillar"] = ""
-
-    #country_df["data_availability"] = ""
-    un_filter = country_df["UN Member States"].isin(['x'])
-    country_df1 = country_df.where(un_filter)
-    country_df1["rank"] = country_df1["new_rank_score"].rank(method="min", ascending=False)
-
-    country_df = country_df.drop(['UN Member States'], axis=1)
-
-    country_df1 = country_df1[["Country Name", "rank"]]
-    c = country_df.columns.difference(["rank"])
-    country_df = country_df[c].merge(country_df1, on=["Country Name"], how="left").reindex(columns=country_df.columns)
-    
-    return country_df
-
-
-def save_roll_csv(df):
-    columns = ["Country Name", "Pillar", "Sub-Pillar", "Indicator", "data_col", "higher_is_better", "data_availability",
-               "Data Source", "Data Link", "Year"]
-    columns_order = ["Country Name", "Pillar", "Sub-Pillar", "Indicator", "data_col", "higher_is_better",
-                     "new_rank_score", "rank", "data_availability", "Data Source", "Data Link", "Year"]
-    indicator_df = df[columns + ["indicator_score"]]
-    indicator_df["rank"] = ""
-    indicator_df["data_availability"] = ""
-    indicator_df = indicator_df.rename(columns={"indicator_score": "new_rank_score"})
-
-    sub_pillar_df = df[columns + ["country_sub_pillar_score"]]
-    sub_pillar_df["rank"] = df[["country_sub_pillar_rank"]]
-    sub_pillar_df = sub_pillar_df.dropna(subset=["country_sub_pillar_score"])
-    sub_pillar_df = sub_pillar_df.drop_duplicates(["Country Name", "Pillar", "Sub-Pillar"], keep="first")
-    sub_pillar_df["Indicator"] = ""
-    sub_pillar_df["data_col"] = ""
-    sub_pillar_df["higher_is_better"] = ""
-    sub_pillar_df["Data Source"] = ""
-    sub_pillar_df["Data Link"] = ""
-    sub_pillar_df["Year"] = ""
-    sub_pillar_df = sub_pillar_df.rename(columns={"country_sub_pillar_score": "new_rank_score"})
-
-    pillar_df = df[columns + ["country_pillar_score", "UN Member States"]]
-    pillar_df["rank"] = df[["country_pillar_rank"]]
-    pillar_df = pillar_df.dropna(subset=["country_pillar_score"])
-    pillar_df = pillar_df.drop_duplicates(["Country Name", "Pillar"], keep="first")
-    pillar_df["Indicator"] = ""
-    pillar_df["Sub-Pillar"] = ""
-    pillar_df["data_col"] = ""
-    pillar_df["higher_is_better"] = ""
-    pillar_df["Data Source"] = ""
-    pillar_df["Data Link"] = ""
-    pillar_df["Year"] = ""
-    pillar_df["data_availability"] = df["country_pillar_availability"]
-    pillar_df = pillar_df.rename(columns={"country_pillar_score": "new_rank_score"})
-
-    country_df = get_country_rank(pillar_df)
-
-    roll_df = pd.concat([country_df, pillar_df, sub_pillar_df, indicator_df], axis=0)
-    roll_df = roll_df.reset_index(drop=True)
-
-    roll_df = roll_df[columns_order]
-
-    roll_df.to_csv("Processed/Full Data/full_output_rolling.csv", index=False)
-    # Copying this file to the UI directory so that the dashboard re-builds/deploys with the new data.
-    #roll_df.to_csv("../ui/database/raw/scores.csv", index=False)
+        full_df = run("add_country_pillar_score", add_country_pillar_score, full_df, weights,
+                      total_sub_pillar_map)
 
+        # every level is ranked from one cube instead of drop_duplicates + merge per level
+        cube = run("build_score_cube", ScoreCube, full_df, pillar_count)
+        full_df = run("add_country_sub_pillar_rank", add_country_sub_pillar_rank, full_df, cube)
+        full_df = run("add_country_pillar_rank", add_country_pillar_rank, full_df, cube)
 
-def process_aggregated(headers, aggr_file):
-    full_df = pd.read_csv(aggr_file)
-    full_df["indicator_score"] = pd.Series(np.float64)
-    # full_df["sub_pillar_score"] = pd.Series(np.float64)
-    full_df["country_sub_pillar_score"] = pd.Series(np.float64)
-    full_df["country_sub_pillar_rank"] = pd.Series(np.int64)
+        full_df = full_df.drop("new_rank_score", axis=1)
 
-    full_df["country_pillar_score"] = pd.Series(np.float64)
-    full_df["country_pillar_rank"] = pd.Series(np.int64)
+        return ScoringResult(full_df, None, cube, total_indicator_map, total_sub_pillar_map, pillar_count)
 
-    full_df["Year"] = full_df["Year"].astype(int)
+    def attach_sources(self, levels: ScoringResult, profiler: StageProfiler = None, tables: ReferenceTables = None):
+        # Data Source and Data Link of every indicator row; levels is left as it is, so a change of the
+        # links alone only repeats this step
+        profiler = profiler or StageProfiler(enabled=False)
+        sources = (tables or self.tables).sources
+        full_df = profiler.run("add_sources", add_sources, levels.full_df.copy(), sources.source_data_df,
+                               sources.source_lookup if sources.unique_sources else None)
 
-    full_df["higher_is_better"] = full_df["higher_is_better"].astype(bool)
+        year_df = full_df["Year"]
 
-    # higher_is_better_df = full_df[(full_df["higher_is_better"] == True)]
-    # higher_is_not_better_df = full_df[(full_df["higher_is_better"] == False)]
+        full_df = full_df.drop("Year", axis=1)
 
-    # print(len(higher_is_better_df.index))
-    # print(len(higher_is_not_better_df.index))
-    # print(len(full_df.index))
+        full_df["Year"] = year_df
 
-    load_weights()
-    prep_total_indicator_map(full_df)
-    prep_total_sub_pillar_map(full_df)
-    prep_pillar_count(full_df)
+        return ScoringResult(full_df, None, levels.cube, levels.total_indicator_map, levels.total_sub_pillar_map,
+                             levels.pillar_count)
 
-    full_df = process_df(full_df, 1, 5.99)
-    # print(full_df[full_df["higher_is_better"] == True].head(10).to_string())
 
-    full_df = handle_higher_not_better(full_df)
-    # print(full_df[full_df["higher_is_better"] == True].head(10).to_string())
+def process_aggregated(headers, aggr_file, profiler: StageProfiler = None, columnar_dir=None, shards_dir=None,
+                       delta_dir=None, peers_dir=None):
+    # aggr_file is output.csv or the column store written by aggregator.py --columnar
+    profiler = profiler or StageProfiler(enabled=False)
 
-    full_df = add_country_sub_pillar_score(full_df)
-    # print(full_df.head(10).to_string())
+    countries_file = "../data/Countries.csv" if os.path.exists("../data/Countries.csv") else None
+    engine = profiler.run("load_reference_data", ScoringEngine, "Weights.csv", "Sources.csv", countries_file)
+    result = engine.score(aggr_file, profiler)
 
-    full_df = add_country_sub_pillar_rank(full_df)
+    profiler.run("save_full_csv", result.full_data.to_csv, "Processed/Full Data/full_data.csv", index=False)
+    if columnar_dir is not None:
+        profiler.run("save_full_columns", write_columns, result.full_data, columnar_dir)
     # print(full_df.head(170).to_string())
 
-    full_df = add_country_pillar_score(full_df)
-    full_df = add_country_pillar_rank(full_df)
-
-    full_df = full_df.drop("new_rank_score", axis=1)
-
-    full_df = add_sources(full_df, "Sources.csv")
-
-    year_df = full_df["Year"]
-
-    full_df = full_df.drop("Year", axis=1)
-
-    full_df["Year"] = year_df
-
-    full_df1 = full_df.drop(['UN Member States'], axis=1)
-
-    full_df1.to_csv("Processed/Full Data/full_data.csv", index=False)
-    # print(full_df.head(170).to_string())
+    profiler.run("save_roll_csv", result.save_roll, "Processed/Full Data/full_output_rolling.csv")
+    # Copying this file to the UI directory so that the dashboard re-builds/deploys with the new data.
+    #result.roll_df.to_csv("../ui/database/raw/scores.csv", index=False)
+    if shards_dir is not None:
+        profiler.run("save_shards", save_shards, "Processed/Full Data/full_output_rolling.csv", shards_dir)
+    if peers_dir is not None:
+        profiler.run("save_peers", save_peers, "Processed/Full Data/full_data.csv", peers_dir)
+    if delta_dir is not None:
+        profiler.run("publish_deltas", publish_deltas, "Processed/Full Data", delta_dir)
 
-    save_roll_csv(full_df)
+    return result
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="Processed/Full Data/output.csv",
+                        help="aggregated indicators, output.csv or a column store directory")
+    parser.add_argument("--columnar", nargs="?", const="Processed/Full Data/full_data_columns", default=None,
+                        help="also write full_data as a column store")
+    parser.add_argument("--shards", nargs="?", const="Processed/Shards", default=None,
+                        help="also write per-country and per-pillar JSON shards for the dashboard")
+    parser.add_argument("--delta", nargs="?", const="Processed/Delta", default=None,
+                        help="also write changesets against the previous run's outputs")
+    parser.add_argument("--peers", nargs="?", const="Processed/Peers", default=None,
+                        help="also write the nearest peers of every country by pillar profile")
+    parser.add_argument("--profile", nargs="?", const="Processed/Full Data/profile_process_aggr.json", default=None,
+                        help="record per-stage time and memory and write a JSON report")
+    args = parser.parse_args()
+
+    stage_profiler = StageProfiler(enabled=args.profile is not None)
     process_aggregated(
         ["Country Name", "Year", "Indicator", "data_col", "new_rank_score", "higher_is_better", "Pillar", "Sub-Pillar", 'UN Member States'],
-        "Processed/Full Data/output.csv"
+        args.input,
+        stage_profiler,
+        args.columnar,
+        args.shards,
+        args.delta,
+        args.peers
     )
+    finish_profile(stage_profiler, args.profile)
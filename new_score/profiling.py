@@ -0,0 +1,157 @@
+import json
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def process_peak_rss_kb():
+    # high-water mark of the whole process since it started, not of one stage (ru_maxrss is in kilobytes
+    # on Linux)
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def count_rows(value):
+    if isinstance(value, tuple) and len(value) > 0:
+        value = value[0]
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value.index)
+    return None
+
+
+class StageProfiler:
+    # Opt-in per-stage timing and memory report. When disabled, run() is a plain function call.
+    # tracemalloc and the CPU clock are process-wide: a stage run inside another one folds the peak it
+    # resets into the enclosing stage, and a stage that overlaps a stage of another thread reports no
+    # memory and no CPU time (concurrent is True), since neither can be told apart from the other stage's.
+    # process_peak_rss_kb is the process high-water mark when the stage ended and rss_growth_kb how much
+    # the stage raised it.
+
+    def __init__(self, enabled=False, trace_memory=True):
+        self.enabled = enabled
+        self.trace_memory = trace_memory and enabled
+        self.stages = []
+        self._started_tracing = False
+        self._lock = threading.Lock()
+        self._active = {}
+        self._first_start = None
+        self._last_end = None
+
+    def _enter(self, name):
+        frame = {"stage": name, "concurrent": False, "inner_peak": 0}
+        with self._lock:
+            thread_stack = self._active.setdefault(threading.get_ident(), [])
+            others = [f for ident, stack in self._active.items() if ident != threading.get_ident() for f in stack]
+            if others:
+                for f in others + thread_stack:
+                    f["concurrent"] = True
+                frame["concurrent"] = True
+            if self.trace_memory and not frame["concurrent"]:
+                peak = tracemalloc.get_traced_memory()[1]
+                for f in thread_stack:
+                    f["inner_peak"] = max(f["inner_peak"], peak)
+                tracemalloc.reset_peak()
+            if self._first_start is None:
+                self._first_start = (time.perf_counter(), time.process_time())
+            thread_stack.append(frame)
+            frame["depth"] = len(thread_stack) - 1
+            frame["mem_before"] = tracemalloc.get_traced_memory()[0] if self.trace_memory else None
+            frame["rss_before"] = process_peak_rss_kb()
+            frame["wall_start"] = time.perf_counter()
+            frame["cpu_start"] = time.process_time()
+        return frame
+
+    def _exit(self, frame):
+        with self._lock:
+            wall = time.perf_counter() - frame["wall_start"]
+            cpu = time.process_time() - frame["cpu_start"]
+            self._active[threading.get_ident()].pop()
+            self._last_end = (time.perf_counter(), time.process_time())
+            memory = self.trace_memory and not frame["concurrent"]
+            current, peak = tracemalloc.get_traced_memory() if memory else (None, None)
+        rss = process_peak_rss_kb()
+        return {
+            "stage": frame["stage"],
+            "depth": frame["depth"],
+            "concurrent": frame["concurrent"],
+            "wall_s": wall,
+            "cpu_s": None if frame["concurrent"] else cpu,
+            "process_peak_rss_kb": rss,
+            "rss_growth_kb": None if rss is None or frame["concurrent"] else rss - frame["rss_before"],
+            "tracemalloc_peak_kb": None if not memory else
+            (max(peak, frame["inner_peak"]) - frame["mem_before"]) / 1024,
+            "tracemalloc_delta_kb": None if not memory else (current - frame["mem_before"]) / 1024,
+        }
+
+    def run(self, name, func, *args, **kwargs):
+        if not self.enabled:
+            return func(*args, **kwargs)
+
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+        rows_in = count_rows(args[0]) if len(args) > 0 else None
+        frame = self._enter(name)
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            stage = self._exit(frame)
+        stage["rows_in"] = rows_in
+        stage["rows_out"] = count_rows(result)
+        with self._lock:
+            self.stages.append(stage)
+
+        return result
+
+    def stop(self):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def report(self):
+        # totals run from the start of the first stage to the end of the last one, so nested and
+        # concurrent stages are not counted twice
+        timed = self._first_start is not None and self._last_end is not None
+        return {
+            "total_wall_s": self._last_end[0] - self._first_start[0] if timed else 0.0,
+            "total_cpu_s": self._last_end[1] - self._first_start[1] if timed else 0.0,
+            "process_peak_rss_kb": process_peak_rss_kb(),
+            "stages": self.stages,
+        }
+
+    def write_json(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=2)
+
+    def summary(self):
+        lines = ["{:<32} {:>9} {:>9} {:>12} {:>10} {:>10}".format(
+            "stage", "wall s", "cpu s", "py peak MB", "rows in", "rows out")]
+        for s in self.stages:
+            peak = "" if s["tracemalloc_peak_kb"] is None else "{:.1f}".format(s["tracemalloc_peak_kb"] / 1024)
+            cpu = "" if s["cpu_s"] is None else "{:.3f}".format(s["cpu_s"])
+            lines.append("{:<32} {:>9.3f} {:>9} {:>12} {:>10} {:>10}".format(
+                "  " * s["depth"] + s["stage"], s["wall_s"], cpu, peak,
+                "" if s["rows_in"] is None else s["rows_in"], "" if s["rows_out"] is None else s["rows_out"]))
+        report = self.report()
+        lines.append("{:<32} {:>9.3f} {:>9.3f}".format("total", report["total_wall_s"], report["total_cpu_s"]))
+        if report["process_peak_rss_kb"] is not None:
+            lines.append("process peak RSS: {:.1f} MB".format(report["process_peak_rss_kb"] / 1024))
+        return "\n".join(lines)
+
+
+def finish_profile(profiler: StageProfiler, report_file=None):
+    profiler.stop()
+    if not profiler.enabled:
+        return
+    if report_file is not None:
+        profiler.write_json(report_file)
+    print(profiler.summary())
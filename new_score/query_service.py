@@ -0,0 +1,288 @@
+import argparse
+import json
+import math
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+from reference import file_signature
+
+LABEL_COLUMNS = ["Country Name", "Pillar", "Sub-Pillar", "Indicator"]
+LEVELS = ["country", "pillar", "sub_pillar", "indicator"]
+# latencies kept for the percentiles in /stats
+LATENCY_WINDOW = 4096
+
+
+def row_level(df: pd.DataFrame):
+    # roll rows leave the labels below their level empty
+    level = np.full(len(df.index), 3)
+    level[(df["Indicator"] == "").to_numpy()] = 2
+    level[(df["Sub-Pillar"] == "").to_numpy()] = 1
+    level[(df["Pillar"] == "").to_numpy()] = 0
+    return level
+
+
+def json_value(value):
+    if isinstance(value, (float, np.floating)):
+        value = float(value)
+        if math.isnan(value):
+            return None
+        return int(value) if value.is_integer() and abs(value) < 2 ** 53 else value
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.bool_):
+        return bool(value)
+    return value
+
+
+class ScoreIndex:
+    # One scoring run (full_output_rolling.csv layout) held as JSON-encoded rows plus row-id lists per
+    # country, per (level, pillar, sub-pillar, indicator) rank list and per label. Built once, never
+    # modified; queries only look up and slice these lists.
+
+    def __init__(self, roll_df: pd.DataFrame, source=None):
+        df = roll_df.reset_index(drop=True).copy()
+        for column in LABEL_COLUMNS:
+            df[column] = df[column].fillna("").astype(str)
+        self.source = source
+        self.loaded_at = time.time()
+        self.columns = list(df.columns)
+        self.level = row_level(df)
+
+        self.records = [dict(zip(self.columns, map(json_value, row))) for row in df.itertuples(index=False)]
+        for record, level in zip(self.records, self.level):
+            record["level"] = LEVELS[level]
+        self.encoded = [json.dumps(record, ensure_ascii=False) for record in self.records]
+
+        # rank lists: ranked rows by rank, then everything else by score, highest first
+        rank = df["rank"].to_numpy(dtype=np.float64) if "rank" in df.columns else np.full(len(df.index), np.nan)
+        score = df["new_rank_score"].to_numpy(dtype=np.float64)
+        order = np.lexsort((np.arange(len(df.index)), np.nan_to_num(-score, nan=np.inf),
+                            np.nan_to_num(rank, nan=np.inf)))
+        ordered = df.iloc[order]
+        self.rank_lists = {}
+        for key, positions in ordered.groupby([self.level[order]] + [ordered[c] for c in LABEL_COLUMNS[1:]],
+                                              sort=False).indices.items():
+            self.rank_lists[key] = order[positions].tolist()
+
+        self.by_country = {key: rows.tolist() for key, rows in df.groupby("Country Name", sort=False).indices.items()}
+        self.by_label = {column: {key: rows.tolist() for key, rows in df.groupby(column, sort=False).indices.items()}
+                         for column in LABEL_COLUMNS[1:]}
+        self.by_level = {LEVELS[level]: np.flatnonzero(self.level == level).tolist() for level in range(len(LEVELS))}
+        self.countries = list(self.by_country)
+        self.pillars = [p for p in self.by_label["Pillar"] if p != ""]
+
+    @classmethod
+    def from_csv(cls, path):
+        return cls(pd.read_csv(path), path)
+
+    def rank_list(self, pillar="", sub_pillar="", indicator="", limit=None):
+        level = 3 if indicator else 2 if sub_pillar else 1 if pillar else 0
+        rows = self.rank_lists.get((level, pillar, sub_pillar, indicator), [])
+        return rows if limit is None else rows[:limit]
+
+    def top(self, n=10):
+        # top n countries of every pillar
+        return {pillar: self.rank_list(pillar, limit=n) for pillar in self.pillars}
+
+    def profile(self, country, indicators=False):
+        rows = self.by_country.get(country, [])
+        return rows if indicators else [row for row in rows if self.level[row] < 3]
+
+    def slice(self, country=None, pillar=None, sub_pillar=None, indicator=None, level=None, limit=None):
+        # rows matching every given filter; starts from the shortest candidate list
+        filters = [("Country Name", country), ("Pillar", pillar), ("Sub-Pillar", sub_pillar), ("Indicator", indicator)]
+        candidates = [self.by_country.get(value, []) if column == "Country Name" else
+                      self.by_label[column].get(value, []) for column, value in filters if value is not None]
+        if level is not None:
+            candidates.append(self.by_level.get(level, []))
+        if not candidates:
+            rows = range(len(self.records))
+        else:
+            rows = min(candidates, key=len)
+        wanted = [(column, value) for column, value in filters if value is not None]
+        found = []
+        for row in rows:
+            record = self.records[row]
+            if (level is None or record["level"] == level) and all(record[c] == v for c, v in wanted):
+                found.append(row)
+                if limit is not None and len(found) >= limit:
+                    break
+        return found
+
+    def render(self, rows):
+        return ("[" + ",".join(self.encoded[row] for row in rows) + "]").encode("utf-8")
+
+    def rows(self, rows):
+        return [self.records[row] for row in rows]
+
+
+class QueryCounters:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = {}
+        self.errors = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def record(self, endpoint, seconds, error=False):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.errors += int(error)
+            self.latencies.append(seconds)
+
+    def report(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000.0
+            total = sum(self.requests.values())
+            report = {"requests": dict(self.requests), "total": total, "errors": self.errors,
+                      "uptime_s": time.time() - self.started}
+        report["requests_per_s"] = total / max(report["uptime_s"], 1e-9)
+        if len(latencies) > 0:
+            report["latency_ms"] = {"mean": float(latencies.mean()),
+                                    **{"p{}".format(p): float(np.percentile(latencies, p)) for p in (50, 90, 99)},
+                                    "max": float(latencies.max())}
+        return report
+
+
+class ScoreService:
+    # Holds the current ScoreIndex. A new run is indexed on the side and swapped in with one assignment,
+    # requests take the index once and answer from it, so a swap never mixes two runs in one response.
+
+    def __init__(self, roll_file):
+        self.roll_file = roll_file
+        self.lock = threading.Lock()
+        self.counters = QueryCounters()
+        self.swaps = 0
+        self.index = ScoreIndex.from_csv(roll_file)
+        self.signature = file_signature(roll_file)
+
+    def swap(self):
+        # only ever re-reads the file the service was started with
+        with self.lock:
+            signature = file_signature(self.roll_file)
+            index = ScoreIndex.from_csv(self.roll_file)
+            self.index = index
+            self.signature = signature
+            self.swaps += 1
+        return index
+
+    def watch(self, interval=2.0):
+        # reloads the run whenever the file is replaced
+        def poll():
+            while True:
+                time.sleep(interval)
+                try:
+                    if file_signature(self.roll_file) != self.signature:
+                        self.swap()
+                except (OSError, ValueError, pd.errors.ParserError) as ex:
+                    print("reload failed, keeping the current run:", ex)
+
+        thread = threading.Thread(target=poll, daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self):
+        index = self.index
+        return {**self.counters.report(), "run": {"source": index.source, "rows": len(index.records),
+                                                  "loaded_at": index.loaded_at, "swaps": self.swaps}}
+
+    def answer(self, path, params):
+        # (status, body) for one GET request
+        index = self.index
+
+        def arg(name, default=None):
+            return params.get(name, [default])[0]
+
+        limit = arg("limit")
+        limit = None if limit is None else int(limit)
+        if path == "/countries":
+            return 200, json.dumps(index.countries).encode("utf-8")
+        if path == "/ranks":
+            return 200, index.render(index.rank_list(arg("pillar", ""), arg("sub_pillar", ""), arg("indicator", ""),
+                                                     limit))
+        if path == "/top":
+            n = int(arg("n", 10))
+            body = ",".join(json.dumps(pillar) + ":" + index.render(rows).decode("utf-8")
+                            for pillar, rows in index.top(n).items())
+            return 200, ("{" + body + "}").encode("utf-8")
+        if path == "/country":
+            name = arg("name")
+            if name not in index.by_country:
+                return 404, json.dumps({"error": "unknown country: {}".format(name)}).encode("utf-8")
+            return 200, index.render(index.profile(name, arg("indicators", "0") == "1"))
+        if path == "/slice":
+            return 200, index.render(index.slice(arg("country"), arg("pillar"), arg("sub_pillar"),
+                                                 arg("indicator"), arg("level"), limit))
+        if path == "/stats":
+            return 200, json.dumps(self.stats()).encode("utf-8")
+        return 404, json.dumps({"error": "unknown endpoint: {}".format(path)}).encode("utf-8")
+
+
+def make_handler(service: ScoreService):
+
+    class QueryHandler(BaseHTTPRequestHandler):
+
+        def send(self, status, body):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            start = time.perf_counter()
+            url = urlparse(self.path)
+            try:
+                status, body = service.answer(url.path, parse_qs(url.query))
+            except ValueError as ex:
+                status, body = 400, json.dumps({"error": str(ex)}).encode("utf-8")
+            service.counters.record(url.path, time.perf_counter() - start, status >= 400)
+            self.send(status, body)
+
+        def do_POST(self):
+            # POST /reload swaps in the current contents of --roll-file
+            url = urlparse(self.path)
+            if url.path != "/reload":
+                self.send(404, json.dumps({"error": "unknown endpoint: {}".format(url.path)}).encode("utf-8"))
+                return
+            try:
+                index = service.swap()
+            except (OSError, ValueError, pd.errors.ParserError) as ex:
+                self.send(400, json.dumps({"error": str(ex)}).encode("utf-8"))
+                return
+            self.send(200, json.dumps({"source": index.source, "rows": len(index.records)}).encode("utf-8"))
+
+        def log_message(self, format, *args):
+            pass
+
+    return QueryHandler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Read-only HTTP queries over a scoring run")
+    parser.add_argument("--roll-file", default="Processed/Full Data/full_output_rolling.csv",
+                        help="full_output_rolling.csv (or scores.csv) of the run to serve")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--watch", type=float, nargs="?", const=2.0, default=None,
+                        help="reload the run when the file changes, polling every N seconds")
+    args = parser.parse_args()
+
+    score_service = ScoreService(args.roll_file)
+    if args.watch is not None:
+        score_service.watch(args.watch)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(score_service))
+    print("Serving {} on http://{}:{}".format(args.roll_file, args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,294 @@
+import argparse
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from aggregation_cache import file_hash
+from columnar import write_columns
+from profiling import StageProfiler, finish_profile
+
+MANIFEST_FILE = "../data_manifest.csv"
+RAW_DIR = "../data"
+# the JS stage writes ../processed; the mirrors go next to the column stores unless asked for there
+CSV_DIR = "Processed/Raw/csv"
+COLUMNS_DIR = "Processed/Raw"
+STATE_NAME = "manifest.json"
+# bumped whenever conversion changes, so every source is converted again
+INGEST_VERSION = 2
+CONFIG_COLUMNS = ["format", "Excel sheet #", "Excel sheet top row #", "Country Column #", "Year Column #"]
+# lines looked at to find the header of a CSV with preamble lines (World Bank downloads)
+SNIFF_LINES = 50
+ARCHIVE_FORMATS = ["xlsx", "xls", "csv", "tsv", "json"]
+
+
+def manifest_sources(manifest_file=MANIFEST_FILE, raw_dir=RAW_DIR, names=None):
+    # one task per manifest row: name, raw file and the conversion settings of the row
+    manifest = pd.read_csv(manifest_file, dtype=str, keep_default_na=False)
+    sources = []
+    for row in manifest.to_dict("records"):
+        if names is not None and row["name"] not in names:
+            continue
+        config = {column: row.get(column, "").strip() for column in CONFIG_COLUMNS}
+        config = {column: None if value in ("", "NaN", "nan") else value for column, value in config.items()}
+        sources.append({"name": row["name"], "path": os.path.join(raw_dir, "{}.{}".format(row["name"], row["format"])),
+                        "config": config})
+    return sources
+
+
+def column_position(value):
+    # "Country Column #" and "Year Column #" are 1-based numbers or Excel letters
+    if value is None:
+        return None
+    value = str(value).strip()
+    if value.replace(".", "", 1).isdigit():
+        return int(float(value)) - 1
+    position = 0
+    for letter in value.upper():
+        position = position * 26 + ord(letter) - ord("A") + 1
+    return position - 1
+
+
+def config_number(config, column, default):
+    value = config.get(column)
+    if value is None:
+        return default
+    try:
+        return int(float(value))
+    except ValueError:
+        raise ValueError("{} is not a number: {!r}".format(column, value))
+
+
+def check_not_html(data, path):
+    start = data[:512].lstrip().lower()
+    if start.startswith((b"<!doctype", b"<html", b"<?xml")) and b"<html" in data[:2048].lower():
+        raise ValueError("{} is an HTML page, not data (failed download?)".format(path))
+
+
+def decode_text(data):
+    # a few downloads are latin-1
+    try:
+        return data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return data.decode("latin-1")
+
+
+def header_line(text, sep):
+    # the first of the widest lines among the first SNIFF_LINES; preamble lines are narrower
+    lines = text.splitlines()[:SNIFF_LINES]
+    widths = [len(row) for row in csv.reader(lines, delimiter=sep)]
+    return widths.index(max(widths)) if widths else 0
+
+
+def read_delimited(data, path, sep, top_row):
+    # every field is kept as the text it was written as, like the JS stage: "NA" is Namibia, not missing,
+    # and numbers keep their digits
+    check_not_html(data, path)
+    text = decode_text(data)
+    skip = top_row - 1 if top_row is not None else 0
+    try:
+        return pd.read_csv(io.StringIO(text), sep=sep, skiprows=skip, dtype=str, keep_default_na=False)
+    except pd.errors.ParserError:
+        if top_row is not None:
+            raise
+        return pd.read_csv(io.StringIO(text), sep=sep, skiprows=header_line(text, sep), dtype=str,
+                           keep_default_na=False)
+
+
+def read_json(data, path):
+    check_not_html(data, path)
+    loaded = json.loads(decode_text(data))
+    return pd.json_normalize(loaded) if isinstance(loaded, list) else pd.json_normalize([loaded])
+
+
+def read_excel(data, config):
+    # sheet and top row as process_raw_data.js: 1-based, the top row holds the header
+    sheet = config_number(config, "Excel sheet #", 1) - 1
+    top_row = config_number(config, "Excel sheet top row #", 1)
+    return pd.read_excel(io.BytesIO(data), sheet_name=sheet, header=top_row - 1)
+
+
+def read_source(data, path, file_format, config):
+    file_format = file_format.lower()
+    if file_format == "zip":
+        # the first member of a readable format, like the JS stage
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            for member in archive.namelist():
+                extension = member.rsplit(".", 1)[-1].lower()
+                if extension in ARCHIVE_FORMATS:
+                    return read_source(archive.read(member), member, extension, config)
+        raise ValueError("{} has no readable member".format(path))
+    if file_format in ("xlsx", "xls"):
+        return read_excel(data, config)
+    if file_format in ("csv", "tsv"):
+        return read_delimited(data, path, "\t" if file_format == "tsv" else ",",
+                              config_number(config, "Excel sheet top row #", None))
+    if file_format in ("csv.gz", "gz"):
+        return read_delimited(gzip.decompress(data), path, ",", None)
+    if file_format == "json":
+        return read_json(data, path)
+    raise ValueError("Unsupported format {} for {}".format(file_format, path))
+
+
+def tidy_frame(df: pd.DataFrame, config):
+    # string column names plus data_country / data_year when the manifest names those columns
+    df.columns = [str(column) for column in df.columns]
+    for target, column in (("data_country", "Country Column #"), ("data_year", "Year Column #")):
+        position = column_position(config.get(column))
+        if position is not None:
+            if position >= len(df.columns):
+                raise ValueError("{} {} is beyond the {} columns".format(column, config[column], len(df.columns)))
+            df[target] = df.iloc[:, position]
+    # whole-number float columns (Excel and JSON sources) are written as integers
+    for column in df.columns:
+        if df[column].dtype.kind == "f" and is_integral(df[column].to_numpy()):
+            df[column] = df[column].astype("Int64")
+    return df
+
+
+def is_integral(values):
+    finite = values[np.isfinite(values)]
+    return len(finite) > 0 and np.array_equal(finite, np.round(finite)) and np.abs(finite).max() < 2 ** 53
+
+
+def parse_numbers(series: pd.Series):
+    # the column as float64 when every non-blank value is a number, else None. Python's float() keeps every
+    # digit of the text, pandas' fast parsers can be an ulp off.
+    text = series.astype(str).str.strip()
+    blank = series.isna().to_numpy() | (text == "").to_numpy()
+    try:
+        numbers = text[~blank].to_numpy(dtype=object).astype(np.float64)
+    except ValueError:
+        return None
+    values = np.full(len(series.index), np.nan)
+    values[~blank] = numbers
+    return values
+
+
+def typed_frame(df: pd.DataFrame):
+    # text columns holding only numbers become Int64 or float64 for the column store, the rest stay text
+    typed = df.copy()
+    for column in df.columns:
+        if df[column].dtype == object:
+            values = parse_numbers(df[column])
+            if values is not None and not np.isnan(values).all():
+                typed[column] = pd.Series(values, index=df.index).astype("Int64") if is_integral(values) else values
+    return typed
+
+
+def source_hash(source):
+    digest = hashlib.sha256()
+    digest.update(json.dumps([INGEST_VERSION, source["config"]], sort_keys=True).encode("utf-8"))
+    digest.update(file_hash(source["path"]).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def convert_source(source, content_hash, csv_dir, columns_dir):
+    # converts one raw file; runs in a worker process and only returns a small report
+    start = time.perf_counter()
+    name = source["name"]
+    try:
+        with open(source["path"], "rb") as f:
+            data = f.read()
+        df = tidy_frame(read_source(data, source["path"], source["config"]["format"], source["config"]),
+                        source["config"])
+        os.makedirs(csv_dir, exist_ok=True)
+        df.to_csv(os.path.join(csv_dir, name + ".csv"), index=False)
+        write_columns(typed_frame(df), os.path.join(columns_dir, name))
+    except (ValueError, KeyError, IndexError, ImportError, OSError, zipfile.BadZipFile,
+            pd.errors.ParserError, pd.errors.EmptyDataError) as ex:
+        return {"name": name, "status": "failed", "hash": content_hash,
+                "detail": "{}: {}".format(type(ex).__name__, ex), "wall_s": time.perf_counter() - start}
+    return {"name": name, "status": "converted", "hash": content_hash, "rows": len(df.index),
+            "columns": len(df.columns), "wall_s": time.perf_counter() - start}
+
+
+class RawIngest:
+    # Converts every manifest source with a local raw file into <csv_dir>/<name>.csv plus a typed column
+    # store under columns_dir. A source is converted again only when its raw file or its manifest row
+    # changed since the last run; conversions run in worker processes.
+
+    def __init__(self, manifest_file=MANIFEST_FILE, raw_dir=RAW_DIR, csv_dir=CSV_DIR, columns_dir=COLUMNS_DIR):
+        self.manifest_file = manifest_file
+        self.raw_dir = raw_dir
+        self.csv_dir = csv_dir
+        self.columns_dir = columns_dir
+        self.state_path = os.path.join(columns_dir, STATE_NAME)
+        self.state = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, encoding="utf-8") as f:
+                self.state = json.load(f)
+
+    def is_current(self, name, content_hash):
+        entry = self.state.get(name)
+        return entry is not None and entry["hash"] == content_hash and entry["status"] == "converted" and \
+            os.path.exists(os.path.join(self.csv_dir, name + ".csv")) and \
+            os.path.exists(os.path.join(self.columns_dir, name, "schema.json"))
+
+    def run(self, names=None, workers=1, force=False, profiler: StageProfiler = None):
+        profiler = profiler or StageProfiler(enabled=False)
+        run = profiler.run
+        sources = run("read_manifest", manifest_sources, self.manifest_file, self.raw_dir, names)
+
+        report = []
+        tasks = []
+        for source in sources:
+            if not os.path.exists(source["path"]):
+                report.append({"name": source["name"], "status": "missing", "detail": source["path"]})
+                continue
+            content_hash = source_hash(source)
+            if not force and self.is_current(source["name"], content_hash):
+                report.append({"name": source["name"], "status": "unchanged"})
+            else:
+                tasks.append((source, content_hash))
+
+        def convert_all():
+            if workers > 1 and len(tasks) > 1:
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    futures = [executor.submit(convert_source, source, content_hash, self.csv_dir, self.columns_dir)
+                               for source, content_hash in tasks]
+                    return [future.result() for future in futures]
+            return [convert_source(source, content_hash, self.csv_dir, self.columns_dir)
+                    for source, content_hash in tasks]
+
+        converted = run("convert_sources", convert_all)
+        for result in converted:
+            self.state[result["name"]] = {key: value for key, value in result.items() if key != "name"}
+        report.extend(converted)
+
+        os.makedirs(self.columns_dir, exist_ok=True)
+        with open(self.state_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+        order = {source["name"]: position for position, source in enumerate(sources)}
+        return sorted(report, key=lambda item: order[item["name"]])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the raw files of data_manifest.csv into CSV mirrors and column stores")
+    parser.add_argument("--manifest", default=MANIFEST_FILE)
+    parser.add_argument("--raw-dir", default=RAW_DIR)
+    parser.add_argument("--csv-dir", default=CSV_DIR, help="where the CSV mirrors are written, ../processed to replace the JS stage's files")
+    parser.add_argument("--columns-dir", default=COLUMNS_DIR, help="where the column stores are written")
+    parser.add_argument("--sources", nargs="+", default=None, help="only convert these manifest names")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--force", action="store_true", help="convert every source, ignoring the input hashes")
+    parser.add_argument("--profile", nargs="?", const="Processed/Raw/profile_raw_ingest.json", default=None)
+    args = parser.parse_args()
+
+    stage_profiler = StageProfiler(enabled=args.profile is not None)
+    ingest = RawIngest(args.manifest, args.raw_dir, args.csv_dir, args.columns_dir)
+    ingest_report = ingest.run(args.sources, args.workers, args.force, stage_profiler)
+    counts = pd.Series([item["status"] for item in ingest_report], dtype=object).value_counts()
+    for item in ingest_report:
+        if item["status"] in ("failed", "missing"):
+            print(item["name"], ":", item["status"], item["detail"])
+    print(counts.to_dict())
+    finish_profile(stage_profiler, args.profile)
@@ -0,0 +1,245 @@
+import os
+import threading
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from aggregation_cache import file_hash
+from columnar import SCHEMA_FILE, is_column_store, read_columns
+from integer_keys import country_code_map, country_ids, lookup
+from scaling import INDICATOR_KEYS, get_range_lookup
+
+WEIGHTS_FILE = "Weights.csv"
+SOURCES_FILE = "Sources.csv"
+COUNTRIES_FILE = "../data/Countries.csv"
+
+WEIGHT_COLUMNS = INDICATOR_KEYS + ["Weight"]
+SOURCE_COLUMNS = INDICATOR_KEYS + ["Raw/Index", "min", "max", "Data Source", "Data Link"]
+COUNTRY_COLUMNS = ["Country or Area", "UN Member States", "M49 Code"]
+
+ReferenceTables = namedtuple("ReferenceTables", ["weights", "sources", "countries"])
+
+
+def read_table(table):
+    # reference tables and indicator data can be passed as DataFrames, CSV paths or column store directories
+    if isinstance(table, pd.DataFrame):
+        return table.copy()
+    if is_column_store(table):
+        return read_columns(table)
+    return pd.read_csv(table, float_precision="round_trip")
+
+
+def check_columns(df: pd.DataFrame, columns, name):
+    missing = [column for column in columns if column not in df.columns]
+    if missing:
+        raise ValueError("{} is missing columns: {}".format(name, missing))
+
+
+def load_weights(weights_file=WEIGHTS_FILE):
+    weights = read_table(weights_file)
+    check_columns(weights, WEIGHT_COLUMNS, "Weights table")
+    weights["Indicator"] = weights["Indicator"].astype(str)
+    numeric = pd.to_numeric(weights["Weight"], errors="coerce")
+    invalid = numeric.isna() | (numeric < 0)
+    if invalid.any():
+        keys = weights.loc[invalid, INDICATOR_KEYS].to_numpy().tolist()
+        raise ValueError("Weights table has missing or negative weights for: {}".format(keys))
+    return weights.drop_duplicates(INDICATOR_KEYS, keep="first").reset_index(drop=True)
+
+
+def build_weight_index(weights: pd.DataFrame):
+    return {key: w for key, w in zip(map(tuple, weights[INDICATOR_KEYS].to_numpy()), weights["Weight"])}
+
+
+def get_range_info_df(sources_df: pd.DataFrame):
+    sources_df = sources_df[["Pillar", "Sub-Pillar", "Indicator", "Raw/Index", "min", "max"]] \
+        .dropna(subset=["Pillar", "Sub-Pillar", "Indicator"])
+
+    sources_df["Pillar"] = sources_df["Pillar"].astype(str)
+    sources_df["Sub-Pillar"] = sources_df["Sub-Pillar"].astype(str)
+    sources_df["Indicator"] = sources_df["Indicator"].astype(str)
+
+    return sources_df
+
+
+def get_source_data_df(sources_df: pd.DataFrame):
+    return sources_df[["Pillar", "Sub-Pillar", "Indicator", "Data Source", "Data Link"]] \
+        .dropna(subset=["Pillar", "Sub-Pillar", "Indicator"])
+
+
+def load_un_countries(countries_file=COUNTRIES_FILE):
+    if isinstance(countries_file, pd.DataFrame):
+        countries_df = countries_file
+    else:
+        countries_df = pd.read_csv(countries_file)
+    codes = country_code_map(countries_df)
+    countries_df = countries_df[["Country or Area", "UN Member States", "M49 Code"]]
+    countries_df = countries_df.rename(columns={"Country or Area": "Country Name"})
+    countryList = ['Kosovo (UNSCR 1244)']
+
+    for country in countryList:
+        countries_df.loc[len(countries_df.index)] = [country, 'y', codes.get(country, np.nan)]
+
+    # filter UN Member States countries from countries_df
+    un_filter = countries_df["UN Member States"].isin(['x', 'y'])
+    countries_df = countries_df.where(un_filter)
+    countries_df = countries_df.dropna(subset=["Country Name", "UN Member States"])
+
+    return countries_df
+
+
+class WeightsTable:
+
+    def __init__(self, table):
+        self.weights = load_weights(table)
+        self.weight_index = build_weight_index(self.weights)
+
+    def weight(self, pillar, sub_pillar, indicator):
+        return self.weight_index.get((pillar, sub_pillar, indicator))
+
+
+class SourcesTable:
+
+    def __init__(self, table):
+        sources_df = read_table(table)
+        check_columns(sources_df, SOURCE_COLUMNS, "Sources table")
+        self.range_info_df = get_range_info_df(sources_df)
+        self.source_data_df = get_source_data_df(sources_df)
+        self.range_lookup = get_range_lookup(self.range_info_df)
+        # an indicator listed with several sources repeats its rows in add_sources, the lookup only
+        # stands in for the merge when every key has one source
+        self.unique_sources = not self.source_data_df.duplicated(INDICATOR_KEYS).any()
+        first_sources = self.source_data_df.drop_duplicates(INDICATOR_KEYS, keep="first")
+        self.source_lookup = {
+            (pillar, sub_pillar, indicator): (source, link)
+            for pillar, sub_pillar, indicator, source, link in zip(
+                *(first_sources[column] for column in first_sources.columns))
+        }
+
+    def range_info(self, pillar, sub_pillar, indicator):
+        # (Raw/Index, min, max) or None
+        return self.range_lookup.get((pillar, sub_pillar, indicator))
+
+    def source(self, pillar, sub_pillar, indicator):
+        # (Data Source, Data Link) of the first source row or None
+        return self.source_lookup.get((pillar, sub_pillar, indicator))
+
+
+class CountriesTable:
+
+    def __init__(self, countries_df: pd.DataFrame, country_codes=None):
+        # countries_df is the UN member table from load_un_countries; country_codes maps every name of the
+        # raw Countries.csv to its M49 code and defaults to the codes of countries_df
+        self.countries_df = countries_df
+        self.members = countries_df.dropna(subset=["M49 Code"]).drop_duplicates("Country Name", keep="first")
+        self.member_codes = country_code_map(self.members)
+        self.country_codes = self.member_codes if country_codes is None else country_codes
+        self.membership = dict(zip(self.members["Country Name"], self.members["UN Member States"]))
+
+    @classmethod
+    def from_file(cls, table):
+        countries_df = read_table(table)
+        check_columns(countries_df, COUNTRY_COLUMNS, "Countries table")
+        return cls(load_un_countries(countries_df), country_code_map(countries_df))
+
+    def un_membership(self, country):
+        # 'x' for UN Member States, 'y' for the other listed countries, None otherwise
+        return self.membership.get(country)
+
+    def member_column(self, names):
+        # UN Member States value of every name, matched through the M49 ids; the first row of a name wins
+        ids = country_ids(names, self.member_codes)
+        return lookup(ids, self.members["M49 Code"].astype(np.int64), self.members["UN Member States"]
+                      .to_numpy(dtype=object))
+
+
+TABLE_LOADERS = {
+    "weights": WeightsTable,
+    "sources": SourcesTable,
+    "countries": CountriesTable.from_file,
+}
+
+
+def file_signature(path):
+    stat = os.stat(os.path.join(path, SCHEMA_FILE) if is_column_store(path) else path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class ReferenceRegistry:
+    # Parsed reference tables keyed by kind and file path. A table is read, validated and indexed once
+    # and handed out read-only; get() re-stats the file and only reloads it when its contents changed.
+    # DataFrames passed instead of paths are parsed on every call and never cached.
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get(self, kind, source):
+        if source is None:
+            return None
+        if isinstance(source, pd.DataFrame):
+            return TABLE_LOADERS[kind](source)
+
+        key = (kind, os.path.abspath(source))
+        signature = file_signature(source)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry["signature"] == signature:
+                return entry["table"]
+            # a touched but unchanged file keeps its parsed table
+            content_hash = None if os.path.isdir(source) else file_hash(source)
+            if entry is not None and content_hash is not None and entry["hash"] == content_hash:
+                entry["signature"] = signature
+                return entry["table"]
+            table = TABLE_LOADERS[kind](source)
+            self.entries[key] = {"signature": signature, "hash": content_hash, "table": table}
+            return table
+
+    def load(self, weights=WEIGHTS_FILE, sources=SOURCES_FILE, countries=None):
+        return ReferenceTables(self.get("weights", weights), self.get("sources", sources),
+                               self.get("countries", countries))
+
+    def invalidate(self, source=None):
+        # drops one file's entries, or every entry
+        with self.lock:
+            if source is None:
+                self.entries.clear()
+                return
+            path = os.path.abspath(source)
+            for key in [key for key in self.entries if key[1] == path]:
+                del self.entries[key]
+
+
+# one registry per process; worker processes get a copy of the parent's through init_worker
+registry = ReferenceRegistry()
+worker_state = {}
+
+
+def default_registry():
+    return registry
+
+
+def reference_table(kind, source):
+    return registry.get(kind, source)
+
+
+def init_worker(parent_registry, shared=None):
+    # ProcessPoolExecutor initializer: the parent's parsed tables and any other read-only objects are
+    # pickled once per worker, tasks then only carry their own arguments
+    global registry
+    registry = parent_registry
+    worker_state.update(shared or {})
+
+
+def worker_object(name):
+    return worker_state[name]
@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+
+INDICATOR_KEYS = ["Pillar", "Sub-Pillar", "Indicator"]
+
+BAND_QUANTILES = np.array([0.2, 0.4, 0.6, 0.8, 1.0])
+BAND_RANGES = [(1, 1.99), (2, 2.99), (3, 3.99), (4, 4.99), (5, 5.99)]
+# the upper three bands are fitted with an extra (max - 1) point when all their values are equal
+BAND_PAD_DEGENERATE = [False, False, True, True, True]
+
+
+def min_max_params(data_min, data_max, range_min, range_max):
+    # same arithmetic as sklearn's MinMaxScaler, so scores are bit-for-bit identical
+    data_range = data_max - data_min
+    if data_range < 10 * np.finfo(np.float64).eps:
+        data_range = 1.0
+    scale = (range_max - range_min) / data_range
+    return scale, range_min - data_min * scale
+
+
+def get_range_lookup(sources_df: pd.DataFrame):
+    # (Pillar, Sub-Pillar, Indicator) -> (Raw/Index, min, max), first row wins
+    sources_df = sources_df.drop_duplicates(INDICATOR_KEYS, keep="first")
+    return {
+        (pillar, sub_pillar, indicator): (ind_type, range_min, range_max)
+        for pillar, sub_pillar, indicator, ind_type, range_min, range_max in zip(
+            sources_df["Pillar"], sources_df["Sub-Pillar"], sources_df["Indicator"],
+            sources_df["Raw/Index"], sources_df["min"], sources_df["max"])
+    }
+
+
+def get_fixed_range(range_info):
+    if range_info is None or range_info[0] != "Index":
+        return None
+    range_min, range_max = range_info[1], range_info[2]
+    if pd.isna(range_min) or pd.isna(range_max) or range_min == "" or range_max == "":
+        return None
+    return int(range_min), int(range_max)
+
+
+def fit_bands(sorted_vals):
+    # sorted_vals holds one group's non-NaN values in ascending order;
+    # returns (start, end, scale, offset) for every non-empty band
+    thresholds = np.percentile(sorted_vals, BAND_QUANTILES * 100.0)
+    cuts = np.concatenate(([0], np.searchsorted(sorted_vals, thresholds[:4], side="left"), [len(sorted_vals)]))
+
+    bands = []
+    for band in range(len(BAND_RANGES)):
+        start, end = cuts[band], cuts[band + 1]
+        if start >= end:
+            continue
+        data_min, data_max = sorted_vals[start], sorted_vals[end - 1]
+        if BAND_PAD_DEGENERATE[band] and data_min == data_max:
+            data_min = data_max - 1
+        scale, offset = min_max_params(data_min, data_max, *BAND_RANGES[band])
+        bands.append((start, end, scale, offset))
+    return bands
+
+
+def scale_indicator_scores(df: pd.DataFrame, sources_df, min_val, max_val):
+    # sources_df is the range info table or a lookup already built from it with get_range_lookup
+    range_lookup = sources_df if isinstance(sources_df, dict) else get_range_lookup(sources_df)
+
+    values = df["data_col"].to_numpy(dtype=np.float64)
+    scores = np.full(len(values), np.nan)
+
+    valid = df[INDICATOR_KEYS].notna().all(axis=1).to_numpy()
+    rows = np.flatnonzero(valid)
+    if len(rows) == 0:
+        return scores
+
+    key_df = df.iloc[rows][INDICATOR_KEYS]
+    codes = key_df.groupby(INDICATOR_KEYS, sort=False).ngroup().to_numpy()
+    _, first_rows = np.unique(codes, return_index=True)
+    group_keys = [tuple(key) for key in key_df.iloc[first_rows].to_numpy()]
+
+    # a single sort orders every group by value, NaNs last within their group
+    order = np.lexsort((values[rows], codes))
+    sorted_rows = rows[order]
+    sorted_codes = codes[order]
+    sorted_vals = values[sorted_rows]
+    sorted_nan = np.isnan(sorted_vals)
+
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    ends = np.r_[starts[1:], len(sorted_codes)]
+
+    pos_scale = np.full(len(sorted_vals), np.nan)
+    pos_offset = np.full(len(sorted_vals), np.nan)
+
+    for start, end in zip(starts, ends):
+        key = group_keys[sorted_codes[start]]
+        n_valid = end - start - np.count_nonzero(sorted_nan[start:end])
+        group_vals = sorted_vals[start:start + n_valid]
+
+        fixed_range = get_fixed_range(range_lookup.get(key))
+        if fixed_range is not None:
+            data_min = min(fixed_range)
+            data_max = max(fixed_range)
+            if n_valid > 0:
+                data_min = min(data_min, group_vals[0])
+                data_max = max(data_max, group_vals[-1])
+            scale, offset = min_max_params(data_min, data_max, min_val, max_val)
+            pos_scale[start:end] = scale
+            pos_offset[start:end] = offset
+        elif n_valid > 0:
+            for band_start, band_end, scale, offset in fit_bands(group_vals):
+                pos_scale[start + band_start:start + band_end] = scale
+                pos_offset[start + band_start:start + band_end] = offset
+
+    scores[sorted_rows] = sorted_vals * pos_scale + pos_offset
+    return scores
@@ -0,0 +1,188 @@
+import copy
+
+import numpy as np
+import pandas as pd
+
+from integer_keys import combined_key, first_rows
+
+
+def first_value_matrix(shape, row_ids, col_ids, values):
+    # dense (rows x cols) matrix holding the first value seen for every (row, col) pair, NaN elsewhere
+    matrix = np.full(shape, np.nan)
+    matrix[row_ids[::-1], col_ids[::-1]] = np.asarray(values, dtype=np.float64)[::-1]
+    return matrix
+
+
+# pillar and country scores used to be object columns, which pandas ranks as tied when two scores are
+# within 1e-13; their ranks keep that tolerance so scores an ulp apart still share a rank
+RANK_TOLERANCE = 1e-13
+
+
+def sequential_sums(values, group_codes, n_groups):
+    # sum of values per group, added one row at a time in row order like a Python loop over each group;
+    # any other order can move the sum by an ulp. Step k adds the k-th row of every group. values may have
+    # leading scenario axes, rows are along the last one.
+    sums = np.zeros(values.shape[:-1] + (n_groups,))
+    if len(group_codes) == 0:
+        return sums
+    position = pd.Series(group_codes).groupby(group_codes).cumcount().to_numpy()
+    order = np.argsort(position, kind="stable")
+    bounds = np.searchsorted(position[order], np.arange(position.max() + 2))
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        rows = order[start:stop]
+        sums[..., group_codes[rows]] += values[..., rows]
+    return sums
+
+
+def pillar_order(country_ids, pillar_ids):
+    # (country, pillar) of every country pillar, in the order of their first rows
+    rows = first_rows(combined_key(country_ids, pillar_ids))
+    return country_ids[rows], pillar_ids[rows]
+
+
+def rank_batched(scores, ranked, tolerance=0.0):
+    # scores is (scenarios, countries, columns); every (scenario, column) is ranked over the countries
+    # in `ranked` only, highest first, ties share the lowest rank like pandas' rank(method="min"). Sorted
+    # neighbours at most `tolerance` apart are ties, as pandas compares them for object columns.
+    negated = np.where(ranked[None, :, None], -scores, np.nan)
+    order = np.argsort(negated, axis=1, kind="stable")
+    sorted_scores = np.take_along_axis(negated, order, axis=1)
+
+    position = np.arange(scores.shape[1])[None, :, None]
+    new_value = np.ones(sorted_scores.shape, dtype=bool)
+    if tolerance > 0:
+        new_value[:, 1:] = ~(np.abs(sorted_scores[:, 1:] - sorted_scores[:, :-1]) <= tolerance)
+    else:
+        new_value[:, 1:] = sorted_scores[:, 1:] != sorted_scores[:, :-1]
+    sorted_ranks = np.maximum.accumulate(np.where(new_value, position, 0), axis=1) + 1.0
+    sorted_ranks[np.isnan(sorted_scores)] = np.nan
+
+    ranks = np.empty(sorted_ranks.shape)
+    np.put_along_axis(ranks, order, sorted_ranks, axis=1)
+    return ranks
+
+
+def rank_columns(scores, eligible, tolerance=0.0):
+    # rank every column on its own, highest score first, ties share the lowest rank (method="min");
+    # rows that are not eligible or have no score get NaN
+    return rank_batched(scores[None], eligible, tolerance)[0]
+
+
+def factorize_level(df: pd.DataFrame, id_column, label_columns):
+    # ids in order of first appearance plus the labels of every id; factorizes the integer id column
+    # when the frame has one (ScoringEngine.prepare adds them) and the label strings otherwise
+    if id_column not in df.columns:
+        if len(label_columns) == 1:
+            return pd.factorize(df[label_columns[0]])
+        return pd.factorize(pd.MultiIndex.from_frame(df[label_columns]))
+    ids, _ = pd.factorize(df[id_column])
+    _, first = np.unique(ids, return_index=True)
+    labels = df[label_columns].iloc[first]
+    if len(label_columns) == 1:
+        return ids, pd.Index(labels[label_columns[0]].to_numpy(), name=None)
+    return ids, pd.MultiIndex.from_frame(labels, names=[None] * len(label_columns))
+
+
+def to_int_ranks(ranks):
+    return pd.Series(ranks).astype("Int64").array
+
+
+class ScoreCube:
+    # Country x sub-pillar / country x pillar / country score arrays for one scored frame.
+    # Rows of the frame are mapped onto the arrays with integer ids, so ranks and scores can be
+    # broadcast back onto the long frame without merges.
+
+    def __init__(self, df: pd.DataFrame, pillar_count=None):
+        self.country_ids, self.countries = factorize_level(df, "country_id", ["Country Name"])
+        self.pillar_ids, self.pillars = factorize_level(df, "pillar_id", ["Pillar"])
+        self.sub_pillar_ids, self.sub_pillars = factorize_level(df, "sub_pillar_id", ["Pillar", "Sub-Pillar"])
+
+        n_countries = len(self.countries)
+        self.pillar_count = len(self.pillars) if pillar_count is None else pillar_count
+
+        un_members = np.empty(n_countries, dtype=object)
+        un_members[self.country_ids[::-1]] = df["UN Member States"].to_numpy()[::-1]
+        self.un_members = un_members
+        # only UN Member States marked 'x' take part in the rankings
+        self.ranked = un_members == "x"
+
+        self.sub_pillar_score = first_value_matrix((n_countries, len(self.sub_pillars)), self.country_ids,
+                                                   self.sub_pillar_ids, df["country_sub_pillar_score"])
+        self.pillar_score = first_value_matrix((n_countries, len(self.pillars)), self.country_ids,
+                                               self.pillar_ids, df["country_pillar_score"])
+        self.pillar_availability = first_value_matrix((n_countries, len(self.pillars)), self.country_ids,
+                                                      self.pillar_ids, df["country_pillar_availability"])
+
+        self.pillar_order = pillar_order(self.country_ids, self.pillar_ids)
+
+        self.sub_pillar_rank = rank_columns(self.sub_pillar_score, self.ranked)
+        self.pillar_rank = rank_columns(self.pillar_score, self.ranked, RANK_TOLERANCE)
+        self.score_countries()
+
+    def score_countries(self):
+        # overall score is the plain mean of the pillars a country has a score for, summed in the order
+        # the country's pillars appear in the frame
+        n_pillars = np.count_nonzero(~np.isnan(self.pillar_score), axis=1)
+        countries, pillars = self.pillar_order
+        scores = self.pillar_score[countries, pillars]
+        scored = ~np.isnan(scores)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.country_score = sequential_sums(scores[scored], countries[scored], len(self.countries)) / n_pillars
+        self.country_score[n_pillars == 0] = np.nan
+        self.country_availability = (n_pillars / self.pillar_count) * 100
+        self.country_rank = rank_columns(self.country_score[:, None], self.ranked, RANK_TOLERANCE)[:, 0]
+
+    def refreshed(self, df: pd.DataFrame, sub_pillars, pillars):
+        # Copy of the cube for a frame that only differs from the one this cube was built from inside the
+        # given sub-pillars and pillars. Only columns whose scores moved are re-ranked. Returns None when
+        # the frame's countries, membership or hierarchy differ, a full rebuild is needed then.
+        cube = copy.copy(self)
+        cube.country_ids, countries = factorize_level(df, "country_id", ["Country Name"])
+        cube.pillar_ids, pillar_labels = factorize_level(df, "pillar_id", ["Pillar"])
+        cube.sub_pillar_ids, sub_pillar_labels = factorize_level(df, "sub_pillar_id", ["Pillar", "Sub-Pillar"])
+        if not (countries.equals(self.countries) and pillar_labels.equals(self.pillars)
+                and sub_pillar_labels.equals(self.sub_pillars)):
+            return None
+        cube.pillar_order = pillar_order(cube.country_ids, cube.pillar_ids)
+        un_members = np.empty(len(countries), dtype=object)
+        un_members[cube.country_ids[::-1]] = df["UN Member States"].to_numpy()[::-1]
+        if not np.array_equal(un_members, self.un_members):
+            return None
+
+        sub_columns = self.sub_pillars.get_indexer(pd.MultiIndex.from_tuples(list(sub_pillars))) \
+            if len(sub_pillars) > 0 else np.array([], dtype=int)
+        pillar_columns = self.pillars.get_indexer(list(pillars))
+
+        cube.sub_pillar_score, cube.sub_pillar_rank, _ = self.refresh_columns(
+            cube, self.sub_pillar_score, self.sub_pillar_rank, cube.sub_pillar_ids, sub_columns,
+            df["country_sub_pillar_score"])
+        cube.pillar_score, cube.pillar_rank, pillars_moved = self.refresh_columns(
+            cube, self.pillar_score, self.pillar_rank, cube.pillar_ids, pillar_columns, df["country_pillar_score"],
+            RANK_TOLERANCE)
+        cube.pillar_availability = self.pillar_availability.copy()
+        cube.pillar_availability[:, pillar_columns] = first_value_matrix(
+            self.pillar_availability.shape, cube.country_ids, cube.pillar_ids,
+            df["country_pillar_availability"])[:, pillar_columns]
+
+        if pillars_moved:
+            cube.score_countries()
+        return cube
+
+    def refresh_columns(self, cube, old_scores, old_ranks, col_ids, columns, values, tolerance=0.0):
+        scores = old_scores.copy()
+        scores[:, columns] = first_value_matrix(scores.shape, cube.country_ids, col_ids, values)[:, columns]
+        moved = [c for c in columns if not np.array_equal(scores[:, c], old_scores[:, c], equal_nan=True)]
+        ranks = old_ranks
+        if moved:
+            ranks = old_ranks.copy()
+            ranks[:, moved] = rank_columns(scores[:, moved], self.ranked, tolerance)
+        return scores, ranks, moved
+
+    def country_index(self, names):
+        return self.countries.get_indexer(names)
+
+    def sub_pillar_rank_column(self):
+        return to_int_ranks(self.sub_pillar_rank[self.country_ids, self.sub_pillar_ids])
+
+    def pillar_rank_column(self):
+        return to_int_ranks(self.pillar_rank[self.country_ids, self.pillar_ids])
@@ -0,0 +1,173 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+
+import pandas as pd
+
+from query_service import LABEL_COLUMNS, json_value, row_level
+
+MANIFEST_NAME = "manifest.json"
+
+
+def shard_name(label, taken):
+    # file-system safe, stable name for a country or pillar; clashes get a numeric suffix
+    base = re.sub(r"[^a-z0-9]+", "-", label.lower()).strip("-") or "shard"
+    name = base
+    suffix = 2
+    while name in taken:
+        name = "{}-{}".format(base, suffix)
+        suffix += 1
+    taken.add(name)
+    return name
+
+
+def level_node(record):
+    return {"score": record["new_rank_score"], "rank": record["rank"], "data_availability": record["data_availability"]}
+
+
+def country_trees(roll_df: pd.DataFrame):
+    # country -> pillar -> sub-pillar -> indicator tree of every country, in roll order
+    df = roll_df.reset_index(drop=True).copy()
+    for column in LABEL_COLUMNS:
+        df[column] = df[column].fillna("").astype(str)
+    levels = row_level(df)
+
+    trees = {}
+    pillar_nodes = {}
+    sub_pillar_nodes = {}
+
+    def tree(country):
+        if country not in trees:
+            trees[country] = {"country": country, "score": None, "rank": None, "data_availability": None,
+                              "pillars": []}
+        return trees[country]
+
+    def pillar(country, name):
+        key = (country, name)
+        if key not in pillar_nodes:
+            pillar_nodes[key] = {"pillar": name, "score": None, "rank": None, "data_availability": None,
+                                 "sub_pillars": []}
+            tree(country)["pillars"].append(pillar_nodes[key])
+        return pillar_nodes[key]
+
+    def sub_pillar(country, pillar_name, name):
+        key = (country, pillar_name, name)
+        if key not in sub_pillar_nodes:
+            sub_pillar_nodes[key] = {"sub_pillar": name, "score": None, "rank": None, "data_availability": None,
+                                     "indicators": []}
+            pillar(country, pillar_name)["sub_pillars"].append(sub_pillar_nodes[key])
+        return sub_pillar_nodes[key]
+
+    columns = list(df.columns)
+    for level, row in zip(levels, df.itertuples(index=False)):
+        record = dict(zip(columns, map(json_value, row)))
+        country = record["Country Name"]
+        if level == 0:
+            tree(country).update(level_node(record))
+        elif level == 1:
+            pillar(country, record["Pillar"]).update(level_node(record))
+        elif level == 2:
+            sub_pillar(country, record["Pillar"], record["Sub-Pillar"]).update(level_node(record))
+        else:
+            sub_pillar(country, record["Pillar"], record["Sub-Pillar"])["indicators"].append({
+                "indicator": record["Indicator"],
+                "value": record["data_col"],
+                "higher_is_better": record["higher_is_better"],
+                "score": record["new_rank_score"],
+                "year": record["Year"],
+                "source": record["Data Source"],
+                "link": record["Data Link"],
+            })
+    return trees
+
+
+def pillar_leaderboards(roll_df: pd.DataFrame):
+    # ranked countries of the overall index and of every pillar, with the pillar's sub-pillar leaderboards
+    df = roll_df.copy()
+    for column in LABEL_COLUMNS:
+        df[column] = df[column].fillna("").astype(str)
+    df = df[df["Indicator"] == ""]
+    df = df.sort_values(["rank", "new_rank_score"], ascending=[True, False], na_position="last", kind="stable")
+
+    def board(rows):
+        return [{"country": country, "score": json_value(score), "rank": json_value(rank),
+                 "data_availability": json_value(availability)}
+                for country, score, rank, availability in zip(rows["Country Name"], rows["new_rank_score"],
+                                                              rows["rank"], rows["data_availability"])]
+
+    boards = {"Overall": {"pillar": "Overall", "leaderboard": board(df[df["Pillar"] == ""]), "sub_pillars": {}}}
+    for name, rows in df[df["Pillar"] != ""].groupby("Pillar", sort=False):
+        sub_rows = rows[rows["Sub-Pillar"] != ""]
+        boards[name] = {
+            "pillar": name,
+            "leaderboard": board(rows[rows["Sub-Pillar"] == ""]),
+            "sub_pillars": {sub_name: board(sub) for sub_name, sub in sub_rows.groupby("Sub-Pillar", sort=False)},
+        }
+    return boards
+
+
+class ShardWriter:
+    # Writes one compact JSON file per country and per pillar into output_dir plus manifest.json with the
+    # sha256 of every shard; shards whose content did not change since the last export are not rewritten.
+
+    def __init__(self, output_dir="Processed/Shards"):
+        self.output_dir = output_dir
+        self.manifest = {"countries": {}, "pillars": {}}
+        manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, encoding="utf-8") as f:
+                self.manifest = json.load(f)
+
+    def write_group(self, kind, shards):
+        os.makedirs(os.path.join(self.output_dir, kind), exist_ok=True)
+        previous = self.manifest.get(kind, {})
+        entries = {}
+        taken = set()
+        written = 0
+        for label, shard in shards.items():
+            body = json.dumps(shard, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            digest = hashlib.sha256(body).hexdigest()
+            file_name = os.path.join(kind, shard_name(label, taken) + ".json")
+            path = os.path.join(self.output_dir, file_name)
+            old = previous.get(label)
+            if old is None or old["hash"] != digest or old["file"] != file_name or not os.path.exists(path):
+                with open(path, "wb") as f:
+                    f.write(body)
+                written += 1
+            entries[label] = {"file": file_name, "hash": digest, "bytes": len(body)}
+
+        # shards of countries or pillars that left the run
+        for label, old in previous.items():
+            if label not in entries and old["file"] not in {entry["file"] for entry in entries.values()}:
+                stale = os.path.join(self.output_dir, old["file"])
+                if os.path.exists(stale):
+                    os.remove(stale)
+        self.manifest[kind] = entries
+        return written
+
+    def write(self, roll_df: pd.DataFrame):
+        written = {
+            "countries": self.write_group("countries", country_trees(roll_df)),
+            "pillars": self.write_group("pillars", pillar_leaderboards(roll_df)),
+        }
+        with open(os.path.join(self.output_dir, MANIFEST_NAME), "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=2)
+        return {kind: {"written": count, "total": len(self.manifest[kind])} for kind, count in written.items()}
+
+
+def save_shards(roll_file="Processed/Full Data/full_output_rolling.csv", output_dir="Processed/Shards"):
+    # shards are built from the saved CSV, so an export from a fresh run and one from an existing file of the
+    # same run give the same bytes and hashes; floats are parsed round-trip exact so they match the file
+    roll_df = roll_file if isinstance(roll_file, pd.DataFrame) else pd.read_csv(roll_file, float_precision="round_trip")
+    return ShardWriter(output_dir).write(roll_df)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-country and per-pillar JSON shards of a scoring run")
+    parser.add_argument("--roll-file", default="Processed/Full Data/full_output_rolling.csv")
+    parser.add_argument("--output-dir", default="Processed/Shards")
+    args = parser.parse_args()
+
+    print(save_shards(args.roll_file, args.output_dir))
@@ -0,0 +1,268 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from process_aggr import SUB_PILLAR_WEIGHT_KEY, ScoringEngine
+from profiling import StageProfiler, finish_profile
+from scaling import INDICATOR_KEYS
+from score_cube import RANK_TOLERANCE, pillar_order, rank_batched, sequential_sums
+
+
+def incidence(child_parent, n_parents):
+    matrix = np.zeros((len(child_parent), n_parents))
+    matrix[np.arange(len(child_parent)), child_parent] = 1.0
+    return matrix
+
+
+class IndicatorMatrix:
+    # Country x indicator view of scored rows. Indicator scores do not depend on the weights, so every
+    # weight configuration is a pair of matrix products over these arrays:
+    #   sub-pillar = (score_sum @ (w * A)) / (count @ (w * A)), pillar likewise over sub-pillars.
+
+    def __init__(self, scored_df: pd.DataFrame, weight_index):
+        # rows without a full hierarchy key never reach a group in the row-wise roll-up either
+        scored_df = scored_df.dropna(subset=["Country Name"] + INDICATOR_KEYS)
+        self.row_index = scored_df.index
+        self.country_ids, self.countries = pd.factorize(scored_df["Country Name"])
+        self.indicator_ids, self.indicators = pd.factorize(pd.MultiIndex.from_frame(scored_df[INDICATOR_KEYS]))
+        sub_ids, self.sub_pillars = pd.factorize(self.indicators.droplevel(2))
+        pillar_ids, self.pillars = pd.factorize(self.sub_pillars.get_level_values(0))
+        self.indicator_sub_pillar = sub_ids
+        self.sub_pillar_pillar = pillar_ids
+        # overall scores add a country's pillars in the order its rows reach them, as ScoreCube does
+        self.pillar_order = pillar_order(self.country_ids, pillar_ids[sub_ids[self.indicator_ids]])
+
+        n_countries, n_indicators = len(self.countries), len(self.indicators)
+        self.shape = (n_countries, n_indicators)
+        self.row_cells = self.country_ids * n_indicators + self.indicator_ids
+        self.score_sum, self.count, self.nan_count = self.accumulate(scored_df["indicator_score"])
+
+        self.indicator_incidence = incidence(self.indicator_sub_pillar, len(self.sub_pillars))
+        self.sub_pillar_incidence = incidence(self.sub_pillar_pillar, len(self.pillars))
+
+        un_members = np.empty(n_countries, dtype=object)
+        un_members[self.country_ids[::-1]] = scored_df["UN Member States"].to_numpy()[::-1]
+        self.ranked = un_members == "x"
+
+        self.base_indicator_weights = np.array([weight_index[key] for key in self.indicators], dtype=np.float64)
+        self.base_sub_pillar_weights = np.array(
+            [weight_index[(pillar, sub_pillar, SUB_PILLAR_WEIGHT_KEY)] for pillar, sub_pillar in self.sub_pillars],
+            dtype=np.float64)
+
+    def accumulate(self, scores):
+        # several rows (years) of the same country and indicator each count once, as in the row-wise mean
+        scores = np.asarray(scores, dtype=np.float64)
+        missing = np.isnan(scores)
+        size = self.shape[0] * self.shape[1]
+        score_sum = np.bincount(self.row_cells, weights=np.where(missing, 0.0, scores), minlength=size)
+        count = np.bincount(self.row_cells, minlength=size).astype(np.float64)
+        nan_count = np.bincount(self.row_cells, weights=missing.astype(np.float64), minlength=size)
+        return score_sum.reshape(self.shape), count.reshape(self.shape), nan_count.reshape(self.shape)
+
+    def roll_up(self, indicator_weights, sub_pillar_weights, score_sum=None, count=None, nan_count=None):
+        # indicator_weights (K, indicators), sub_pillar_weights (K, sub-pillars); the data arrays are
+        # (countries, indicators) or (K, countries, indicators) for per-scenario resampled data
+        score_sum = self.score_sum if score_sum is None else score_sum
+        count = self.count if count is None else count
+        nan_count = self.nan_count if nan_count is None else nan_count
+
+        weighted_incidence = indicator_weights[:, :, None] * self.indicator_incidence[None]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sub_scores = (score_sum @ weighted_incidence) / (count @ weighted_incidence)
+        sub_present = (count @ self.indicator_incidence) > 0
+        sub_missing = (nan_count @ self.indicator_incidence) > 0
+        sub_scores = np.where(sub_present & ~sub_missing, sub_scores, np.nan)
+        sub_present = np.broadcast_to(sub_present, sub_scores.shape)
+
+        weighted_incidence = sub_pillar_weights[:, :, None] * self.sub_pillar_incidence[None]
+        sub_nan = (sub_present & np.isnan(sub_scores)).astype(np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            pillar_scores = (np.where(sub_present, np.nan_to_num(sub_scores), 0.0) @ weighted_incidence) / \
+                            (sub_present.astype(np.float64) @ weighted_incidence)
+        pillar_present = (sub_present.astype(np.float64) @ self.sub_pillar_incidence) > 0
+        pillar_missing = (sub_nan @ self.sub_pillar_incidence) > 0
+        pillar_scores = np.where(pillar_present & ~pillar_missing, pillar_scores, np.nan)
+
+        # overall score is the plain mean of the pillars that have a score
+        n_pillars = np.count_nonzero(~np.isnan(pillar_scores), axis=2)
+        countries, pillars = self.pillar_order
+        pillar_sums = sequential_sums(np.nan_to_num(pillar_scores[..., countries, pillars]), countries,
+                                      len(self.countries))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            country_scores = pillar_sums / n_pillars
+        country_scores[n_pillars == 0] = np.nan
+
+        return sub_scores, pillar_scores, country_scores
+
+
+class SweepResult:
+
+    def __init__(self, matrix: IndicatorMatrix, names, sub_scores, pillar_scores, country_scores):
+        self.matrix = matrix
+        self.names = list(names)
+        self.sub_scores = sub_scores
+        self.pillar_scores = pillar_scores
+        self.country_scores = country_scores
+        self.sub_ranks = rank_batched(sub_scores, matrix.ranked)
+        self.pillar_ranks = rank_batched(pillar_scores, matrix.ranked, RANK_TOLERANCE)
+        self.country_ranks = rank_batched(country_scores[:, :, None], matrix.ranked, RANK_TOLERANCE)[:, :, 0]
+
+    def levels(self):
+        m = self.matrix
+        sub_labels = [(p, s) for p, s in m.sub_pillars]
+        pillar_labels = [(p, "") for p in m.pillars]
+        return [
+            ("sub_pillar", self.sub_scores, self.sub_ranks, sub_labels),
+            ("pillar", self.pillar_scores, self.pillar_ranks, pillar_labels),
+            ("country", self.country_scores[:, :, None], self.country_ranks[:, :, None], [("", "")]),
+        ]
+
+    def to_long_frame(self):
+        frames = []
+        countries = np.asarray(self.matrix.countries, dtype=object)
+        for level, scores, ranks, labels in self.levels():
+            n_scenarios, n_countries, n_columns = scores.shape
+            scenario, country, column = np.indices(scores.shape).reshape(3, -1)
+            frames.append(pd.DataFrame({
+                "scenario": np.asarray(self.names, dtype=object)[scenario],
+                "level": level,
+                "Country Name": countries[country],
+                "Pillar": [labels[c][0] for c in column],
+                "Sub-Pillar": [labels[c][1] for c in column],
+                "score": scores.reshape(-1),
+                "rank": pd.array(ranks.reshape(-1)).astype("Int64"),
+            }).dropna(subset=["score"]))
+        return pd.concat(frames, ignore_index=True)
+
+    def rank_stability(self, base_scenario=0):
+        # spread of every ranked country's rank over all scenarios, per level
+        frames = []
+        countries = np.asarray(self.matrix.countries, dtype=object)
+        ranked = self.matrix.ranked
+        for level, scores, ranks, labels in self.levels():
+            base = ranks[base_scenario]
+            has_rank = ~np.isnan(ranks)
+            n_ranked = has_rank.sum(axis=0)
+            keep = ranked[:, None] & (n_ranked > 0)
+            country, column = np.nonzero(keep)
+            with np.errstate(invalid="ignore"):
+                percentiles = np.nanpercentile(ranks, [5, 50, 95], axis=0)
+                same = np.where(has_rank, ranks == base[None], False).sum(axis=0) / np.maximum(n_ranked, 1)
+            frames.append(pd.DataFrame({
+                "level": level,
+                "Country Name": countries[country],
+                "Pillar": [labels[c][0] for c in column],
+                "Sub-Pillar": [labels[c][1] for c in column],
+                "base_rank": base[country, column],
+                "min_rank": np.nanmin(ranks, axis=0)[country, column],
+                "p5_rank": percentiles[0][country, column],
+                "median_rank": percentiles[1][country, column],
+                "p95_rank": percentiles[2][country, column],
+                "max_rank": np.nanmax(ranks, axis=0)[country, column],
+                "mean_rank": np.nanmean(ranks, axis=0)[country, column],
+                "std_rank": np.nanstd(ranks, axis=0)[country, column],
+                "share_same_rank": same[country, column],
+            }))
+        return pd.concat(frames, ignore_index=True)
+
+    def save(self, output_dir, long_csv=False):
+        os.makedirs(output_dir, exist_ok=True)
+        m = self.matrix
+        np.savez_compressed(
+            os.path.join(output_dir, "sweep_scores.npz"),
+            scenarios=np.asarray(self.names, dtype=str),
+            countries=np.asarray(m.countries, dtype=str),
+            pillars=np.asarray(m.pillars, dtype=str),
+            sub_pillars=np.asarray(["{}|{}".format(p, s) for p, s in m.sub_pillars], dtype=str),
+            sub_pillar_scores=self.sub_scores, sub_pillar_ranks=self.sub_ranks,
+            pillar_scores=self.pillar_scores, pillar_ranks=self.pillar_ranks,
+            country_scores=self.country_scores, country_ranks=self.country_ranks,
+        )
+        self.rank_stability().to_csv(os.path.join(output_dir, "rank_stability.csv"), index=False)
+        if long_csv:
+            self.to_long_frame().to_csv(os.path.join(output_dir, "sweep_scores.csv"), index=False)
+
+
+class WeightSweep:
+
+    def __init__(self, engine: ScoringEngine, indicator_data, profiler: StageProfiler = None):
+        scored_df = engine.indicator_scores(indicator_data, profiler)
+        self.matrix = IndicatorMatrix(scored_df, engine.weight_index)
+
+    def weights_from_frame(self, scenarios_df: pd.DataFrame):
+        # scenarios_df has Weights.csv columns plus 'scenario'; rows override the base weights
+        m = self.matrix
+        indicator_pos = {key: i for i, key in enumerate(m.indicators)}
+        sub_pillar_pos = {key: i for i, key in enumerate(m.sub_pillars)}
+        names = list(pd.unique(scenarios_df["scenario"]))
+        indicator_weights = np.tile(m.base_indicator_weights, (len(names), 1))
+        sub_pillar_weights = np.tile(m.base_sub_pillar_weights, (len(names), 1))
+        scenario_pos = {name: k for k, name in enumerate(names)}
+
+        scenarios_df = scenarios_df.assign(Indicator=scenarios_df["Indicator"].astype(str))
+        for name, pillar, sub_pillar, indicator, weight in scenarios_df[
+                ["scenario", "Pillar", "Sub-Pillar", "Indicator", "Weight"]].itertuples(index=False):
+            k = scenario_pos[name]
+            if indicator == SUB_PILLAR_WEIGHT_KEY:
+                if (pillar, sub_pillar) in sub_pillar_pos:
+                    sub_pillar_weights[k, sub_pillar_pos[(pillar, sub_pillar)]] = weight
+            elif (pillar, sub_pillar, indicator) in indicator_pos:
+                indicator_weights[k, indicator_pos[(pillar, sub_pillar, indicator)]] = weight
+        return names, indicator_weights, sub_pillar_weights
+
+    def random_weights(self, n_scenarios, spread=0.5, seed=0):
+        # multiply every base weight by a factor drawn uniformly from [1 - spread, 1 + spread]
+        m = self.matrix
+        rng = np.random.default_rng(seed)
+        indicator_weights = m.base_indicator_weights * rng.uniform(1 - spread, 1 + spread,
+                                                                   (n_scenarios, len(m.indicators)))
+        sub_pillar_weights = m.base_sub_pillar_weights * rng.uniform(1 - spread, 1 + spread,
+                                                                     (n_scenarios, len(m.sub_pillars)))
+        names = ["random_{}".format(k) for k in range(n_scenarios)]
+        return names, indicator_weights, sub_pillar_weights
+
+    def run(self, names, indicator_weights, sub_pillar_weights, include_base=True, block_size=256):
+        m = self.matrix
+        if include_base:
+            names = ["base"] + list(names)
+            indicator_weights = np.vstack([m.base_indicator_weights, indicator_weights])
+            sub_pillar_weights = np.vstack([m.base_sub_pillar_weights, sub_pillar_weights])
+
+        # scenarios are evaluated in blocks to bound the size of the (K, countries, columns) products
+        n_countries = len(m.countries)
+        sub_scores = np.empty((len(names), n_countries, len(m.sub_pillars)))
+        pillar_scores = np.empty((len(names), n_countries, len(m.pillars)))
+        country_scores = np.empty((len(names), n_countries))
+        for start in range(0, len(names), block_size):
+            block = slice(start, start + block_size)
+            sub_scores[block], pillar_scores[block], country_scores[block] = \
+                m.roll_up(indicator_weights[block], sub_pillar_weights[block])
+
+        return SweepResult(m, names, sub_scores, pillar_scores, country_scores)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score many alternative weight configurations in one run")
+    parser.add_argument("--scenarios", help="CSV with a 'scenario' column plus Weights.csv columns")
+    parser.add_argument("--random", type=int, default=0, help="number of random weight perturbations")
+    parser.add_argument("--spread", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output-dir", default="Processed/Sweep")
+    parser.add_argument("--long-csv", action="store_true", help="also write every scenario score as a long CSV")
+    parser.add_argument("--profile", nargs="?", const="Processed/Sweep/profile_sweep.json", default=None)
+    args = parser.parse_args()
+
+    stage_profiler = StageProfiler(enabled=args.profile is not None)
+    sweep = WeightSweep(ScoringEngine("Weights.csv", "Sources.csv"), "Processed/Full Data/output.csv", stage_profiler)
+
+    if args.scenarios:
+        scenario_set = sweep.weights_from_frame(pd.read_csv(args.scenarios))
+    else:
+        scenario_set = sweep.random_weights(args.random, args.spread, args.seed)
+
+    result = stage_profiler.run("run_sweep", sweep.run, *scenario_set)
+    stage_profiler.run("save_sweep", result.save, args.output_dir, args.long_csv)
+    print("Scenarios:", len(result.names), "written to", args.output_dir)
+    finish_profile(stage_profiler, args.profile)
@@ -0,0 +1,208 @@
+import argparse
+import fnmatch
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import pandas as pd
+
+from aggregator import TRACKS_FILE, filter_un_countries, indicator_dtypes
+from columnar import write_columns
+from country_names import CountryNameResolver, parse_country_column
+from profiling import StageProfiler, finish_profile
+from reference import COUNTRIES_FILE, reference_table
+
+REPORT_FILE = "Processed/Tracks/report.json"
+
+
+class Track:
+    # One score directory and how its files become one output table. Files are picked by their prefix
+    # (the text before the first "_", case-insensitive) or by fnmatch patterns; with label_column set,
+    # the capitalised prefix is written to that column as aggregator.py does for the pillar name.
+
+    def __init__(self, config):
+        self.name = config["name"]
+        self.directory = config["directory"]
+        self.prefixes = [prefix.lower() for prefix in config.get("prefixes", [])]
+        self.patterns = config.get("patterns", [])
+        self.label_column = config.get("label_column")
+        self.skip = set(config.get("skip", []))
+        self.header_map = config.get("header_map", {})
+        self.headers = config["headers"]
+        self.required = config.get("required")
+        self.un_members_only = config.get("un_members_only", False)
+        self.output = config["output"]
+        self.columnar = config.get("columnar")
+        self.after = config.get("after", [])
+        if not self.prefixes and not self.patterns:
+            raise ValueError("Track {} has neither prefixes nor patterns".format(self.name))
+
+    def select(self, file_names):
+        # (files to load with their label, skipped files, names of the files this track claims)
+        to_load = []
+        skipped = []
+        claimed = set()
+        for file_name in file_names:
+            prefix = file_name.split("_")[0]
+            if self.prefixes and prefix.strip().lower() in self.prefixes:
+                label = prefix.strip().capitalize()
+            elif any(fnmatch.fnmatchcase(file_name, pattern) for pattern in self.patterns):
+                label = None
+            else:
+                continue
+            claimed.add(file_name)
+            if file_name.strip() in self.skip:
+                skipped.append({"file": file_name, "reason": "in skip list", "detail": ""})
+            else:
+                to_load.append((file_name, label))
+        return to_load, skipped, claimed
+
+    def read_file(self, file_name, label):
+        path = os.path.join(self.directory, file_name)
+        columns = [h for h in self.headers if h != self.label_column]
+        sources = columns
+        try:
+            if self.header_map:
+                # header_map renames source columns, so the columns to read depend on the file's header
+                file_columns = pd.read_csv(path, nrows=0).columns
+                inverse = {target: source for source, target in self.header_map.items() if source in file_columns}
+                sources = [inverse.get(c, c) for c in columns]
+            dtypes = {s: indicator_dtypes[c] for s, c in zip(sources, columns) if c in indicator_dtypes}
+            file_df = pd.read_csv(path, usecols=sources, dtype=dtypes)
+        except (ValueError, pd.errors.ParserError, UnicodeDecodeError) as ex:
+            return None, {"file": file_name, "reason": "header check failed", "detail": str(ex)}
+
+        file_df = file_df.rename(columns=dict(zip(sources, columns)))
+        if self.label_column is not None:
+            file_df[self.label_column] = label
+        return file_df[self.headers], None
+
+
+class DirectoryListing:
+    # every directory is listed once per run, however many tracks read it
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.listings = {}
+
+    def files(self, directory):
+        key = os.path.abspath(directory)
+        with self.lock:
+            if key not in self.listings:
+                self.listings[key] = sorted(entry.name for entry in os.scandir(directory)
+                                            if entry.is_file() and entry.name.endswith(".csv"))
+            return self.listings[key]
+
+    def unclaimed(self, claimed):
+        # files of the listed directories that no track picked up
+        return [{"track": "", "file": os.path.join(directory, file_name), "reason": "not claimed by any track",
+                 "detail": file_name.split("_")[0]}
+                for directory, file_names in self.listings.items() for file_name in file_names
+                if (directory, file_name) not in claimed]
+
+
+class TrackRunner:
+    # Runs every track of a config in one refresh. The directory listings, the country name resolver and
+    # the reference tables are shared; tracks run concurrently unless one lists another in "after", and
+    # the files of all tracks are read through one thread pool.
+
+    def __init__(self, tracks, workers=None, countries_file=COUNTRIES_FILE):
+        self.tracks = {track.name: track for track in tracks}
+        self.workers = workers or min(8, os.cpu_count() or 1)
+        self.countries_file = countries_file
+        self.listing = DirectoryListing()
+        self.resolver = CountryNameResolver()
+        self.resolver_lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, config_file=TRACKS_FILE, names=None, **kwargs):
+        with open(config_file, encoding="utf-8") as f:
+            configs = json.load(f)["tracks"]
+        tracks = [Track(config) for config in configs if names is None or config["name"] in names]
+        return cls(tracks, **kwargs)
+
+    def resolve_names(self, df):
+        # the resolver's cache is shared, so a name seen by one track is not resolved again by the next
+        with self.resolver_lock:
+            return parse_country_column(df, self.resolver)
+
+    def build_track(self, track: Track, file_pool):
+        # (table, files loaded, skipped files, claimed files) of one track, nothing is written
+        to_load, skipped, claimed = track.select(self.listing.files(track.directory))
+        results = list(file_pool.map(lambda item: track.read_file(*item), to_load))
+        frames = [file_df for file_df, _ in results if file_df is not None]
+        skipped += [error for _, error in results if error is not None]
+
+        df = pd.concat(frames, axis=0, ignore_index=True) if frames else pd.DataFrame(columns=track.headers)
+        df = self.resolve_names(df)
+        df = df.reset_index(drop=True).dropna(subset=track.required)
+        if track.un_members_only:
+            df = filter_un_countries(df, reference_table("countries", self.countries_file), verbose=False)
+        return df, len(frames), skipped, claimed
+
+    def run_track(self, track: Track, file_pool):
+        start = time.perf_counter()
+        df, files, skipped, claimed = self.build_track(track, file_pool)
+
+        os.makedirs(os.path.dirname(track.output) or ".", exist_ok=True)
+        df.to_csv(track.output, index=False)
+        if track.columnar is not None:
+            write_columns(df, track.columnar)
+        return {"track": track.name, "output": track.output, "files": files, "rows": len(df.index),
+                "skipped": [{"track": track.name, **item} for item in skipped],
+                "claimed": {(os.path.abspath(track.directory), file_name) for file_name in claimed},
+                "wall_s": time.perf_counter() - start}
+
+    def run(self, profiler: StageProfiler = None):
+        profiler = profiler or StageProfiler(enabled=False)
+        reports = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as file_pool, \
+                ThreadPoolExecutor(max_workers=max(1, len(self.tracks))) as track_pool:
+            pending = dict(self.tracks)
+            running = {}
+            while pending or running:
+                # start every track whose predecessors in this run are done
+                for name in [n for n, t in pending.items()
+                             if all(a in reports or a not in self.tracks for a in t.after)]:
+                    track = pending.pop(name)
+                    running[name] = track_pool.submit(profiler.run, "track_" + name, self.run_track, track,
+                                                      file_pool)
+                if not running:
+                    raise ValueError("Tracks wait on each other: {}".format(sorted(pending)))
+                done, _ = wait(running.values(), return_when=FIRST_COMPLETED)
+                for name in [n for n, future in running.items() if future in done]:
+                    reports[name] = running.pop(name).result()
+
+        skipped = [item for name in self.tracks for item in reports[name]["skipped"]]
+        skipped += self.listing.unclaimed(set().union(*(reports[name]["claimed"] for name in self.tracks)))
+        return {"tracks": [{k: v for k, v in reports[name].items() if k not in ("skipped", "claimed")}
+                           for name in self.tracks],
+                "skipped": skipped}
+
+
+def write_report(report, report_file=REPORT_FILE):
+    os.makedirs(os.path.dirname(report_file) or ".", exist_ok=True)
+    with open(report_file, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Aggregate every score directory of a track config in one run")
+    parser.add_argument("--config", default=TRACKS_FILE)
+    parser.add_argument("--tracks", nargs="+", default=None, help="only run these tracks")
+    parser.add_argument("--workers", type=int, default=None, help="threads reading files, shared by all tracks")
+    parser.add_argument("--report", default=REPORT_FILE, help="consolidated report of skipped and malformed files")
+    parser.add_argument("--profile", nargs="?", const="Processed/Tracks/profile_tracks.json", default=None)
+    args = parser.parse_args()
+
+    stage_profiler = StageProfiler(enabled=args.profile is not None, trace_memory=False)
+    runner = TrackRunner.from_file(args.config, args.tracks, workers=args.workers)
+    run_report = runner.run(stage_profiler)
+    write_report(run_report, args.report)
+    for track_report in run_report["tracks"]:
+        print("{track}: {files} files, {rows} rows -> {output}".format(**track_report))
+    for item in run_report["skipped"]:
+        print(item["track"] or "-", ":", item["file"], ":", item["reason"], item["detail"])
+    finish_profile(stage_profiler, args.profile)
@@ -0,0 +1,281 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from process_aggr import SUB_PILLAR_WEIGHT_KEY, ScoringEngine, handle_higher_not_better
+from profiling import StageProfiler, finish_profile
+from reference import default_registry, init_worker, read_table, worker_object
+from scaling import INDICATOR_KEYS, scale_indicator_scores
+from score_cube import RANK_TOLERANCE, rank_batched
+from sweep import IndicatorMatrix
+
+SCORE_PERCENTILES = [5, 50, 95]
+# rank tie tolerance of the sub-pillar, pillar and country levels, as ScoreCube ranks them
+LEVEL_TOLERANCES = [0.0, RANK_TOLERANCE, RANK_TOLERANCE]
+
+
+def weight_bounds(matrix: IndicatorMatrix, spread=0.0, bounds_df: pd.DataFrame = None):
+    # every weight is drawn from [w * (1 - spread), w * (1 + spread)] unless bounds_df (Weights.csv keys
+    # plus 'Min' and 'Max' columns, empty Indicator for sub-pillar weights) gives explicit bounds
+    indicator_low = matrix.base_indicator_weights * (1 - spread)
+    indicator_high = matrix.base_indicator_weights * (1 + spread)
+    sub_low = matrix.base_sub_pillar_weights * (1 - spread)
+    sub_high = matrix.base_sub_pillar_weights * (1 + spread)
+
+    if bounds_df is not None:
+        indicator_pos = {key: i for i, key in enumerate(matrix.indicators)}
+        sub_pillar_pos = {key: i for i, key in enumerate(matrix.sub_pillars)}
+        bounds_df = bounds_df.assign(Indicator=bounds_df["Indicator"].astype(str))
+        for pillar, sub_pillar, indicator, low, high in bounds_df[
+                ["Pillar", "Sub-Pillar", "Indicator", "Min", "Max"]].itertuples(index=False):
+            if indicator == SUB_PILLAR_WEIGHT_KEY:
+                if (pillar, sub_pillar) in sub_pillar_pos:
+                    sub_low[sub_pillar_pos[(pillar, sub_pillar)]] = low
+                    sub_high[sub_pillar_pos[(pillar, sub_pillar)]] = high
+            elif (pillar, sub_pillar, indicator) in indicator_pos:
+                indicator_low[indicator_pos[(pillar, sub_pillar, indicator)]] = low
+                indicator_high[indicator_pos[(pillar, sub_pillar, indicator)]] = high
+
+    return (indicator_low, indicator_high), (sub_low, sub_high)
+
+
+def column_percentiles(values, percentiles):
+    # np.nanpercentile(values, percentiles, axis=0) (linear interpolation) without the per-column loop
+    sorted_values = np.sort(values, axis=0)
+    n_valid = np.count_nonzero(~np.isnan(sorted_values), axis=0)
+    result = np.full((len(percentiles),) + values.shape[1:], np.nan)
+    for p, percentile in enumerate(percentiles):
+        position = (n_valid - 1) * percentile / 100.0
+        lower = np.floor(position).astype(int).clip(0)
+        upper = np.ceil(position).astype(int).clip(0)
+        low_values = np.take_along_axis(sorted_values, lower[None], axis=0)[0]
+        high_values = np.take_along_axis(sorted_values, upper[None], axis=0)[0]
+        result[p] = np.where(n_valid > 0, low_values + (high_values - low_values) * (position - lower), np.nan)
+    return result
+
+
+def rank_quantile(sorted_ranks, total, quantile):
+    # smallest rank reached by the quantile share of the ranked replicates, ranks sorted along axis 0
+    position = np.maximum(np.ceil(quantile * total).astype(np.int64) - 1, 0)
+    return np.where(total > 0, np.take_along_axis(sorted_ranks, position[None], axis=0)[0], np.nan)
+
+
+class ReplicateSampler:
+    # Draws one chunk of replicates at a time. A chunk only depends on its own seed, so results are the
+    # same whichever worker runs it.
+
+    def __init__(self, matrix: IndicatorMatrix, indicator_bounds, sub_pillar_bounds, resample=True,
+                 jitter=0.0, scored_df: pd.DataFrame = None, range_lookup=None,
+                 min_val=1, max_val=5.99):
+        self.matrix = matrix
+        self.indicator_bounds = indicator_bounds
+        self.sub_pillar_bounds = sub_pillar_bounds
+        self.resample = resample
+        self.jitter = jitter
+
+        # indicators are resampled with replacement inside every (country, sub-pillar) the country has data for
+        n_indicators = matrix.shape[1]
+        cells = np.flatnonzero(matrix.count.ravel() > 0)
+        groups = (cells // n_indicators) * len(matrix.sub_pillars) + \
+            matrix.indicator_sub_pillar[cells % n_indicators]
+        order = np.argsort(groups, kind="stable")
+        self.cells = cells[order]
+        groups = groups[order]
+        starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+        sizes = np.diff(np.r_[starts, len(groups)])
+        self.cell_group_start = np.repeat(starts, sizes)
+        self.cell_group_size = np.repeat(sizes, sizes)
+
+        if jitter > 0:
+            self.frame = scored_df.loc[matrix.row_index, INDICATOR_KEYS + ["data_col", "higher_is_better"]] \
+                .reset_index(drop=True)
+            # noise is relative to the spread of every indicator's raw values
+            self.noise_scale = jitter * self.frame.groupby(INDICATOR_KEYS, sort=False)["data_col"] \
+                .transform("std").fillna(0.0).to_numpy()
+            self.range_lookup = range_lookup
+            self.min_val = min_val
+            self.max_val = max_val
+
+    def jittered_data(self, rng, n):
+        m = self.matrix
+        score_sum, count, nan_count = (np.empty((n,) + m.shape) for _ in range(3))
+        values = self.frame["data_col"].to_numpy(dtype=np.float64)
+        for k in range(n):
+            frame = self.frame.assign(data_col=values + rng.standard_normal(len(values)) * self.noise_scale)
+            frame["indicator_score"] = scale_indicator_scores(frame, self.range_lookup, self.min_val, self.max_val)
+            score_sum[k], count[k], nan_count[k] = m.accumulate(handle_higher_not_better(frame)["indicator_score"])
+        return score_sum, count, nan_count
+
+    def multiplicities(self, rng, n):
+        n_cells = len(self.cells)
+        picks = self.cell_group_start + np.floor(rng.random((n, n_cells)) * self.cell_group_size).astype(int)
+        counts = np.bincount((picks + np.arange(n)[:, None] * n_cells).ravel(), minlength=n * n_cells)
+        multiplicity = np.zeros((n, self.matrix.shape[0] * self.matrix.shape[1]))
+        multiplicity[:, self.cells] = counts.reshape(n, n_cells)
+        return multiplicity.reshape((n,) + self.matrix.shape)
+
+    def run_chunk(self, n, seed):
+        m = self.matrix
+        rng = np.random.default_rng(seed)
+
+        if self.jitter > 0:
+            score_sum, count, nan_count = self.jittered_data(rng, n)
+        else:
+            score_sum, count, nan_count = m.score_sum, m.count, m.nan_count
+        if self.resample:
+            multiplicity = self.multiplicities(rng, n)
+            score_sum, count, nan_count = multiplicity * score_sum, multiplicity * count, multiplicity * nan_count
+
+        indicator_weights = rng.uniform(*self.indicator_bounds, size=(n, len(m.indicators)))
+        sub_pillar_weights = rng.uniform(*self.sub_pillar_bounds, size=(n, len(m.sub_pillars)))
+
+        sub_scores, pillar_scores, country_scores = m.roll_up(indicator_weights, sub_pillar_weights,
+                                                              score_sum, count, nan_count)
+        country_scores = country_scores[:, :, None]
+        levels = []
+        for scores, tolerance in zip((sub_scores, pillar_scores, country_scores), LEVEL_TOLERANCES):
+            ranks = rank_batched(scores, m.ranked, tolerance)
+            levels.append((scores.astype(np.float32), np.nan_to_num(ranks, nan=0).astype(np.int32)))
+        return levels
+
+
+def run_worker_chunk(n, seed):
+    return worker_object("sampler").run_chunk(n, seed)
+
+
+class UncertaintyResult:
+    LEVELS = ["sub_pillar", "pillar", "country"]
+
+    def __init__(self, matrix: IndicatorMatrix, base_levels, scores, ranks, interval=90.0,
+                 percentiles=SCORE_PERCENTILES):
+        self.matrix = matrix
+        self.base_levels = base_levels
+        self.scores = scores
+        self.ranks = ranks
+        self.interval = interval
+        self.percentiles = list(percentiles)
+
+    def summary(self):
+        m = self.matrix
+        countries = np.asarray(m.countries, dtype=object)
+        labels = [[(p, s) for p, s in m.sub_pillars], [(p, "") for p in m.pillars], [("", "")]]
+        tail = (100.0 - self.interval) / 200.0
+
+        frames = []
+        for level, (base_scores, base_ranks), scores, ranks, level_labels in zip(
+                self.LEVELS, self.base_levels, self.scores, self.ranks, labels):
+            score_percentiles = column_percentiles(scores, self.percentiles)
+            # rank 0 stands for "not ranked" and is sorted after every rank
+            total = np.count_nonzero(ranks, axis=0)
+            sorted_ranks = np.sort(np.where(ranks > 0, ranks, np.iinfo(ranks.dtype).max), axis=0)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                mean_rank = ranks.sum(axis=0, dtype=np.int64) / total
+
+            country, column = np.nonzero(~np.isnan(base_scores) | (total > 0))
+            frame = pd.DataFrame({
+                "level": level,
+                "Country Name": countries[country],
+                "Pillar": [level_labels[c][0] for c in column],
+                "Sub-Pillar": [level_labels[c][1] for c in column],
+                "base_score": base_scores[country, column],
+            })
+            for p, percentile in enumerate(self.percentiles):
+                frame["score_p{:g}".format(percentile)] = score_percentiles[p][country, column]
+            frame["base_rank"] = base_ranks[country, column]
+            frame["rank_low"] = rank_quantile(sorted_ranks, total, tail)[country, column]
+            frame["rank_median"] = rank_quantile(sorted_ranks, total, 0.5)[country, column]
+            frame["rank_high"] = rank_quantile(sorted_ranks, total, 1 - tail)[country, column]
+            frame["rank_mean"] = mean_rank[country, column]
+            frame["replicates_ranked"] = total[country, column]
+            frames.append(frame)
+
+        summary = pd.concat(frames, ignore_index=True)
+        for column in ["base_rank", "rank_low", "rank_median", "rank_high"]:
+            summary[column] = summary[column].astype("Int64")
+        return summary
+
+    def save(self, output_dir, replicates_file=False):
+        os.makedirs(output_dir, exist_ok=True)
+        self.summary().to_csv(os.path.join(output_dir, "uncertainty.csv"), index=False)
+        if replicates_file:
+            np.savez_compressed(os.path.join(output_dir, "replicate_scores.npz"),
+                                countries=np.asarray(self.matrix.countries, dtype=str),
+                                **{level + "_scores": scores for level, scores in zip(self.LEVELS, self.scores)})
+
+
+def run_uncertainty(engine: ScoringEngine, indicator_data, replicates=1000, seed=0, workers=1, chunk_size=100,
+                    resample=True, weight_spread=0.0, weight_bounds_file=None, jitter=0.0, interval=90.0,
+                    profiler: StageProfiler = None):
+    profiler = profiler or StageProfiler(enabled=False)
+    run = profiler.run
+
+    scored_df = engine.indicator_scores(indicator_data, profiler)
+    matrix = run("indicator_matrix", IndicatorMatrix, scored_df, engine.weight_index)
+    bounds_df = None if weight_bounds_file is None else read_table(weight_bounds_file)
+    indicator_bounds, sub_pillar_bounds = weight_bounds(matrix, weight_spread, bounds_df)
+    sampler = ReplicateSampler(matrix, indicator_bounds, sub_pillar_bounds, resample, jitter, scored_df,
+                               engine.tables.sources.range_lookup, engine.min_val, engine.max_val)
+
+    base = matrix.roll_up(matrix.base_indicator_weights[None], matrix.base_sub_pillar_weights[None])
+    base_levels = []
+    for scores, tolerance in zip((base[0], base[1], base[2][:, :, None]), LEVEL_TOLERANCES):
+        base_levels.append((scores[0], rank_batched(scores, matrix.ranked, tolerance)[0]))
+
+    # chunk sizes and seeds only depend on the replicate count, never on the number of workers
+    sizes = [min(chunk_size, replicates - start) for start in range(0, replicates, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+
+    n_countries = len(matrix.countries)
+    widths = [len(matrix.sub_pillars), len(matrix.pillars), 1]
+    scores = [np.empty((replicates, n_countries, width), dtype=np.float32) for width in widths]
+    # ranks are kept per replicate like the scores, so memory grows linearly with the number of countries
+    ranks = [np.empty((replicates, n_countries, width), dtype=np.int32) for width in widths]
+
+    def collect(chunks):
+        start = 0
+        for n, levels in zip(sizes, chunks):
+            for level, (level_scores, level_ranks) in enumerate(levels):
+                scores[level][start:start + n] = level_scores
+                ranks[level][start:start + n] = level_ranks
+            start += n
+
+    if workers > 1:
+        # the sampler goes to every worker once, tasks only carry a chunk size and a seed
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(default_registry(), {"sampler": sampler})) as executor:
+            run("replicates", collect, executor.map(run_worker_chunk, sizes, seeds))
+    else:
+        run("replicates", collect, map(sampler.run_chunk, sizes, seeds))
+
+    return UncertaintyResult(matrix, base_levels, scores, ranks, interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Monte Carlo rank intervals and score percentiles")
+    parser.add_argument("--replicates", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-size", type=int, default=100, help="replicates drawn per task")
+    parser.add_argument("--no-resample", action="store_true", help="keep every country's indicators fixed")
+    parser.add_argument("--weight-spread", type=float, default=0.0,
+                        help="relative bound for weight perturbation, e.g. 0.2 for +/-20%%")
+    parser.add_argument("--weight-bounds", help="CSV with Weights.csv keys plus Min and Max columns")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="std of the noise added to data_col, relative to each indicator's std")
+    parser.add_argument("--interval", type=float, default=90.0, help="central rank interval in percent")
+    parser.add_argument("--output-dir", default="Processed/Uncertainty")
+    parser.add_argument("--save-replicates", action="store_true")
+    parser.add_argument("--profile", nargs="?", const="Processed/Uncertainty/profile_uncertainty.json",
+                        default=None)
+    args = parser.parse_args()
+
+    stage_profiler = StageProfiler(enabled=args.profile is not None)
+    result = run_uncertainty(ScoringEngine("Weights.csv", "Sources.csv"), "Processed/Full Data/output.csv",
+                             args.replicates, args.seed, args.workers, args.chunk_size, not args.no_resample,
+                             args.weight_spread, args.weight_bounds, args.jitter, args.interval, stage_profiler)
+    stage_profiler.run("save_uncertainty", result.save, args.output_dir, args.save_replicates)
+    print("Replicates:", args.replicates, "written to", args.output_dir)
+    finish_profile(stage_profiler, args.profile)